@@ -1,12 +1,30 @@
+import time
+_import_started = time.perf_counter()
+
 import os
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response
+from markupsafe import Markup
 from functools import wraps
-import hashlib
-from database import init_db, get_user_by_email, create_user, save_typing_result, get_user_stats, get_leaderboard, get_user_by_id, update_user_streak, get_all_users, create_badge
-from auth import verify_google_token, send_verification_email
-import edge_tts
-import asyncio
+import passwords
+from database import local_date, init_db, get_user_by_email, create_user, record_typing_result, get_user_stats, get_leaderboard, get_user_by_id, get_all_users, get_user_rank, get_badge_asset, update_password_hash, get_key_stats, bulk_record_results, to_utc_timestamp, get_progress_series, set_user_timezone, get_data_versions
+from auth import verify_google_token, queue_verification_email
+import tts
+import badges
+import jobs
+import cache
+import metrics
+import db_pool
+import httpcache
+import ratelimit
+import corpus
+import practice
+import archive
+import scoring
 import base64
+import math
+from datetime import date, datetime, timedelta, timezone
+
+metrics.record_startup('imports', time.perf_counter() - _import_started)
 
 if os.name == 'nt':
     with open(".env", "r") as file:
@@ -20,6 +38,22 @@ if os.name == 'nt':
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 
+# Route latency histograms, Server-Timing headers and the slow-request profiler
+metrics.init_app(app)
+metrics.add_collector(lambda: [
+    (f'cache_{name}_total', 'counter', f"Read cache {name}", value)
+    for name, value in cache.stats().items() if name in ('hits', 'misses', 'invalidations', 'evictions', 'expirations')
+])
+
+# ETags, 304s, precompressed assets and gzip for text responses
+httpcache.init_app(app, versions=get_data_versions)
+
+@app.teardown_request
+def release_db_connection(exc):
+    # The threaded server runs each request on a new thread; hand the
+    # connection back so the next one reuses it instead of opening another
+    db_pool.release()
+
 # Configuration
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
@@ -31,8 +65,25 @@ app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
 
-# Initialize database
-init_db()
+# Largest batch accepted by /submit-results
+MAX_BULK_RESULTS = int(os.environ.get('MAX_BULK_RESULTS', 500))
+# Oldest offline result /submit-results accepts
+MAX_RESULT_AGE_DAYS = int(os.environ.get('MAX_RESULT_AGE_DAYS', 30))
+
+# Serverless deploys (Vercel sets VERCEL=1) pay for startup on every cold
+# start, so work that only pays off in a long-lived process is left to
+# first use: job workers start with the first enqueued job and quotes are
+# synthesized when first requested
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', '1' if os.environ.get('VERCEL') else '0') == '1'
+
+# Initialize database (a single read when the schema is already current)
+with metrics.startup_step('init_db'):
+    init_db()
+
+# Pick up queued jobs, including any left over from before a restart
+if not LAZY_STARTUP:
+    with metrics.startup_step('start_workers'):
+        jobs.start_workers()
 
 # Motivational quotes
 MOTIVATIONAL_QUOTES = [
@@ -48,6 +99,11 @@ MOTIVATIONAL_QUOTES = [
     "Progress, not perfection, is the goal."
 ]
 
+# Render the quotes' audio in the background so "Hear Quote" is served from cache
+if os.environ.get('TTS_PRERENDER', '0' if LAZY_STARTUP else '1') == '1':
+    with metrics.startup_step('tts_prerender'):
+        tts.get_engine().prerender(MOTIVATIONAL_QUOTES)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -62,7 +118,28 @@ def index():
         return redirect(url_for('dashboard'))
     return render_template('index.html')
 
+def _remember_timezone(user_id, data, current=None):
+    """Store the browser's IANA timezone (used for streak days) when it changed"""
+    timezone_name = data.get('timezone')
+    if timezone_name and timezone_name != current:
+        set_user_timezone(user_id, timezone_name)
+
+def _client_ip_key():
+    return [f'ip:{ratelimit.client_ip()}']
+
+def _bulk_result_count():
+    """Tokens a /submit-results request takes: one per result, oversized batches are refused anyway"""
+    data = request.get_json(silent=True)
+    items = data.get('results') if isinstance(data, dict) else None
+    return min(len(items), MAX_BULK_RESULTS) if isinstance(items, list) and items else 1
+
+def _login_account_key():
+    """Limit guesses against one account however many addresses they come from"""
+    email = (request.get_json(silent=True) or {}).get('email')
+    return [f'account:{str(email).strip().lower()}']
+
 @app.route('/signup', methods=['POST'])
+@ratelimit.admit('signup', keys=_client_ip_key)
 def signup():
     data = request.get_json()
     email = data.get('email')
@@ -77,22 +154,37 @@ def signup():
         return jsonify({'success': False, 'message': 'User already exists'})
     
     # Create user
-    user_id = create_user(name, email, password)
+    try:
+        user_id = create_user(name, email, password)
+    except passwords.HashingBusy:
+        return ratelimit.server_busy()
     if user_id:
-        # Send verification email
-        send_verification_email(email, name)
+        _remember_timezone(user_id, data)
+        # Send verification email in the background
+        queue_verification_email(email, name)
         return jsonify({'success': True, 'message': 'Account created successfully. Please check your email for verification.'})
     else:
         return jsonify({'success': False, 'message': 'Failed to create account'})
 
 @app.route('/login', methods=['POST'])
+@ratelimit.admit('login', keys=_client_ip_key)
+@ratelimit.admit('login-account', keys=_login_account_key)
 def login():
     data = request.get_json()
     email = data.get('email')
     password = data.get('password')
     
     user = get_user_by_email(email)
-    if user and user['password'] == hashlib.sha256(password.encode()).hexdigest():
+    try:
+        valid, new_hash = passwords.verify_password(password, user['password']) if user else (False, None)
+    except passwords.HashingBusy:
+        return ratelimit.server_busy()
+    
+    if valid:
+        if new_hash:
+            # Transparently upgrade legacy / weaker hashes
+            update_password_hash(user['id'], new_hash)
+        _remember_timezone(user['id'], data, user.get('timezone'))
         session['user_id'] = user['id']
         session['user_name'] = user['name']
         session['user_email'] = user['email']
@@ -102,7 +194,9 @@ def login():
 
 @app.route('/google-login', methods=['POST'])
 def google_login():
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
     token = data.get('token')
     
     user_info = verify_google_token(token)
@@ -113,6 +207,7 @@ def google_login():
             user_id = create_user(user_info['name'], user_info['email'], '', google_id=user_info['sub'])
         else:
             user_id = user['id']
+        _remember_timezone(user_id, data, user.get('timezone') if user else None)
         
         session['user_id'] = user_id
         session['user_name'] = user_info['name']
@@ -126,26 +221,55 @@ def logout():
     session.clear()
     return redirect(url_for('index'))
 
+def _local_day(user_id):
+    """The user's current date, which decides whether a streak still counts"""
+    user = get_user_by_id(user_id)
+    return local_date(user.get('timezone') if user else None)
+
 @app.route('/dashboard')
 @login_required
+@httpcache.conditional(tags=lambda: [f"user:{session['user_id']}", 'leaderboard'],
+                       vary=lambda: (_local_day(session['user_id']),))
 def dashboard():
     user_stats = get_user_stats(session['user_id'])
     all_users = get_all_users()
-    return render_template('dashboard.html', stats=user_stats, all_users=all_users, current_user_id=session['user_id'])
+    rank = get_user_rank(session['user_id'])
+    key_stats = get_key_stats(session['user_id'], limit=5)
+    return render_template('dashboard.html', stats=user_stats, all_users=all_users, rank=rank,
+                           key_stats=key_stats, current_user_id=session['user_id'])
 
 @app.route('/test')
 @login_required
 def test():
     return render_template('test.html')
 
+@cache.cached('leaderboard_board', tags=lambda page: ['leaderboard'])
+def _leaderboard_board(page):
+    """Rendered podium, table and totals for one page; the same for every viewer"""
+    per_page = 10
+    offset = (page - 1) * per_page
+    # Fetch one extra row to know whether there is a next page
+    leaders = get_leaderboard(limit=per_page + 1, offset=offset)
+    has_next = len(leaders) > per_page
+    return Markup(render_template('leaderboard_board.html',
+                                  leaders=leaders[:per_page],
+                                  page=page,
+                                  offset=offset,
+                                  has_next=has_next).strip())
+
 @app.route('/leaderboard')
 @login_required
+@httpcache.conditional(tags=lambda: ['leaderboard'])
 def leaderboard():
-    leaders = get_leaderboard()
-    return render_template('leaderboard.html', leaders=leaders)
+    page = max(request.args.get('page', 1, type=int), 1)
+    return render_template('leaderboard.html',
+                         board=_leaderboard_board(page),
+                         your_rank=get_user_rank(session['user_id']))
 
 @app.route('/user/<int:user_id>')
 @login_required
+@httpcache.conditional(tags=lambda user_id: [f'user:{user_id}'],
+                       vary=lambda user_id: (_local_day(user_id),))
 def user_profile(user_id):
     user = get_user_by_id(user_id)
     if not user:
@@ -160,63 +284,212 @@ def user_profile(user_id):
                          is_own_profile=is_own_profile,
                          current_user_id=session['user_id'])
 
-@app.route('/submit-result', methods=['POST'])
-@login_required
-def submit_result():
-    data = request.get_json()
-    wpm = data.get('wpm')
-    accuracy = data.get('accuracy')
-    test_duration = data.get('duration', 60)
-    
-    if wpm is None or accuracy is None:
-        return jsonify({'success': False, 'message': 'Invalid data'})
-    
-    # Save result
-    save_typing_result(session['user_id'], wpm, accuracy, test_duration)
-    
-    # Update streak
-    update_user_streak(session['user_id'])
-    
-    # Check for milestones and create badges
-    user_stats = get_user_stats(session['user_id'])
+def _read_submission(data):
+    """Check one submitted test.
+
+    Returns (text_id, passage text, keys, intervals, duration_ms, claimed_wpm,
+    claimed_accuracy); raises scoring.InvalidLog with the reason otherwise.
+    """
+    if isinstance(data, dict) and 'keys' not in data and 'wpm' in data:
+        raise scoring.InvalidLog(scoring.OUTDATED_CLIENT, code='keystrokes_required')
+    text_id = data.get('text_id') if isinstance(data, dict) else None
+    if isinstance(data, dict) and data.get('text_token') and text_id is None:
+        # A generated practice text (/typing-text?mode=adaptive)
+        token = data['text_token']
+        text = practice.read_token(token, app.secret_key) if isinstance(token, str) else None
+    else:
+        passage = corpus.get_corpus().get(text_id) if isinstance(text_id, int) else None
+        text = passage['text'] if passage else None
+    if text is None:
+        raise scoring.InvalidLog('Invalid data')
+    keys, intervals = scoring.parse_log(data, text)
+    try:
+        duration = float(data.get('duration') or 0)
+        claimed_wpm = float(data['wpm']) if data.get('wpm') is not None else None
+        claimed_accuracy = float(data['accuracy']) if data.get('accuracy') is not None else None
+    except (TypeError, ValueError):
+        raise scoring.InvalidLog('Invalid data')
+    # 0 (or absent) means the test ended with the last keystroke
+    if not math.isfinite(duration) or not 0 <= duration <= scoring.MAX_DURATION_S:
+        raise scoring.InvalidLog('Test duration is out of range')
+    return text_id, text, keys, intervals, duration * 1000, claimed_wpm, claimed_accuracy
+
+def _earliest_taken_at(user):
+    """Oldest taken_at accepted for a user: not before the account, nor MAX_RESULT_AGE_DAYS ago"""
+    oldest = (datetime.now(timezone.utc) - timedelta(days=MAX_RESULT_AGE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    created_at = user.get('created_at') if user else None
+    return max(oldest, str(created_at)) if created_at else oldest
+
+def _read_taken_at(value, earliest):
+    """Parse a client timestamp into the UTC format typing_results uses"""
+    if value is None:
+        return None
+    try:
+        taken_at = to_utc_timestamp(value)
+    except ValueError:
+        raise scoring.InvalidLog('Invalid taken_at timestamp')
+    latest = datetime.now(timezone.utc) + timedelta(minutes=5)
+    if taken_at > latest.strftime('%Y-%m-%d %H:%M:%S'):
+        raise scoring.InvalidLog('taken_at is in the future')
+    # These compare as strings; years before 1000 are not zero-padded
+    if len(taken_at) != 19 or taken_at < earliest:
+        raise scoring.InvalidLog('taken_at is too old')
+    return taken_at
+
+def _badge_payload(badges, current_streak, wpm):
+    """Queue rendering for newly awarded badges and shape them for the client"""
+    if badges:
+        # Render new badge images off the request path
+        jobs.enqueue('render_badges', [[badge['title'], badge['description']] for badge in badges])
     badges_earned = []
+    for badge in badges:
+        if badge['type'] == 'streak':
+            badges_earned.append({'type': 'streak', 'days': current_streak, 'image': badge['image']})
+        else:
+            badges_earned.append({'type': 'wpm', 'wpm': wpm, 'title': badge['title'], 'image': badge['image']})
+    return badges_earned
+
+def save_submission(user_id, data):
+    """Score one submitted test and save it; returns the /submit-result response body"""
+    try:
+        text_id, text, keys, intervals, duration_ms, claimed_wpm, claimed_accuracy = _read_submission(data)
+    except scoring.InvalidLog as e:
+        return {'success': False, 'code': e.code, 'message': str(e)}
     
-    # Check for streak milestones
-    current_streak = user_stats['current_streak']
-    if current_streak in [5, 10, 15, 30, 50, 100]:
-        badge_path = create_badge(session['user_id'], f"{current_streak} Day Streak", f"Maintained {current_streak} day typing streak!")
-        badges_earned.append({'type': 'streak', 'days': current_streak, 'image': badge_path})
+    # Score the keystrokes ourselves; the client's figures are only cross-checked
+    result = scoring.score(keys, intervals, text, duration_ms)
+    problem = scoring.validate(result, intervals, claimed_wpm, claimed_accuracy)
+    if problem:
+        return {'success': False, 'code': 'implausible', 'message': problem}
+    wpm = round(result['wpm'])
+    accuracy = round(result['accuracy'])
+    test_duration = round(result['elapsed_ms'] / 1000)
     
-    # Check for WPM records
-    best_wpm = user_stats['best_wpm']
-    if wpm == best_wpm and wpm >= 40:  # New personal record
-        milestone = None
-        if wpm >= 100:
-            milestone = "Lightning Fingers"
-        elif wpm >= 80:
-            milestone = "Speed Demon"
-        elif wpm >= 60:
-            milestone = "Fast Typer"
-        elif wpm >= 40:
-            milestone = "Speed Boost"
-        
-        if milestone:
-            badge_path = create_badge(session['user_id'], milestone, f"Achieved {wpm} WPM!")
-            badges_earned.append({'type': 'wpm', 'wpm': wpm, 'title': milestone, 'image': badge_path})
+    # Save result, update streak and award milestone badges in one transaction
+    outcome = record_typing_result(user_id, wpm, accuracy, test_duration,
+                                   keystrokes=(text_id, keys, intervals, text))
+    if outcome is None:
+        return {'success': False, 'message': 'Unknown user'}
+    
+    current_streak = outcome['current_streak']
+    badges_earned = _badge_payload(outcome['badges'], current_streak, wpm)
     
     # Get a random motivational quote
     import random
     quote = random.choice(MOTIVATIONAL_QUOTES)
     
-    return jsonify({
+    return {
         'success': True, 
+        'wpm': wpm,
+        'accuracy': accuracy,
+        'raw_wpm': round(result['raw_wpm']),
+        'consistency': round(result['consistency']),
         'badges': badges_earned,
         'quote': quote,
         'current_streak': current_streak
+    }
+
+@app.route('/submit-result', methods=['POST'])
+@login_required
+@ratelimit.admit('submit', gate='db-write')
+def submit_result():
+    data = request.get_json(silent=True) or {}
+    outcome = save_submission(session['user_id'], data)
+    if outcome.get('code') == 'keystrokes_required':
+        # An outdated client: fail loudly rather than look like a saved test
+        return jsonify(outcome), 400
+    return jsonify(outcome)
+
+@app.route('/submit-results', methods=['POST'])
+@login_required
+@ratelimit.admit('submit-results', cost=_bulk_result_count)
+@ratelimit.admit('submit', gate='db-write')
+def submit_results():
+    """Save a batch of tests (e.g. taken offline): {"results": [{...same fields as /submit-result, "taken_at"}]}"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('results')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'message': 'Invalid data'})
+    if len(items) > MAX_BULK_RESULTS:
+        return jsonify({'success': False, 'message': f'At most {MAX_BULK_RESULTS} results per request'}), 413
+    
+    earliest = _earliest_taken_at(get_user_by_id(session['user_id']))
+    accepted = []
+    rejected = []
+    for index, item in enumerate(items):
+        try:
+            submission = _read_submission(item)
+            taken_at = _read_taken_at(item.get('taken_at'), earliest)
+        except scoring.InvalidLog as e:
+            rejected.append({'index': index, 'code': e.code, 'message': str(e)})
+            continue
+        accepted.append((index, submission, taken_at))
+    
+    # Score the whole batch at once, then check each test against its claims
+    scores = scoring.score_many([(keys, intervals, text, duration_ms)
+                                 for _, (_, text, keys, intervals, duration_ms, _, _), _ in accepted])
+    results = []
+    for (index, submission, taken_at), result in zip(accepted, scores):
+        text_id, text, keys, intervals, _, claimed_wpm, claimed_accuracy = submission
+        problem = scoring.validate(result, intervals, claimed_wpm, claimed_accuracy)
+        if problem:
+            rejected.append({'index': index, 'code': 'implausible', 'message': problem})
+            continue
+        results.append({
+            'user_id': session['user_id'],
+            'wpm': round(result['wpm']),
+            'accuracy': round(result['accuracy']),
+            'test_duration': round(result['elapsed_ms'] / 1000),
+            'taken_at': taken_at,
+            'keystrokes': (text_id, keys, intervals, text)
+        })
+    
+    rejected.sort(key=lambda item: item['index'])
+    outcome = bulk_record_results(results).get(session['user_id']) if results else None
+    if outcome is None:
+        return jsonify({'success': False, 'saved': 0, 'rejected': rejected})
+    
+    return jsonify({
+        'success': True,
+        'saved': outcome['saved'],
+        'rejected': rejected,
+        'best_wpm': outcome['best_wpm'],
+        'current_streak': outcome['current_streak'],
+        'badges': _badge_payload(outcome['badges'], outcome['current_streak'], outcome['best_wpm'])
+    })
+
+@app.route('/speech', methods=['GET', 'POST'])
+@login_required
+@ratelimit.admit('speech', gate='speech')
+def speech():
+    """Stream synthesized speech as binary audio"""
+    if request.method == 'POST':
+        text = (request.get_json(silent=True) or {}).get('text')
+    else:
+        text = request.args.get('text')
+    
+    if not text:
+        return jsonify({'success': False, 'message': 'No text provided'}), 400
+    
+    chunks = tts.get_engine().stream(text)
+    try:
+        # Pull the first chunk here so synthesis errors still get a JSON reply
+        first_chunk = next(chunks, b"")
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 502
+    
+    def generate():
+        yield first_chunk
+        yield from chunks
+    
+    return Response(generate(), mimetype=tts.AUDIO_MIMETYPE, headers={
+        'Cache-Control': 'private, max-age=86400',
+        'ETag': f'"{tts.audio_key(text)}"'
     })
 
 @app.route('/generate-speech', methods=['POST'])
 @login_required
+@ratelimit.admit('speech', gate='speech')
 def generate_speech():
     data = request.get_json()
     text = data.get('text')
@@ -224,21 +497,10 @@ def generate_speech():
     if not text:
         return jsonify({'success': False, 'message': 'No text provided'})
     
-    async def create_speech():
-        communicate = edge_tts.Communicate(text, "en-US-AriaNeural")
-        audio_data = b""
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_data += chunk["data"]
-        return audio_data
-    
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        audio_data = loop.run_until_complete(create_speech())
-        loop.close()
+        audio_data = tts.get_engine().synthesize(text)
         
-        # Convert to base64 for JSON response
+        # Convert to base64 for JSON response (kept for older clients; prefer /speech)
         audio_b64 = base64.b64encode(audio_data).decode()
         return jsonify({'success': True, 'audio': audio_b64})
     except Exception as e:
@@ -246,20 +508,67 @@ def generate_speech():
 
 @app.route('/typing-text')
 def typing_text():
-    texts = [
-        "The quick brown fox jumps over the lazy dog. This sentence contains all letters of the alphabet and is perfect for typing practice.",
-        "In the digital age, typing skills have become essential for productivity and communication in both personal and professional contexts.",
-        "Practice makes perfect, and consistent daily typing exercises can significantly improve your speed and accuracy over time.",
-        "Technology continues to evolve rapidly, changing the way we work, communicate, and interact with the world around us.",
-        "The art of typing efficiently requires muscle memory, proper finger placement, and regular practice to achieve mastery."
-    ]
-    
-    import random
-    return jsonify({'text': random.choice(texts)})
+    """Pick a passage, e.g. /typing-text?duration=60&difficulty=hard&focus=punctuation
+
+    With mode=adaptive the text is generated instead, favouring the signed-in
+    user's weak keys; submit it back with its text_token instead of text_id.
+    """
+    duration = request.args.get('duration', type=int)
+    if request.args.get('mode') == 'adaptive':
+        passage = practice.generate(session.get('user_id'), duration, get_key_stats)
+        if passage is None:
+            return jsonify({'success': False, 'message': 'No typing texts available'}), 503
+        return jsonify(dict(passage, id=None, mode='adaptive',
+                            text_token=practice.make_token(passage['text'], app.secret_key)))
+    user_key = session.get('user_id') or request.remote_addr
+    passage = corpus.get_corpus().choose(duration=duration,
+                                         difficulty=request.args.get('difficulty'),
+                                         focus=request.args.get('focus'),
+                                         user_key=user_key)
+    if passage is None:
+        return jsonify({'success': False, 'message': 'No typing texts available'}), 503
+    return jsonify(passage)
+
+@app.route('/race/token')
+@login_required
+def race_token():
+    """Token and URL for joining a race on the WebSocket server (races.py)"""
+    import races
+    user = get_user_by_id(session['user_id'])
+    if user is None:
+        return jsonify({'success': False, 'message': 'Unknown user'}), 404
+    url = races.RACE_URL or f"ws://{request.host.split(':')[0]}:{races.RACE_PORT}/race/ws"
+    return jsonify({
+        'success': True,
+        'token': races.make_token(user['id'], user['name'], app.secret_key),
+        'url': url,
+        'expires_in': races.TOKEN_MAX_AGE,
+    })
+
+@app.route('/badges/<asset_key>.svg')
+def badge_image(asset_key):
+    """Serve a shared badge image; the key is content-derived, so it never changes"""
+    def load():
+        svg = badges.get_badge_svg(asset_key, get_badge_asset)
+        return (svg, badges.SVG_MIMETYPE, asset_key) if svg is not None else None
+
+    response = httpcache.send_asset(f'badge:{asset_key}', load, tag=asset_key)
+    if response is None:
+        return jsonify({'success': False, 'message': 'Unknown badge'}), 404
+    return response
 
 @app.route('/favicon.ico')
 def favicon():
-    return send_file('favico.png', mimetype='image/png')
+    # Browsers ask for this fixed URL; pages link the fingerprinted /assets/ copy
+    return httpcache.send_file_asset('favico.png', 'public, max-age=86400')
+
+@app.route('/assets/<name>')
+def static_asset(name):
+    """Fingerprinted project files (see httpcache.asset_url), cached forever"""
+    response = httpcache.send_fingerprinted(name)
+    if response is None:
+        return jsonify({'success': False, 'message': 'Unknown asset'}), 404
+    return response
 
 @app.route('/get-typing-stats')
 @login_required
@@ -267,6 +576,63 @@ def get_typing_stats():
     stats = get_user_stats(session['user_id'])
     return jsonify(stats)
 
+@app.route('/progress')
+@login_required
+def progress():
+    """Progress series, e.g. /progress?resolution=week&start=2024-01-01&end=2024-12-31&points=52"""
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD'}), 400
+    if start and end and start > end:
+        return jsonify({'success': False, 'message': 'start must not be after end'}), 400
+    points = min(max(request.args.get('points', 60, type=int), 2), 366)
+    series = get_progress_series(session['user_id'], request.args.get('resolution', 'auto'),
+                                 start, end, points)
+    return jsonify(series)
+
+@app.route('/key-stats')
+@login_required
+def key_stats():
+    """Most-missed keys and slowest bigrams, e.g. /key-stats?limit=20"""
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    return jsonify(get_key_stats(session['user_id'], limit=limit))
+
+@app.route('/export')
+@login_required
+@ratelimit.admit('export')
+def export_results():
+    """Stream the user's whole result history, e.g. /export?format=csv (default ndjson)"""
+    file_format = request.args.get('format', 'ndjson')
+    if file_format not in archive.FORMATS:
+        return jsonify({'success': False, 'message': f"format must be one of: {', '.join(archive.FORMATS)}"}), 400
+    encode, mimetype = archive.FORMATS[file_format]
+    user_id = session['user_id']
+    
+    def generate():
+        # Runs after the request's teardown, so it returns its own connection
+        try:
+            yield from encode(archive.export_results(user_id))
+        finally:
+            db_pool.release()
+    
+    return Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="typing-results.{file_format}"',
+        'Cache-Control': 'private, no-store'
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    if not metrics.ENABLED:
+        return jsonify({'success': False, 'message': 'Metrics are disabled'}), 404
+    if not metrics.authorized(request.headers.get('Authorization'), request.remote_addr):
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+metrics.record_startup('total', time.perf_counter() - _import_started)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
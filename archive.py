@@ -0,0 +1,297 @@
+"""Hot/cold partitioning of typing_results, and streaming export.
+
+The main database keeps recent results only. archive_results() moves every
+result from a calendar month (UTC) that ended more than ARCHIVE_AFTER_DAYS
+ago, with its keystroke log, into that month's own SQLite file under
+ARCHIVE_DIR (results-YYYY-MM.db). Cold partitions hold just the two tables
+and a (user_id, created_at) index, are written with a rollback journal and
+vacuumed after each run, so one month is one compact, self-contained file
+that can be copied to cheaper storage or opened with any SQLite tool.
+
+Everything the app reads on a request is kept elsewhere and stays put:
+user_aggregates, progress_rollups, key stats, streaks and the leaderboard
+are running totals, so only the raw rows move. The main database records
+each partition in archive_partitions and the totals of what was moved in
+archived_totals. The rebuild and check commands read those, and the
+partitions through cold_rows(), so they still cover the whole history.
+
+Rows are moved in batches of ARCHIVE_BATCH_SIZE. Each batch is first
+committed to the partition and only then deleted from the main database.
+A run that is interrupted in between leaves copies in both tiers, which
+the next run (INSERT OR IGNORE, keyed by result id) finishes moving.
+
+export_results() streams one user's or every user's results from the cold
+partitions and the main database, merged by created_at; a result still in
+both tiers after an interrupted run is exported once. Reads are keyset
+paginated, so memory stays constant and no read transaction is held open
+on the main database for the whole export. to_ndjson() and to_csv() turn
+the rows into lines in the format manage.py import-results reads.
+"""
+import csv
+import heapq
+import io
+import json
+import os
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+
+import cache
+import db_pool
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 5000))
+# Rows fetched per query while exporting
+EXPORT_PAGE_SIZE = 1000
+
+EXPORT_FIELDS = ('id', 'user_id', 'wpm', 'accuracy', 'test_duration', 'taken_at')
+
+_PARTITION_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS typing_results (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        wpm REAL NOT NULL,
+        accuracy REAL NOT NULL,
+        test_duration INTEGER NOT NULL,
+        created_at TIMESTAMP NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_typing_results_user_created ON typing_results (user_id, created_at)',
+    '''
+    CREATE TABLE IF NOT EXISTS typing_keystrokes (
+        result_id INTEGER PRIMARY KEY,
+        text_id INTEGER,
+        data BLOB NOT NULL
+    )
+    ''',
+)
+
+_ADD_TO_ARCHIVED_TOTALS = '''
+    INSERT INTO archived_totals
+        (user_id, result_count, wpm_sum, wpm_sq_sum, wpm_max, accuracy_sum, accuracy_sq_sum, accuracy_max)
+    SELECT user_id, COUNT(*), SUM(wpm), SUM(wpm * wpm), MAX(wpm),
+           SUM(accuracy), SUM(accuracy * accuracy), MAX(accuracy)
+    FROM typing_results
+    WHERE id IN (SELECT value FROM json_each(?))
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        result_count = result_count + excluded.result_count,
+        wpm_sum = wpm_sum + excluded.wpm_sum,
+        wpm_sq_sum = wpm_sq_sum + excluded.wpm_sq_sum,
+        wpm_max = MAX(wpm_max, excluded.wpm_max),
+        accuracy_sum = accuracy_sum + excluded.accuracy_sum,
+        accuracy_sq_sum = accuracy_sq_sum + excluded.accuracy_sq_sum,
+        accuracy_max = MAX(accuracy_max, excluded.accuracy_max)
+'''
+
+
+def archive_dir():
+    """Directory of the cold partitions (default: "archive" next to the database)"""
+    if ARCHIVE_DIR:
+        return ARCHIVE_DIR
+    return os.path.join(os.path.dirname(os.path.abspath(db_pool.DB_PATH)), 'archive')
+
+
+def partition_filename(month):
+    return f'results-{month}.db'
+
+
+def horizon(days=None, today=None):
+    """First day (YYYY-MM-01) of the oldest month that stays hot"""
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    today = today or datetime.now(timezone.utc).date()
+    return (today - timedelta(days=days)).replace(day=1).isoformat()
+
+
+def _next_month(month):
+    year, number = map(int, month.split('-'))
+    return date(year + number // 12, number % 12 + 1, 1).isoformat()
+
+
+def partitions(conn=None):
+    """(month, path, result_count) of every cold partition, oldest first"""
+    conn = conn or db_pool.get_connection()
+    directory = archive_dir()
+    return [(row['month'], os.path.join(directory, row['filename']), row['result_count'])
+            for row in conn.execute('SELECT month, filename, result_count FROM archive_partitions ORDER BY month')]
+
+
+def _open_partition(path, readonly=False):
+    if readonly:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=db_pool.BUSY_TIMEOUT_MS / 1000)
+    else:
+        conn = sqlite3.connect(path, timeout=db_pool.BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        for statement in _PARTITION_SCHEMA:
+            conn.execute(statement)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def cold_rows(query, params=()):
+    """Run a read-only query against every cold partition in turn and yield its rows"""
+    for _, path, _ in partitions():
+        conn = _open_partition(path, readonly=True)
+        try:
+            yield from conn.execute(query, params)
+        finally:
+            conn.close()
+
+
+def _move_batch(hot, cold, month, start, end):
+    """Move up to BATCH_SIZE results of one month; returns how many moved"""
+    rows = hot.execute('''
+        SELECT id, user_id, wpm, accuracy, test_duration, created_at
+        FROM typing_results
+        WHERE created_at >= ? AND created_at < ?
+        ORDER BY created_at
+        LIMIT ?
+    ''', (start, end, BATCH_SIZE)).fetchall()
+    if not rows:
+        return 0
+    ids = json.dumps([row[0] for row in rows])
+    logs = hot.execute('''
+        SELECT result_id, text_id, data FROM typing_keystrokes
+        WHERE result_id IN (SELECT value FROM json_each(?))
+    ''', (ids,)).fetchall()
+
+    # Durable in the partition before anything leaves the main database
+    cold.execute('BEGIN')
+    try:
+        cold.executemany('INSERT OR IGNORE INTO typing_results VALUES (?, ?, ?, ?, ?, ?)', rows)
+        cold.executemany('INSERT OR IGNORE INTO typing_keystrokes VALUES (?, ?, ?)', logs)
+        cold.execute('COMMIT')
+    except BaseException:
+        cold.execute('ROLLBACK')
+        raise
+
+    with db_pool.transaction() as conn:
+        conn.execute(_ADD_TO_ARCHIVED_TOTALS, (ids,))
+        conn.execute('DELETE FROM typing_keystrokes WHERE result_id IN (SELECT value FROM json_each(?))', (ids,))
+        moved = conn.execute('DELETE FROM typing_results WHERE id IN (SELECT value FROM json_each(?))', (ids,)).rowcount
+        conn.execute('''
+            INSERT INTO archive_partitions (month, filename, result_count) VALUES (?, ?, ?)
+            ON CONFLICT (month) DO UPDATE SET
+                result_count = result_count + excluded.result_count,
+                archived_at = CURRENT_TIMESTAMP
+        ''', (month, partition_filename(month), moved))
+    return moved
+
+
+def archive_results(days=None, dry_run=False, progress=None):
+    """Move whole months older than `days` (default ARCHIVE_AFTER_DAYS) to cold partitions.
+
+    Returns {month: results moved}; with dry_run, the counts that would move.
+    """
+    cutoff = horizon(days)
+    hot = db_pool.get_connection()
+    months = {row[0]: row[1] for row in hot.execute('''
+        SELECT substr(created_at, 1, 7) as month, COUNT(*)
+        FROM typing_results
+        WHERE created_at < ?
+        GROUP BY month
+        ORDER BY month
+    ''', (cutoff,))}
+    if dry_run or not months:
+        return months
+
+    directory = archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    moved = {}
+    for month in months:
+        start, end = f'{month}-01', _next_month(month)
+        cold = _open_partition(os.path.join(directory, partition_filename(month)))
+        try:
+            total = 0
+            while True:
+                count = _move_batch(hot, cold, month, start, end)
+                if not count:
+                    break
+                total += count
+            cold.execute('VACUUM')
+        finally:
+            cold.close()
+        moved[month] = total
+        if progress:
+            progress(f"{month}: {total} result(s) archived")
+    cache.clear()
+    return moved
+
+
+def _hot_pages(user_id):
+    """Yield the main database's results in (created_at, id) order, a page per query"""
+    conn = db_pool.get_connection()
+    where = 'user_id = ? AND ' if user_id is not None else ''
+    params = (user_id,) if user_id is not None else ()
+    last = ('', 0)
+    while True:
+        rows = conn.execute(f'''
+            SELECT id, user_id, wpm, accuracy, test_duration, created_at
+            FROM typing_results
+            WHERE {where}(created_at, id) > (?, ?)
+            ORDER BY created_at, id
+            LIMIT ?
+        ''', (*params, *last, EXPORT_PAGE_SIZE)).fetchall()
+        yield from rows
+        if len(rows) < EXPORT_PAGE_SIZE:
+            return
+        last = (rows[-1]['created_at'], rows[-1]['id'])
+
+
+def _cold_pages(user_id):
+    where = 'WHERE user_id = ?' if user_id is not None else ''
+    params = (user_id,) if user_id is not None else ()
+    return cold_rows(f'''
+        SELECT id, user_id, wpm, accuracy, test_duration, created_at
+        FROM typing_results {where}
+        ORDER BY created_at, id
+    ''', params)
+
+
+def export_results(user_id=None):
+    """Yield every result of one user (or of everyone) as a dict, oldest first, across both tiers"""
+    def sort_key(row):
+        return row['created_at'], row['id']
+
+    last = None
+    for row in heapq.merge(_cold_pages(user_id), _hot_pages(user_id), key=sort_key):
+        # Both copies of a row caught mid-move sort next to each other
+        if sort_key(row) == last:
+            continue
+        last = sort_key(row)
+        yield {
+            'id': row['id'],
+            'user_id': row['user_id'],
+            'wpm': row['wpm'],
+            'accuracy': row['accuracy'],
+            'test_duration': row['test_duration'],
+            'taken_at': row['created_at'],
+        }
+
+
+def to_ndjson(rows):
+    """Yield one JSON line per row"""
+    for row in rows:
+        yield json.dumps(row, separators=(',', ':')) + '\n'
+
+
+def to_csv(rows):
+    """Yield a header line, then one CSV line per row"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, for an empty export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+FORMATS = {
+    'ndjson': (to_ndjson, 'application/x-ndjson'),
+    'csv': (to_csv, 'text/csv'),
+}
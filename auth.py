@@ -1,84 +1,96 @@
 import os
-import smtplib
-import requests
-import hashlib
+import jobs
+from mailer import get_mailer, SendError
+from google_tokens import verify_id_token, TokenError
+import passwords
 import secrets
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
 def verify_google_token(token):
     """Verify Google OAuth token and return user info"""
     try:
-        response = requests.get(f'https://oauth2.googleapis.com/tokeninfo?id_token={token}')
-        if response.status_code == 200:
-            user_info = response.json()
-            # Verify the token is for our app
-            if user_info.get('aud') == os.environ.get('GOOGLE_CLIENT_ID'):
-                return {
-                    'sub': user_info['sub'],
-                    'email': user_info['email'],
-                    'name': user_info['name'],
-                    'picture': user_info.get('picture', '')
-                }
-    except Exception as e:
+        user_info = verify_id_token(token, os.environ.get('GOOGLE_CLIENT_ID'))
+        if not isinstance(user_info.get('sub'), str) or not isinstance(user_info.get('email'), str):
+            raise TokenError("Token has no subject or email")
+        name = user_info.get('name')
+        picture = user_info.get('picture')
+        return {
+            'sub': user_info['sub'],
+            'email': user_info['email'],
+            'name': name if isinstance(name, str) and name else user_info['email'],
+            'picture': picture if isinstance(picture, str) else ''
+        }
+    except TokenError as e:
         print(f"Error verifying Google token: {e}")
     return None
 
-def send_verification_email(email, name):
-    """Send email verification"""
-    try:
-        # Create verification token
-        token = secrets.token_urlsafe(32)
-        
-        # Email content
-        subject = "Welcome to TypingMaster - Verify Your Email"
-        body = f"""
-        Hi {name},
+def build_verification_email(email, name):
+    """Build the welcome / verification message"""
+    # Create verification token
+    token = secrets.token_urlsafe(32)
+    
+    # Email content
+    subject = "Welcome to TypingMaster - Verify Your Email"
+    body = f"""
+    Hi {name},
 
-        Welcome to TypingMaster! Thank you for signing up.
+    Welcome to TypingMaster! Thank you for signing up.
 
-        Your account has been created successfully. You can now start improving your typing skills with our interactive tests and track your progress over time.
+    Your account has been created successfully. You can now start improving your typing skills with our interactive tests and track your progress over time.
 
-        Features you'll enjoy:
-        - Real-time WPM feedback
-        - Progress tracking with beautiful charts
-        - Streak tracking and badges
-        - Leaderboards to compete with others
-        - Motivational quotes and TTS support
+    Features you'll enjoy:
+    - Real-time WPM feedback
+    - Progress tracking with beautiful charts
+    - Streak tracking and badges
+    - Leaderboards to compete with others
+    - Motivational quotes and TTS support
 
-        Start typing and watch your skills improve!
+    Start typing and watch your skills improve!
 
-        Best regards,
-        The TypingMaster Team
-        """
-        
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = os.environ.get('MAIL_USERNAME')
-        msg['To'] = email
-        msg['Subject'] = subject
-        
-        msg.attach(MIMEText(body, 'plain'))
-        
-        # Send email
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(os.environ.get('MAIL_USERNAME'), os.environ.get('MAIL_PASSWORD'))
-        server.send_message(msg)
-        server.quit()
-        
+    Best regards,
+    The TypingMaster Team
+    """
+    
+    # Create message (email.mime is only imported when a message is built)
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    msg = MIMEMultipart()
+    msg['From'] = os.environ.get('MAIL_USERNAME')
+    msg['To'] = email
+    msg['Subject'] = subject
+    
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+def send_verification_email(email, name):
+    """Send email verification right away over the pooled SMTP connection"""
+    try:
+        get_mailer().send(build_verification_email(email, name))
         return True
     except Exception as e:
         print(f"Error sending email: {e}")
         return False
 
+def queue_verification_email(email, name):
+    """Send email verification from the background job queue"""
+    return jobs.enqueue('verification_email', {'email': email, 'name': name})
+
+def send_verification_emails(payloads):
+    """Job handler: send a batch of verification emails on one connection"""
+    messages = [build_verification_email(p['email'], p['name']) for p in payloads]
+    try:
+        get_mailer().send_many(messages)
+    except SendError as e:
+        # Only the messages that were not delivered are retried
+        raise jobs.PartialFailure(e.sent, e.error) from e
+
 def hash_password(password):
-    """Hash password using SHA256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash password with the configured KDF"""
+    return passwords.hash_password(password)
 
 def verify_password(password, hashed):
     """Verify password against hash"""
-    return hash_password(password) == hashed
+    return passwords.verify_password(password, hashed)[0]
 
 def generate_share_url(badge_type, achievement):
     """Generate share URLs for social media"""
@@ -0,0 +1,112 @@
+"""Shared, content-addressed badge images.
+
+There are only a handful of distinct badges, so each (title, description)
+pair is rendered once and stored under a key derived from its content.
+Badge rows only reference that key, which means awarding a badge is a
+database insert: the SVG is rendered on first request (or ahead of time
+with prerender) and then served from memory or disk with immutable
+caching headers.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+BADGE_DIR = os.environ.get('BADGE_DIR', '/tmp/badges' if os.name != 'nt' else 'badges')
+MEMORY_CACHE_ENTRIES = int(os.environ.get('BADGE_CACHE_ENTRIES', 1024))
+
+SVG_MIMETYPE = 'image/svg+xml'
+
+_memory = OrderedDict()
+_lock = threading.Lock()
+
+
+def badge_key(title, description):
+    """Content address of a badge"""
+    return hashlib.sha256(f"{title}\0{description}".encode()).hexdigest()[:32]
+
+
+def badge_url(key):
+    """URL the badge image is served from"""
+    return f"/badges/{key}.svg"
+
+
+def render_badge(title, description):
+    """Render a badge to SVG bytes with anybadge"""
+    import anybadge
+
+    badge = anybadge.Badge(
+        label=title,
+        value=description,
+        default_color='gold',
+        text_color='white'
+    )
+    return badge.badge_svg_text.encode()
+
+
+def _path(key):
+    return os.path.join(BADGE_DIR, f"{key}.svg")
+
+
+def _remember(key, svg):
+    with _lock:
+        _memory[key] = svg
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_CACHE_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _store(key, svg):
+    """Write a rendered badge to disk atomically"""
+    try:
+        os.makedirs(BADGE_DIR, exist_ok=True)
+        tmp_path = f"{_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(svg)
+        os.replace(tmp_path, _path(key))
+    except OSError as e:
+        print(f"Error storing badge: {e}")
+
+
+def get_badge_svg(key, lookup):
+    """Return the SVG for `key`, rendering it on first use.
+
+    `lookup(key)` returns (title, description) for a known key or None.
+    Returns None for unknown keys.
+    """
+    with _lock:
+        svg = _memory.get(key)
+        if svg is not None:
+            _memory.move_to_end(key)
+            return svg
+
+    try:
+        with open(_path(key), 'rb') as f:
+            svg = f.read()
+    except OSError:
+        details = lookup(key)
+        if details is None:
+            return None
+        svg = render_badge(*details)
+        _store(key, svg)
+
+    _remember(key, svg)
+    return svg
+
+
+def prerender(title, description):
+    """Render and store a badge ahead of its first request"""
+    key = badge_key(title, description)
+    if os.path.exists(_path(key)):
+        return key
+    svg = render_badge(title, description)
+    _store(key, svg)
+    _remember(key, svg)
+    return key
+
+
+def render_badges(payloads):
+    """Job handler: pre-render badge images so the first view is a file read"""
+    for badge_list in payloads:
+        for title, description in badge_list:
+            prerender(title, description)
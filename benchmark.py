@@ -0,0 +1,610 @@
+"""Reproducible load benchmarks for the core routes.
+
+seed() fills a fresh SQLite file with synthetic users and typing_results
+(deterministic for a given seed) and rebuilds every derived table from
+them, so the database looks like one that grew through the app.
+
+run() then measures /submit-result, /dashboard, /leaderboard,
+/get-typing-stats and /typing-text against it, in one or both modes:
+
+    test-client   requests issued one after another through Flask's test
+                  client, in process: the server-side cost of each route
+    http          the app served by a threaded HTTP server in a separate
+                  process and driven by several client processes over
+                  keep-alive connections: throughput under concurrency
+
+Requests are spread over a pool of seeded users whose session cookies are
+signed locally, so no password hashing is involved. Speech synthesis,
+SMTP and Google's key endpoint are replaced by their local fakes, so
+nothing leaves the machine.
+
+race_load() does the same for the WebSocket race server (races.py): it
+fills private rooms with seeded users whose simulated clients type at a
+set rate, and reports how long keystrokes take to come back in the
+broadcast state, next to the server's message and tick counters.
+
+Results are plain dicts (throughput and p50/p90/p99/max latency per route
+and mode), written as JSON by manage.py benchmark-routes; compare() lists
+the regressions between two such files.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import corpus
+import db_pool
+import migrations
+
+PASSWORD = 'benchmark-password'
+EMAIL_DOMAIN = 'bench.example.invalid'
+DURATIONS = (15, 30, 60, 120)
+
+ROUTES = {
+    'submit-result': ('POST', '/submit-result'),
+    'dashboard': ('GET', '/dashboard'),
+    'leaderboard': ('GET', '/leaderboard'),
+    'get-typing-stats': ('GET', '/get-typing-stats'),
+    'typing-text': ('GET', '/typing-text?duration=60'),
+}
+MODES = ('test-client', 'http')
+
+# How much worse (relative) p99 latency or throughput may get before compare() flags it
+REGRESSION_THRESHOLD = 0.2
+
+
+def install_stubs():
+    """Replace every external service with its local fake"""
+    import google_tokens
+    import mailer
+    import tts
+
+    tts.set_synthesizer(tts.FakeSynthesizer())
+    mailer.set_transport(mailer.FakeTransport())
+    google_tokens.set_jwks_fetcher(lambda: ({'keys': []}, 3600))
+
+
+def _user_rows(count, rng, now):
+    for index in range(count):
+        created = now - timedelta(days=rng.randrange(1, 730))
+        yield (f'Bench User {index}', f'user{index}@{EMAIL_DOMAIN}', created.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _result_rows(user_ids, total, days, rng, now):
+    """Yield (user_id, wpm, accuracy, test_duration, created_at) sorted by user and time"""
+    # A few users take most of the tests, as on the real site
+    weights = [rng.paretovariate(1.2) for _ in user_ids]
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    for index in rng.sample(range(len(user_ids)), min(total - sum(counts), len(user_ids))):
+        counts[index] += 1
+
+    for user_id, count in zip(user_ids, counts):
+        skill = min(max(rng.gauss(45, 15), 10), 140)
+        ages = sorted((rng.random() * days for _ in range(count)), reverse=True)
+        for age in ages:
+            wpm = round(min(max(rng.gauss(skill, 5), 5), 200), 1)
+            accuracy = round(min(max(rng.gauss(94, 4), 50), 100), 1)
+            created = now - timedelta(days=age)
+            yield (user_id, wpm, accuracy, rng.choice(DURATIONS), created.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def seed(path, users=1000, results=100_000, days=365, seed=0, batch_size=50_000, progress=None):
+    """Create a benchmark database at `path` (which must not exist yet).
+
+    Every user shares one password hash (PASSWORD), so seeding costs one
+    hash instead of one per user. Aggregates, the leaderboard, progress
+    rollups, totals and streaks are rebuilt from the results at the end.
+    Returns per-step timings in seconds.
+    """
+    import database
+    import passwords
+
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists; seed into a new file")
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    timings = {}
+    report = progress or (lambda message: None)
+
+    db_pool.configure(path)
+    migrations.migrate()
+    conn = db_pool.get_connection()
+
+    start = time.perf_counter()
+    password_hash = passwords.hash_password(PASSWORD)
+    with db_pool.transaction():
+        conn.executemany('INSERT INTO users (name, email, password, created_at) VALUES (?, ?, ?, ?)',
+                         ((name, email, password_hash, created) for name, email, created in _user_rows(users, rng, now)))
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    timings['users'] = time.perf_counter() - start
+    report(f"{users} users in {timings['users']:.1f}s")
+
+    start = time.perf_counter()
+    rows = _result_rows(user_ids, results, days, rng, now)
+    inserted = 0
+    while True:
+        batch = [row for _, row in zip(range(batch_size), rows)]
+        if not batch:
+            break
+        with db_pool.transaction():
+            conn.executemany('''
+                INSERT INTO typing_results (user_id, wpm, accuracy, test_duration, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', batch)
+        inserted += len(batch)
+        report(f"{inserted}/{results} results")
+    timings['results'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    database.rebuild_user_aggregates()
+    database.rebuild_leaderboard()
+    database.rebuild_progress_rollups()
+    with db_pool.transaction():
+        conn.execute('''
+            UPDATE users
+            SET total_tests = a.result_count, best_wpm = a.wpm_max
+            FROM user_aggregates a
+            WHERE a.user_id = users.id
+        ''')
+    database.recompute_streaks()
+    timings['derived'] = time.perf_counter() - start
+    report(f"Derived tables rebuilt in {timings['derived']:.1f}s")
+    return timings
+
+
+def _session_cookies(app, user_ids):
+    """Signed Flask session cookies for the given users, as the app would issue at login"""
+    serializer = app.session_interface.get_signing_serializer(app)
+    return [serializer.dumps({'user_id': user_id, 'user_name': f'Bench User {user_id}',
+                              'user_email': f'user{user_id}@{EMAIL_DOMAIN}'})
+            for user_id in user_ids]
+
+
+def _payloads(rng, texts, count):
+    payloads = []
+    passage_ids = texts.ids()
+    for _ in range(count):
+        passage_id = rng.choice(passage_ids)
+        text = texts.text(passage_id)
+        gap = 60000 / (rng.uniform(30, 90) * 5)
+        keys = ''.join('#' if rng.random() < 0.03 else ch for ch in text)
+        payloads.append(json.dumps({
+            'text_id': passage_id,
+            'keys': keys,
+            'intervals': [max(int(rng.gauss(gap, gap / 4)), 30) for _ in keys],
+            'duration': 0,
+        }))
+    return payloads
+
+
+def _ok(status, body, route):
+    if status >= 400:
+        return False
+    if route == 'submit-result':
+        try:
+            return json.loads(body).get('success') is True
+        except ValueError:
+            return False
+    return True
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def _summary(route, mode, latencies, errors, seconds, workers):
+    ordered = sorted(latencies)
+    return {
+        'route': route,
+        'mode': mode,
+        'workers': workers,
+        'requests': len(ordered),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(ordered) / seconds, 1) if seconds else 0.0,
+        'p50_ms': round(_percentile(ordered, 0.50) * 1000, 3),
+        'p90_ms': round(_percentile(ordered, 0.90) * 1000, 3),
+        'p99_ms': round(_percentile(ordered, 0.99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+
+
+def _sample_users(path, count, seed):
+    conn = sqlite3.connect(path)
+    try:
+        ids = [row[0] for row in conn.execute('SELECT id FROM users WHERE email LIKE ?', (f'%@{EMAIL_DOMAIN}',))]
+    finally:
+        conn.close()
+    if not ids:
+        raise ValueError(f"{path} has no benchmark users; run seed first")
+    return random.Random(seed).sample(ids, min(count, len(ids)))
+
+
+def _run_test_client(app, route, requests, warmup, cookies, payloads, rng):
+    method, url = ROUTES[route]
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for index in range(warmup + requests):
+        client.set_cookie('session', rng.choice(cookies))
+        body = payloads[index % len(payloads)] if method == 'POST' else None
+        start = time.perf_counter()
+        response = client.open(url, method=method, data=body, content_type='application/json')
+        elapsed = time.perf_counter() - start
+        if index == warmup:
+            started = start
+        if index >= warmup:
+            latencies.append(elapsed)
+            if not _ok(response.status_code, response.get_data(), route):
+                errors += 1
+    return latencies, errors, time.perf_counter() - started
+
+
+def serve(port):
+    """Serve the app on localhost with a threaded HTTP/1.1 server (run in a subprocess)"""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    install_stubs()
+    import app
+    import ratelimit
+
+    # Every simulated user submits far faster than a person could
+    ratelimit.set_enabled(False)
+
+    class Handler(WSGIRequestHandler):
+        # Keep-alive needs HTTP/1.1; per-request access logs would dominate the timings
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    make_server('127.0.0.1', port, app.app, threaded=True, request_handler=Handler).serve_forever()
+
+
+def serve_races(port):
+    """Run the race server on localhost (run in a subprocess)"""
+    import races
+
+    install_stubs()
+    races.serve(port, host='127.0.0.1')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(path, timeout=60, target='serve', env=None):
+    port = _free_port()
+    env = dict(os.environ, DB_PATH=path, TTS_PRERENDER='0', **(env or {}))
+    process = subprocess.Popen(
+        [sys.executable, '-c', f'import benchmark; benchmark.{target}({port})'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Benchmark server exited with status {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Benchmark server did not start in time")
+
+
+def _http_worker(port, route, requests, cookies, payloads, seed):
+    """Issue `requests` requests over one keep-alive connection; returns (latencies, errors)"""
+    import http.client
+
+    method, url = ROUTES[route]
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    latencies = []
+    errors = 0
+    for index in range(requests):
+        headers = {'Cookie': f'session={rng.choice(cookies)}'}
+        body = None
+        if method == 'POST':
+            body = payloads[index % len(payloads)]
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            ok = _ok(response.status, data, route)
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            ok = False
+        latencies.append(time.perf_counter() - start)
+        errors += not ok
+    connection.close()
+    return latencies, errors
+
+
+def _run_http(port, route, requests, warmup, workers, cookies, payloads, seed):
+    # Spawned, not forked: the parent may already run the app's background threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # Warm up the server and start every worker process before timing
+        list(pool.map(_http_worker, *zip(*[(port, route, max(warmup // workers, 1), cookies, payloads, seed + i)
+                                            for i in range(workers)])))
+        share = [requests // workers + (i < requests % workers) for i in range(workers)]
+        start = time.perf_counter()
+        outcomes = list(pool.map(_http_worker, *zip(*[(port, route, share[i], cookies, payloads, seed + 100 + i)
+                                                      for i in range(workers)])))
+        seconds = time.perf_counter() - start
+    latencies = [latency for worker_latencies, _ in outcomes for latency in worker_latencies]
+    return latencies, sum(errors for _, errors in outcomes), seconds
+
+
+def _metadata(path, **settings):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    conn = sqlite3.connect(path)
+    try:
+        users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        results = conn.execute('SELECT COUNT(*) FROM typing_results').fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'users': users,
+        'results': results,
+        **settings,
+    }
+
+
+def run(path, modes=MODES, routes=tuple(ROUTES), requests=1000, warmup=100, workers=4,
+        active_users=1000, seed=0, progress=None):
+    """Benchmark the routes against a seeded database; returns {'meta', 'results'}"""
+    report = progress or (lambda message: None)
+    rng = random.Random(seed)
+    user_ids = _sample_users(path, active_users, seed)
+    texts = corpus.get_corpus()
+    payloads = _payloads(rng, texts, min(requests + warmup, 2000))
+    meta = _metadata(path, requests=requests, warmup=warmup, workers=workers, active_users=len(user_ids), seed=seed)
+    results = []
+
+    if 'test-client' in modes:
+        os.environ['DB_PATH'] = path
+        os.environ.setdefault('TTS_PRERENDER', '0')
+        db_pool.configure(path)
+        install_stubs()
+        import app
+        import ratelimit
+
+        ratelimit.set_enabled(False)
+        cookies = _session_cookies(app.app, user_ids)
+        for route in routes:
+            latencies, errors, seconds = _run_test_client(app.app, route, requests, warmup, cookies, payloads, rng)
+            results.append(_summary(route, 'test-client', latencies, errors, seconds, 1))
+            report(_format(results[-1]))
+
+    if 'http' in modes:
+        from flask import Flask
+
+        # Sign cookies with the same secret as the server process
+        signer = Flask(__name__)
+        signer.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
+        cookies = _session_cookies(signer, user_ids)
+        server, port = _start_server(path)
+        try:
+            for route in routes:
+                latencies, errors, seconds = _run_http(port, route, requests, warmup, workers, cookies, payloads, seed)
+                results.append(_summary(route, 'http', latencies, errors, seconds, workers))
+                report(_format(results[-1]))
+        finally:
+            server.terminate()
+            server.wait(10)
+    return {'meta': meta, 'results': results}
+
+
+def _format(result):
+    return (f"{result['mode']:<11} {result['route']:<17} {result['throughput']:>9.1f} req/s  "
+            f"p50 {result['p50_ms']:>8.2f} ms  p90 {result['p90_ms']:>8.2f} ms  "
+            f"p99 {result['p99_ms']:>8.2f} ms  errors {result['errors']}")
+
+
+def compare(previous, current, threshold=REGRESSION_THRESHOLD):
+    """List (route, mode, description) regressions of `current` against `previous`"""
+    before = {(result['route'], result['mode']): result for result in previous['results']}
+    regressions = []
+    for result in current['results']:
+        old = before.get((result['route'], result['mode']))
+        if old is None:
+            continue
+        if old['throughput'] and result['throughput'] < old['throughput'] * (1 - threshold):
+            regressions.append((result['route'], result['mode'],
+                                f"throughput {old['throughput']} -> {result['throughput']} req/s"))
+        if old['p99_ms'] and result['p99_ms'] > old['p99_ms'] * (1 + threshold):
+            regressions.append((result['route'], result['mode'],
+                                f"p99 {old['p99_ms']} -> {result['p99_ms']} ms"))
+        if result['errors'] > old['errors']:
+            regressions.append((result['route'], result['mode'], f"errors {old['errors']} -> {result['errors']}"))
+    return regressions
+
+
+async def _racer(session, url, user, room, keys_per_second, rng, stats, joined=None):
+    """One simulated racer: joins, types at about keys_per_second and submits at the end"""
+    import races
+
+    token = races.make_token(user[0], user[1])
+    params = {'token': token, 'room': room} if room else {'token': token}
+    started = time.perf_counter()
+    try:
+        ws = await session.ws_connect(url, params=params, max_msg_size=0)
+    except Exception:
+        stats['errors'] += 1
+        if joined is not None and not joined.done():
+            joined.set_result(None)
+        return
+    stats['connect_ms'].append((time.perf_counter() - started) * 1000)
+    sent = deque()
+    typist = None
+
+    async def type_passage(passage):
+        text = passage['text']
+        intervals = []
+        last = time.perf_counter()
+        for typed in range(1, len(text) + 1):
+            await asyncio.sleep(rng.uniform(0.5, 1.5) / keys_per_second)
+            now = time.perf_counter()
+            intervals.append(max(round((now - last) * 1000), 1))
+            last = now
+            sent.append((typed, now))
+            await ws.send_str(json.dumps({'type': 'progress', 'typed': typed}))
+        result = {'text_id': passage['id'], 'keys': text, 'intervals': intervals, 'duration': 0}
+        await ws.send_str(json.dumps({'type': 'finish', 'result': result}))
+
+    passage = None
+    try:
+        async for message in ws:
+            data = json.loads(message.data)
+            kind = data.get('type')
+            if kind == 'joined':
+                passage = data['passage']
+                if joined is not None:
+                    joined.set_result(data['room'])
+            elif kind == 'start':
+                typist = asyncio.ensure_future(type_passage(passage))
+            elif kind == 'state':
+                stats['states'] += 1
+                progress = next((p['progress'] for p in data['players'] if p['id'] == user[0]), 0)
+                now = time.perf_counter()
+                # How long a keystroke took to show up in a broadcast
+                while sent and sent[0][0] <= progress:
+                    stats['echo_ms'].append((now - sent.popleft()[1]) * 1000)
+            elif kind == 'result':
+                stats['saved' if data.get('success') else 'rejected'] += 1
+            elif kind == 'finished':
+                stats['finished'] += 1
+                break
+            elif kind == 'error':
+                stats['errors'] += 1
+                break
+    except Exception:
+        stats['errors'] += 1
+    finally:
+        if typist is not None:
+            typist.cancel()
+        if joined is not None and not joined.done():
+            joined.set_result(None)
+        await ws.close()
+
+
+async def _race_room(session, url, group, keys_per_second, rng, stats):
+    # The first racer opens a private room; the rest join it by code
+    joined = asyncio.get_running_loop().create_future()
+    host = asyncio.ensure_future(_racer(session, url, group[0], 'new', keys_per_second, rng, stats, joined))
+    code = await joined
+    if code is None:
+        await host
+        return
+    await asyncio.gather(host, *(_racer(session, url, user, code, keys_per_second, rng, stats)
+                                 for user in group[1:]))
+
+
+def _race_worker(port, groups, keys_per_second, seed, timeout):
+    """Run the racers of several rooms in one process; returns their stats"""
+    import aiohttp
+    import races
+
+    races.raise_file_limit()
+    stats = {'connect_ms': [], 'echo_ms': [], 'states': 0, 'finished': 0, 'saved': 0, 'rejected': 0, 'errors': 0}
+
+    async def main():
+        rng = random.Random(seed)
+        url = f'http://127.0.0.1:{port}/race/ws'
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            await asyncio.wait_for(asyncio.gather(*(_race_room(session, url, group, keys_per_second, rng, stats)
+                                                    for group in groups)), timeout)
+
+    try:
+        asyncio.run(main())
+    except asyncio.TimeoutError:
+        stats['errors'] += 1
+    return stats
+
+
+def race_load(path, rooms=1000, players=4, keys_per_second=6, duration=15, countdown_ms=10000,
+              workers=4, timeout=300, seed=0, progress=None):
+    """Drive rooms * players simulated racers against a race server on a seeded database.
+
+    The server (races.py) runs in its own process with the fakes installed,
+    the racers in `workers` client processes. Every racer is a seeded user
+    and its result goes through the regular save path, so the database
+    changes. Returns a summary with the server's own counters.
+    """
+    import http.client
+
+    report = progress or (lambda message: None)
+    conn = sqlite3.connect(path)
+    try:
+        users = conn.execute('SELECT id, name FROM users ORDER BY id LIMIT ?', (rooms * players,)).fetchall()
+    finally:
+        conn.close()
+    if len(users) < rooms * players:
+        raise ValueError(f"{rooms * players} racers need as many users; {path} has {len(users)}")
+    groups = [users[index * players:(index + 1) * players] for index in range(rooms)]
+    meta = _metadata(path, rooms=rooms, players=players, keys_per_second=keys_per_second,
+                     duration=duration, workers=workers, seed=seed)
+
+    env = {'RACE_DURATION_S': str(duration), 'RACE_COUNTDOWN_MS': str(countdown_ms),
+           'RACE_MIN_PLAYERS': str(players), 'RACE_MAX_PLAYERS': str(players)}
+    server, port = _start_server(path, target='serve_races', env=env)
+    try:
+        report(f"Race server on port {port}; starting {rooms * players} racers in {rooms} rooms")
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            outcomes = list(pool.map(_race_worker, *zip(*[(port, groups[i::workers], keys_per_second, seed + i, timeout)
+                                                          for i in range(workers)])))
+        seconds = time.perf_counter() - start
+
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        connection.request('GET', '/race/stats')
+        server_stats = json.loads(connection.getresponse().read())
+        connection.close()
+    finally:
+        server.terminate()
+        server.wait(10)
+
+    connect = sorted(ms for stats in outcomes for ms in stats['connect_ms'])
+    echo = sorted(ms for stats in outcomes for ms in stats['echo_ms'])
+    totals = {key: sum(stats[key] for stats in outcomes) for key in ('states', 'finished', 'saved', 'rejected', 'errors')}
+    return {
+        'meta': meta,
+        'seconds': round(seconds, 2),
+        'racers': rooms * players,
+        **totals,
+        'connect_p99_ms': round(_percentile(connect, 0.99), 2),
+        'echo_p50_ms': round(_percentile(echo, 0.50), 2),
+        'echo_p99_ms': round(_percentile(echo, 0.99), 2),
+        'server': server_stats,
+    }
@@ -0,0 +1,223 @@
+"""Read-through cache for database lookups.
+
+Cached entries are tagged (e.g. "user:42", "leaderboard"). Writers call
+invalidate() with the tags they touched; every tag has a version counter
+stored in the backend, and an entry is only served while the versions it
+was stored with are still current. Bumping a counter is all it takes to
+invalidate, which works the same for the in-process backend and for a
+shared one used by several gunicorn workers.
+
+The default backend is an in-process LRU with TTL. A shared backend only
+has to implement CacheBackend (get/set/delete/get_counter/incr/clear) and be installed
+with set_backend().
+"""
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+DEFAULT_TTL = float(os.environ.get('CACHE_TTL', 60))
+# Stands for every tag in shared (database-side) versions; bumped by rebuilds
+ALL_TAGS = '*'
+MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+
+MISSING = object()
+
+_PROCESS_EPOCH = secrets.token_hex(8)
+
+
+class CacheBackend:
+    """Storage interface for the cache.
+
+    Keys are strings and values must be picklable if the backend is shared
+    between processes. get() returns MISSING for absent or expired keys.
+    Counters (tag versions) must never be evicted, otherwise an old entry
+    could match a counter that restarted from zero.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def get_counter(self, key):
+        """Return an integer counter, 0 if it was never incremented"""
+        raise NotImplementedError
+
+    def incr(self, key):
+        """Atomically increment an integer counter and return the new value"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def epoch(self):
+        """Token that changes whenever the counters may have restarted from zero.
+
+        HTTP ETags are built from tag versions (httpcache.py), so they must
+        not repeat across such a restart. The default is per process; a
+        shared backend should return a value stored with its counters.
+        """
+        return _PROCESS_EPOCH
+
+
+class MemoryCache(CacheBackend):
+    """Thread-safe in-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is MISSING:
+                return MISSING
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters.get(key, 0) + 1
+            self._counters[key] = value
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_backend = MemoryCache()
+_counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_counters_lock = threading.Lock()
+_enabled = os.environ.get('CACHE_ENABLED', '1') != '0'
+
+
+def set_backend(backend):
+    """Install a different cache backend (e.g. one shared across workers)"""
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    """Return the active cache backend"""
+    return _backend
+
+
+def set_enabled(enabled):
+    """Turn caching on or off (e.g. for benchmarks of the raw queries)"""
+    global _enabled
+    _enabled = enabled
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def _tag_version(tag):
+    return _backend.get_counter('tag:' + tag)
+
+
+def invalidate(*tags):
+    """Invalidate every cached entry carrying any of the given tags"""
+    for tag in tags:
+        _backend.incr('tag:' + tag)
+        _count('invalidations')
+
+
+def tag_versions(*tags):
+    """Current version of each tag; changes whenever a tagged entry is invalidated"""
+    return tuple(_tag_version(tag) for tag in tags)
+
+
+def epoch():
+    """The backend's epoch (see CacheBackend.epoch)"""
+    return _backend.epoch()
+
+
+def clear():
+    """Drop every cached entry"""
+    _backend.clear()
+    _count('invalidations')
+
+
+def stats():
+    """Return hit/miss/invalidation counters for monitoring"""
+    with _counters_lock:
+        result = dict(_counters)
+    lookups = result['hits'] + result['misses']
+    result['hit_ratio'] = result['hits'] / lookups if lookups else 0.0
+    if isinstance(_backend, MemoryCache):
+        result['entries'] = len(_backend)
+        result['evictions'] = _backend.evictions
+        result['expirations'] = _backend.expirations
+    return result
+
+
+def cached(namespace, tags, ttl=DEFAULT_TTL):
+    """Cache a function's return value, keyed on its arguments.
+
+    `tags(*args, **kwargs)` returns the tags the entry depends on.
+    The undecorated function stays available as `func.uncached`. Cached
+    values are shared between callers, so they must not be mutated.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            key = f"{namespace}:{args!r}:{sorted(kwargs.items())!r}"
+            entry = _backend.get(key)
+            if entry is not MISSING:
+                value, versions = entry
+                if all(_tag_version(tag) == version for tag, version in versions):
+                    _count('hits')
+                    return value
+            _count('misses')
+
+            # Read the tag versions before querying: a write that lands
+            # mid-query bumps them and the stored entry is never served.
+            versions = tuple((tag, _tag_version(tag)) for tag in tags(*args, **kwargs))
+            value = func(*args, **kwargs)
+            _backend.set(key, (value, versions), ttl)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+    return decorator
@@ -0,0 +1,285 @@
+"""Typing passages, loaded once and indexed for constant-time selection.
+
+Passages live in text files under TYPING_CORPUS_DIR, one per line (blank
+lines and lines starting with "#" are skipped; an optional "<weight><TAB>"
+prefix changes how often a passage is picked). They are loaded on first
+use into one string plus an offsets array, with a few bytes of metadata
+per passage: a length bucket, a difficulty tier and feature flags
+(punctuation, numbers, capitals, symbols).
+
+Every combination of (length, difficulty, focus), including "any" for
+each, is precomputed into an index of passage ids with a cumulative
+weight array, so a query is a dict lookup plus a bisect, whatever the size
+of the corpus. Recently served passages are remembered per user and
+re-drawn a few times to avoid immediate repeats.
+
+A passage's id is derived from a hash of its (whitespace-normalized)
+text, so it stays the same when passages are added, removed or reordered,
+and typing logs stored under an id keep pointing at the text they were
+typed from. Editing a passage gives it a new id.
+"""
+import bisect
+import hashlib
+import os
+import random
+import threading
+from array import array
+from collections import OrderedDict, deque
+
+CORPUS_DIR = os.environ.get('TYPING_CORPUS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'texts'))
+RECENT_PER_USER = int(os.environ.get('TYPING_RECENT_PER_USER', 20))
+RECENT_USERS = int(os.environ.get('TYPING_RECENT_USERS', 10000))
+# Re-draws before accepting a passage the user saw recently
+MAX_DRAWS = 8
+# Roughly 40 WPM, used to turn a test duration into a passage length
+CHARS_PER_SECOND = 3.5
+
+LENGTHS = ('short', 'medium', 'long')
+# Upper bound (exclusive, in characters) of each length bucket but the last
+LENGTH_LIMITS = (100, 250)
+DIFFICULTIES = ('easy', 'medium', 'hard')
+FOCUSES = {'punctuation': 1, 'numbers': 2, 'capitals': 4, 'symbols': 8}
+
+SYMBOL_CHARS = set('#$%&*+/<=>@\\^_`{|}~[]')
+PUNCTUATION_CHARS = set('.,;:!?\'"()-')
+
+
+def passage_id(text):
+    """Stable id of a passage: the first 48 bits of the SHA-256 of its normalized text"""
+    # 48 bits stay exact as JSON numbers in the browser
+    digest = hashlib.sha256(' '.join(text.split()).encode()).digest()
+    return int.from_bytes(digest[:6], 'big')
+
+
+def _length_bucket(size):
+    return bisect.bisect_right(LENGTH_LIMITS, size)
+
+
+def _features(text):
+    """Return (feature flags, difficulty score) for a passage"""
+    size = len(text)
+    letters = sum(1 for ch in text if ch.isalpha())
+    upper = sum(1 for ch in text if ch.isupper())
+    digits = sum(1 for ch in text if ch.isdigit())
+    symbols = sum(1 for ch in text if ch in SYMBOL_CHARS)
+    punctuation = sum(1 for ch in text if ch in PUNCTUATION_CHARS)
+    words = text.split()
+
+    flags = 0
+    if punctuation / size >= 0.04:
+        flags |= FOCUSES['punctuation']
+    if digits >= 3:
+        flags |= FOCUSES['numbers']
+    if letters and upper / letters >= 0.05:
+        flags |= FOCUSES['capitals']
+    if symbols >= 2:
+        flags |= FOCUSES['symbols']
+
+    average_word = sum(len(word) for word in words) / max(len(words), 1)
+    score = (average_word + 20 * punctuation / size + 25 * digits / size
+             + 30 * symbols / size + 10 * upper / max(letters, 1))
+    return flags, score
+
+
+class Corpus:
+    """Compact passage store with precomputed selection indexes"""
+
+    def __init__(self, passages):
+        """`passages` is an iterable of text or (text, weight) items"""
+        parts = []
+        weights = array('d')
+        # Passages are stored by position; _ids maps a position to its id
+        self._ids = array('Q')
+        self._positions = {}
+        self._offsets = array('L', [0])
+        self._length = array('B')
+        self._flags = array('B')
+        scores = array('d')
+
+        position = 0
+        for item in passages:
+            text, weight = (item, 1.0) if isinstance(item, str) else item
+            text = ' '.join(text.split())
+            if not text or weight <= 0:
+                continue
+            text_id = passage_id(text)
+            if text_id in self._positions:
+                # The same passage twice: pick it as if it had both weights
+                weights[self._positions[text_id]] += weight
+                continue
+            self._positions[text_id] = len(self._ids)
+            self._ids.append(text_id)
+            flags, score = _features(text)
+            parts.append(text)
+            position += len(text)
+            self._offsets.append(position)
+            self._length.append(_length_bucket(len(text)))
+            self._flags.append(flags)
+            scores.append(score)
+            weights.append(weight)
+        self._text = ''.join(parts)
+
+        # Difficulty tiers are corpus tertiles, so every tier is populated
+        order = sorted(range(len(scores)), key=scores.__getitem__)
+        self._difficulty = array('B', bytes(len(scores)))
+        for rank, position in enumerate(order):
+            self._difficulty[position] = rank * len(DIFFICULTIES) // len(order)
+
+        self._indexes = self._build_indexes(weights)
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _build_indexes(self, weights):
+        buckets = {}
+        for position in range(len(self)):
+            length = self._length[position]
+            difficulty = self._difficulty[position]
+            flags = self._flags[position]
+            focuses = [0] + [bit for bit in FOCUSES.values() if flags & bit]
+            for length_key in (length, None):
+                for difficulty_key in (difficulty, None):
+                    for focus in focuses:
+                        key = (length_key, difficulty_key, focus)
+                        if key not in buckets:
+                            buckets[key] = (array('L'), array('d'))
+                        positions, cumulative = buckets[key]
+                        positions.append(position)
+                        cumulative.append((cumulative[-1] if cumulative else 0.0) + weights[position])
+        return buckets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def ids(self):
+        """Ids of every passage, in load order"""
+        return list(self._ids)
+
+    def _text_at(self, position):
+        return self._text[self._offsets[position]:self._offsets[position + 1]]
+
+    def text(self, passage_id):
+        """Return the text of a passage, or None for an unknown id"""
+        position = self._positions.get(passage_id)
+        return self._text_at(position) if position is not None else None
+
+    def _get_at(self, position):
+        flags = self._flags[position]
+        return {
+            'id': self._ids[position],
+            'text': self._text_at(position),
+            'length': LENGTHS[self._length[position]],
+            'difficulty': DIFFICULTIES[self._difficulty[position]],
+            'focus': [name for name, bit in FOCUSES.items() if flags & bit],
+        }
+
+    def get(self, passage_id):
+        """Return a passage as a dict, or None for an unknown id"""
+        position = self._positions.get(passage_id)
+        return self._get_at(position) if position is not None else None
+
+    def _index_for(self, length, difficulty, focus):
+        """Find the closest populated index, relaxing length, then difficulty, then focus"""
+        if length is None:
+            candidates = [None]
+        else:
+            candidates = sorted(range(len(LENGTHS)), key=lambda bucket: abs(bucket - length))
+        for focus_key in (focus, 0):
+            for difficulty_key in (difficulty, None):
+                for length_key in candidates:
+                    index = self._indexes.get((length_key, difficulty_key, focus_key))
+                    if index is not None:
+                        return index
+        return self._indexes.get((None, None, 0))
+
+    def _remember(self, user_key, position):
+        recent = self._recent.get(user_key)
+        if recent is None:
+            recent = self._recent[user_key] = deque(maxlen=RECENT_PER_USER)
+        self._recent.move_to_end(user_key)
+        recent.append(position)
+        while len(self._recent) > RECENT_USERS:
+            self._recent.popitem(last=False)
+
+    def choose(self, duration=None, difficulty=None, focus=None, user_key=None):
+        """Pick a passage for a test.
+
+        `duration` (seconds) selects the length bucket, `difficulty` is one of
+        DIFFICULTIES and `focus` one of FOCUSES; unknown values mean "any".
+        When no passage matches every filter, the filters are relaxed.
+        Returns a dict from get(), or None if the corpus is empty.
+        """
+        length = None
+        if duration:
+            length = _length_bucket(duration * CHARS_PER_SECOND)
+        difficulty = DIFFICULTIES.index(difficulty) if difficulty in DIFFICULTIES else None
+        index = self._index_for(length, difficulty, FOCUSES.get(focus, 0))
+        if index is None:
+            return None
+
+        positions, cumulative = index
+        with self._lock:
+            recent = self._recent.get(user_key, ()) if user_key is not None else ()
+            for _ in range(MAX_DRAWS):
+                drawn = bisect.bisect_right(cumulative, random.random() * cumulative[-1])
+                position = positions[min(drawn, len(positions) - 1)]
+                if position not in recent:
+                    break
+            if user_key is not None:
+                self._remember(user_key, position)
+        return self._get_at(position)
+
+    def stats(self):
+        """Return passage counts per length, difficulty and focus"""
+        def count(key):
+            return len(self._indexes.get(key, ((), None))[0])
+
+        return {
+            'passages': len(self),
+            'characters': len(self._text),
+            'length': {name: count((i, None, 0)) for i, name in enumerate(LENGTHS)},
+            'difficulty': {name: count((None, i, 0)) for i, name in enumerate(DIFFICULTIES)},
+            'focus': {name: count((None, None, bit)) for name, bit in FOCUSES.items()},
+        }
+
+
+def read_passages(directory=CORPUS_DIR):
+    """Yield (text, weight) for every passage in the corpus files"""
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.txt'))
+    except OSError as e:
+        print(f"Error reading typing corpus: {e}")
+        return
+    for name in names:
+        with open(os.path.join(directory, name), encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                weight = 1.0
+                prefix, tab, rest = line.partition('\t')
+                if tab:
+                    try:
+                        weight, line = float(prefix), rest
+                    except ValueError:
+                        pass
+                yield line, weight
+
+
+_corpus = None
+_corpus_lock = threading.Lock()
+
+
+def get_corpus():
+    """Return the process-wide corpus, loading it on first use"""
+    global _corpus
+    with _corpus_lock:
+        if _corpus is None:
+            _corpus = Corpus(read_passages())
+        return _corpus
+
+
+def set_corpus(corpus):
+    """Replace the process-wide corpus (e.g. after reloading the files)"""
+    global _corpus
+    with _corpus_lock:
+        _corpus = corpus
@@ -1,121 +1,487 @@
 import sqlite3
-import os
-import hashlib
-from datetime import datetime, date
-from PIL import Image, ImageDraw, ImageFont
-import anybadge
-
-# Determine database path based on OS
-if os.name == 'nt':  # Windows
-    DB_PATH = 'web.db'
-else:  # POSIX (Linux, macOS, Vercel)
-    DB_PATH = '/tmp/web.db'
+import json
+import passwords
+import math
+from functools import lru_cache
+from datetime import datetime, date, timedelta, timezone
+from itertools import chain, groupby
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import badges as badge_assets
+import keystrokes as keystroke_logs
+import archive
+from db_pool import get_connection, transaction
+from migrations import migrate
+import cache
+import metrics
+from cache import cached
 
 def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get this thread's pooled database connection (do not close it)"""
+    return get_connection()
+
+# Milestones checked after every submitted result
+STREAK_MILESTONES = (5, 10, 15, 30, 50, 100)
+WPM_MILESTONES = (
+    (100, "Lightning Fingers"),
+    (80, "Speed Demon"),
+    (60, "Fast Typer"),
+    (40, "Speed Boost"),
+)
 
 def init_db():
-    """Initialize database with required tables"""
+    """Initialize database with required tables, applying pending migrations"""
+    migrate()
+
+def _touch(conn, *tags):
+    """Bump the shared versions of cache tags inside the writer's transaction.
+
+    cache.invalidate() only reaches this process; page ETags are built from
+    these rows instead, so they change whichever process wrote.
+    """
+    conn.executemany('''
+        INSERT INTO data_versions (tag, version) VALUES (?, 1)
+        ON CONFLICT (tag) DO UPDATE SET version = version + 1
+    ''', [(tag,) for tag in tags])
+
+def get_data_versions(tags):
+    """Shared version of each tag (0 if it was never written); never cached"""
     conn = get_db_connection()
-    
-    # Users table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT,
-            google_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            current_streak INTEGER DEFAULT 0,
-            longest_streak INTEGER DEFAULT 0,
-            last_test_date DATE,
-            total_tests INTEGER DEFAULT 0,
-            verified BOOLEAN DEFAULT 0
-        )
-    ''')
-    
-    # Typing results table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS typing_results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            wpm REAL NOT NULL,
-            accuracy REAL NOT NULL,
-            test_duration INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Badges table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS badges (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            badge_type TEXT NOT NULL,
-            title TEXT NOT NULL,
-            description TEXT,
-            image_path TEXT,
-            earned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    versions = dict(conn.execute(
+        'SELECT tag, version FROM data_versions WHERE tag IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(tags)),)
+    ).fetchall())
+    return tuple(versions.get(tag, 0) for tag in tags)
 
 def create_user(name, email, password, google_id=None):
     """Create a new user"""
-    conn = get_db_connection()
+    hashed_password = passwords.hash_password(password) if password else None
     try:
-        hashed_password = hashlib.sha256(password.encode()).hexdigest() if password else None
-        cursor = conn.execute(
-            'INSERT INTO users (name, email, password, google_id) VALUES (?, ?, ?, ?)',
-            (name, email, hashed_password, google_id)
-        )
-        user_id = cursor.lastrowid
-        conn.commit()
-        return user_id
+        with transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO users (name, email, password, google_id) VALUES (?, ?, ?, ?)',
+                (name, email, hashed_password, google_id)
+            )
+            _touch(conn, 'leaderboard')
     except sqlite3.IntegrityError:
         return None
-    finally:
-        conn.close()
+    cache.invalidate(f'email:{email}', 'leaderboard')
+    return cursor.lastrowid
 
 def get_user_by_email(email):
     """Get user by email"""
+    user_id = _get_user_id_by_email(email)
+    return get_user_by_id(user_id) if user_id is not None else None
+
+def update_password_hash(user_id, password_hash):
+    """Replace a user's stored password hash (e.g. after a KDF upgrade)"""
+    with transaction() as conn:
+        conn.execute('UPDATE users SET password = ? WHERE id = ?', (password_hash, user_id))
+        _touch(conn, f'user:{user_id}')
+    cache.invalidate(f'user:{user_id}')
+
+# An email always maps to the same id, so only "no such user" ever needs
+# invalidating (by create_user); the row itself is cached by id.
+@cached('user_id_by_email', tags=lambda email: [f'email:{email}'])
+def _get_user_id_by_email(email):
+    """Get the id of the user with this email, or None"""
     conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-    conn.close()
-    return dict(user) if user else None
+    row = conn.execute('SELECT id FROM users WHERE email = ?', (email,)).fetchone()
+    return row['id'] if row else None
 
+@cached('user_by_id', tags=lambda user_id: [f'user:{user_id}'])
 def get_user_by_id(user_id):
     """Get user by ID"""
     conn = get_db_connection()
     user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
     return dict(user) if user else None
 
-def save_typing_result(user_id, wpm, accuracy, test_duration):
-    """Save typing test result"""
-    conn = get_db_connection()
-    conn.execute(
+# Fold (count, wpm sum, wpm squares, wpm max, accuracy sum, accuracy squares,
+# accuracy max) for one user into their running aggregates
+_ADD_TO_AGGREGATES = '''
+    INSERT INTO user_aggregates
+        (user_id, result_count, wpm_sum, wpm_sq_sum, wpm_max, accuracy_sum, accuracy_sq_sum, accuracy_max)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        result_count = result_count + excluded.result_count,
+        wpm_sum = wpm_sum + excluded.wpm_sum,
+        wpm_sq_sum = wpm_sq_sum + excluded.wpm_sq_sum,
+        wpm_max = MAX(wpm_max, excluded.wpm_max),
+        accuracy_sum = accuracy_sum + excluded.accuracy_sum,
+        accuracy_sq_sum = accuracy_sq_sum + excluded.accuracy_sq_sum,
+        accuracy_max = MAX(accuracy_max, excluded.accuracy_max)
+'''
+
+# Copy one user's aggregates into the materialized leaderboard
+_REFRESH_LEADERBOARD_ENTRY = '''
+    INSERT INTO leaderboard_entries (user_id, best_wpm, avg_accuracy, avg_wpm)
+    SELECT user_id, wpm_max, accuracy_sum / result_count, wpm_sum / result_count
+    FROM user_aggregates
+    WHERE user_id = ?
+    ON CONFLICT (user_id) DO UPDATE SET
+        best_wpm = excluded.best_wpm,
+        avg_accuracy = excluded.avg_accuracy,
+        avg_wpm = excluded.avg_wpm
+'''
+
+# Fold (count, wpm sum, wpm max, accuracy sum) into one progress bucket
+_ADD_TO_ROLLUP = '''
+    INSERT INTO progress_rollups (user_id, period, bucket, result_count, wpm_sum, wpm_max, accuracy_sum)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, period, bucket) DO UPDATE SET
+        result_count = result_count + excluded.result_count,
+        wpm_sum = wpm_sum + excluded.wpm_sum,
+        wpm_max = MAX(wpm_max, excluded.wpm_max),
+        accuracy_sum = accuracy_sum + excluded.accuracy_sum
+'''
+
+PROGRESS_PERIODS = ('day', 'week', 'month')
+
+@lru_cache(maxsize=4096)
+def _rollup_buckets(day):
+    """(period, bucket start) pairs a test taken on ISO date `day` counts towards"""
+    day = date.fromisoformat(day)
+    return (
+        ('day', day.isoformat()),
+        ('week', (day - timedelta(days=day.weekday())).isoformat()),
+        ('month', day.replace(day=1).isoformat()),
+    )
+
+def _insert_result(conn, user_id, wpm, accuracy, test_duration, day):
+    """Insert a result row and fold it into the user's running aggregates and their local `day`'s progress buckets"""
+    cursor = conn.execute(
         'INSERT INTO typing_results (user_id, wpm, accuracy, test_duration) VALUES (?, ?, ?, ?)',
         (user_id, wpm, accuracy, test_duration)
     )
-    
-    # Update total tests count
+    conn.execute(_ADD_TO_AGGREGATES, (user_id, 1, wpm, wpm * wpm, wpm, accuracy, accuracy * accuracy, accuracy))
+    conn.execute(_REFRESH_LEADERBOARD_ENTRY, (user_id,))
+    conn.executemany(_ADD_TO_ROLLUP, [(user_id, period, bucket, 1, wpm, wpm, accuracy)
+                                      for period, bucket in _rollup_buckets(day)])
+    return cursor.lastrowid
+
+def _insert_keystrokes(conn, user_id, result_id, text_id, keys, intervals, text):
+    """Store a result's keystroke blob and fold it into the per-key counters"""
+    # A text without a passage id (a generated practice text) is stored in
+    # the blob, so the log can still be replayed
     conn.execute(
-        'UPDATE users SET total_tests = total_tests + 1 WHERE id = ?',
-        (user_id,)
+        'INSERT INTO typing_keystrokes (result_id, text_id, data) VALUES (?, ?, ?)',
+        (result_id, text_id, keystroke_logs.encode(keys, intervals, text, embed_text=text_id is None))
     )
+    _add_key_stats(conn, user_id, keys, intervals, text)
+
+def _add_key_stats(conn, user_id, keys, intervals, text):
+    """Fold one keystroke log into the user's key and bigram counters"""
+    key_stats, bigram_stats = keystroke_logs.analyze(keys, intervals, text)
+    conn.executemany('''
+        INSERT INTO user_key_stats (user_id, key, attempts, errors, timed, total_ms)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, key) DO UPDATE SET
+            attempts = attempts + excluded.attempts,
+            errors = errors + excluded.errors,
+            timed = timed + excluded.timed,
+            total_ms = total_ms + excluded.total_ms
+    ''', [(user_id, key, *stats) for key, stats in key_stats.items()])
+    conn.executemany('''
+        INSERT INTO user_bigram_stats (user_id, bigram, count, total_ms)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, bigram) DO UPDATE SET
+            count = count + excluded.count,
+            total_ms = total_ms + excluded.total_ms
+    ''', [(user_id, bigram, *stats) for bigram, stats in bigram_stats.items()])
+
+def get_keystrokes(result_id):
+    """Get a result's decoded keystroke log, or None if it has none"""
+    conn = get_db_connection()
+    row = conn.execute('SELECT data FROM typing_keystrokes WHERE result_id = ?', (result_id,)).fetchone()
+    return keystroke_logs.decode(row['data']) if row else None
+
+# The streak after a test on :today, from the row's values before the update
+_STREAK_AFTER_TEST = '''
+    CASE
+        WHEN last_test_date >= :today THEN MAX(current_streak, 1)
+        WHEN last_test_date = :yesterday THEN current_streak + 1
+        ELSE 1
+    END
+'''
+
+# Count a test against the user row and advance its streak in one statement,
+# so concurrent submits cannot read a stale streak and overwrite each other
+_ADVANCE_USER = f'''
+    UPDATE users
+    SET total_tests = total_tests + 1,
+        best_wpm = MAX(COALESCE(best_wpm, 0), :wpm),
+        current_streak = {_STREAK_AFTER_TEST},
+        longest_streak = MAX(longest_streak, {_STREAK_AFTER_TEST}),
+        last_test_date = MAX(COALESCE(last_test_date, :today), :today)
+    WHERE id = :user_id
+    RETURNING current_streak, best_wpm
+'''
+
+def record_typing_result(user_id, wpm, accuracy, test_duration, keystrokes=None):
+    """Save a result, update streak/totals and work out earned milestones.
+
+    The user row is updated by a single UPDATE ... RETURNING that computes
+    the new streak from the row itself, and the result insert and badges
+    share its write transaction, so the cost does not depend on how many
+    tests the user has taken. Days are counted in the user's timezone.
+    `keystrokes` is an optional (text_id, keys, intervals, text) log stored
+    with the result. Returns the user's current streak, best WPM and the
+    badges awarded, or None for an unknown user.
+    """
+    user = get_user_by_id(user_id)
+    if user is None:
+        return None
+    today = local_date(user.get('timezone'))
+    params = {
+        'user_id': user_id,
+        'wpm': wpm,
+        'today': today.isoformat(),
+        'yesterday': (today - timedelta(days=1)).isoformat(),
+    }
+    with transaction() as conn:
+        user = conn.execute(_ADVANCE_USER, params).fetchone()
+        if user is None:
+            return None
+        
+        result_id = _insert_result(conn, user_id, wpm, accuracy, test_duration, params['today'])
+        if keystrokes is not None:
+            _insert_keystrokes(conn, user_id, result_id, *keystrokes)
+        
+        milestones = []
+        # Streak badges are earned by the first test of the day only
+        if user['current_streak'] in STREAK_MILESTONES and _tests_on(conn, user_id, params['today']) == 1:
+            milestones.append(_streak_milestone(user['current_streak']))
+        # best_wpm already includes this test, so it equals wpm for a new record
+        wpm_milestone = _wpm_milestone(wpm, user['best_wpm'])
+        if wpm_milestone:
+            milestones.append(wpm_milestone)
+        earned = _award(conn, user_id, milestones)
+        _touch(conn, f'user:{user_id}', 'leaderboard')
+    cache.invalidate(f'user:{user_id}', 'leaderboard')
     
-    conn.commit()
-    conn.close()
+    return {
+        'current_streak': user['current_streak'],
+        'best_wpm': user['best_wpm'],
+        'badges': earned
+    }
+
+def _tests_on(conn, user_id, day):
+    """How many tests a user has taken on ISO date `day`"""
+    row = conn.execute(
+        "SELECT result_count FROM progress_rollups WHERE user_id = ? AND period = 'day' AND bucket = ?",
+        (user_id, day)
+    ).fetchone()
+    return row['result_count'] if row else 0
+
+def _streak_milestone(streak):
+    return (f"{streak} Day Streak", f"Maintained {streak} day typing streak!", 'streak')
+
+def _wpm_milestone(wpm, previous_best):
+    """The badge for a new personal record, if it reaches a WPM milestone"""
+    if wpm >= previous_best:
+        for threshold, title in WPM_MILESTONES:
+            if wpm >= threshold:
+                # One badge per milestone, so every holder shares its image
+                return (title, f"Achieved {threshold} WPM!", 'wpm')
+    return None
+
+def _award(conn, user_id, milestones):
+    """Insert badges for (title, description, type) milestones"""
+    # Badges only reference shared images, so awarding them is just an insert
+    earned = []
+    for title, description, badge_type in milestones:
+        image = _insert_badge(conn, user_id, title, description)
+        earned.append({'title': title, 'description': description, 'type': badge_type, 'image': image})
+    return earned
+
+def to_utc_timestamp(value):
+    """Normalize an ISO 8601 timestamp to the UTC 'YYYY-MM-DD HH:MM:SS' form of created_at.
+
+    Timestamps without an offset are taken to be UTC already. Raises
+    ValueError for anything unparseable.
+    """
+    moment = datetime.fromisoformat(str(value))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    try:
+        moment = moment.astimezone(timezone.utc)
+    except OverflowError:
+        # e.g. 0001-01-01T00:00+01:00, which would fall before year 1
+        raise ValueError(f"Timestamp out of range: {value}")
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+@lru_cache(maxsize=1024)
+def _zone(name):
+    """ZoneInfo for an IANA timezone name, or None if it is unset or unknown"""
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError, OSError):
+        return None
+
+def is_valid_timezone(name):
+    """Check that `name` is an IANA timezone this server knows about"""
+    return isinstance(name, str) and len(name) <= 64 and _zone(name) is not None
+
+def local_date(timezone_name=None, moment=None):
+    """The date in a user's timezone now (or at aware datetime `moment`).
+
+    Users without a (known) timezone get the server's local date, which is
+    what streaks were always counted in.
+    """
+    moment = moment or datetime.now(timezone.utc)
+    return moment.astimezone(_zone(timezone_name)).date()
+
+def _local_day(timestamp, timezone_name=None):
+    """The date (as used for streaks) of a UTC timestamp string in a user's timezone"""
+    moment = datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc)
+    return local_date(timezone_name, moment).isoformat()
+
+def set_user_timezone(user_id, timezone_name):
+    """Store the IANA timezone a user's streak days are counted in"""
+    if not is_valid_timezone(timezone_name):
+        return False
+    try:
+        with transaction() as conn:
+            conn.execute('UPDATE users SET timezone = ? WHERE id = ?', (timezone_name, user_id))
+            _touch(conn, f'user:{user_id}')
+    except Exception as e:
+        print(f"Error setting user timezone: {e}")
+        return False
+    cache.invalidate(f'user:{user_id}')
+    return True
 
+def bulk_record_results(results):
+    """Save many results in one transaction (offline practice, imports).
+
+    `results` is an iterable of dicts with user_id, wpm, accuracy and
+    test_duration, plus optional taken_at (UTC 'YYYY-MM-DD HH:MM:SS', like
+    created_at; default now) and keystrokes (as for record_typing_result). Rows go in with
+    executemany, each user's aggregates and totals are updated once, their
+    streak is walked once over the batch's sorted test dates, progress
+    buckets are summed before being upserted, and milestones are checked once per user per batch. Results for unknown
+    users are skipped. Returns {user_id: {'current_streak', 'best_wpm',
+    'badges', 'saved'}}.
+    """
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    by_user = {}
+    for result in results:
+        by_user.setdefault(result['user_id'], []).append(result)
+    if not by_user:
+        return {}
+    
+    outcomes = {}
+    with transaction() as conn:
+        users = {}
+        user_ids = list(by_user)
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows = conn.execute(f'''
+                SELECT id, last_test_date, current_streak, best_wpm, timezone
+                FROM users WHERE id IN ({', '.join('?' * len(chunk))})
+            ''', chunk).fetchall()
+            users.update((row['id'], row) for row in rows)
+        
+        inserts = []
+        logs = []
+        aggregates = []
+        rollups = {}
+        user_updates = []
+        for user_id, items in by_user.items():
+            user = users.get(user_id)
+            if user is None:
+                continue
+            
+            count = 0
+            wpm_sum = wpm_sq_sum = wpm_max = accuracy_sum = accuracy_sq_sum = accuracy_max = 0
+            days = set()
+            for item in items:
+                wpm, accuracy = item['wpm'], item['accuracy']
+                taken_at = item.get('taken_at') or now
+                inserts.append((user_id, wpm, accuracy, item['test_duration'], taken_at))
+                logs.append(item.get('keystrokes'))
+                day = _local_day(taken_at, user['timezone'])
+                days.add(day)
+                for period, bucket in _rollup_buckets(day):
+                    rollup = rollups.get((user_id, period, bucket))
+                    if rollup is None:
+                        rollups[(user_id, period, bucket)] = [1, wpm, wpm, accuracy]
+                    else:
+                        rollup[0] += 1
+                        rollup[1] += wpm
+                        rollup[2] = max(rollup[2], wpm)
+                        rollup[3] += accuracy
+                count += 1
+                wpm_sum += wpm
+                wpm_sq_sum += wpm * wpm
+                wpm_max = max(wpm_max, wpm)
+                accuracy_sum += accuracy
+                accuracy_sq_sum += accuracy * accuracy
+                accuracy_max = max(accuracy_max, accuracy)
+            aggregates.append((user_id, count, wpm_sum, wpm_sq_sum, wpm_max, accuracy_sum, accuracy_sq_sum, accuracy_max))
+            
+            # Walk the streak forward over the new test days; days before the
+            # last known test day cannot change the current streak
+            last_day = user['last_test_date']
+            streak = user['current_streak'] or 0
+            longest = streak
+            milestones = []
+            for day in sorted(days):
+                if last_day and day <= last_day:
+                    continue
+                previous = streak
+                streak = _next_streak(last_day, streak, date.fromisoformat(day))
+                last_day = day
+                longest = max(longest, streak)
+                if streak != previous and streak in STREAK_MILESTONES:
+                    milestones.append(_streak_milestone(streak))
+            
+            previous_best = user['best_wpm'] or 0
+            wpm_milestone = _wpm_milestone(wpm_max, previous_best)
+            if wpm_milestone:
+                milestones.append(wpm_milestone)
+            
+            user_updates.append((count, max(previous_best, wpm_max), streak, longest, last_day, user_id))
+            outcomes[user_id] = {
+                'current_streak': streak,
+                'best_wpm': max(previous_best, wpm_max),
+                'milestones': milestones,
+                'saved': count
+            }
+        
+        if not inserts:
+            return {}
+        conn.executemany('''
+            INSERT INTO typing_results (user_id, wpm, accuracy, test_duration, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', inserts)
+        if any(logs):
+            # One executemany inside the write lock hands out consecutive ids
+            first_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0] - len(inserts) + 1
+            for offset, log in enumerate(logs):
+                if log is not None:
+                    _insert_keystrokes(conn, inserts[offset][0], first_id + offset, *log)
+        conn.executemany(_ADD_TO_AGGREGATES, aggregates)
+        conn.executemany(_REFRESH_LEADERBOARD_ENTRY, [(row[0],) for row in aggregates])
+        conn.executemany(_ADD_TO_ROLLUP, [(*key, *values) for key, values in rollups.items()])
+        conn.executemany('''
+            UPDATE users
+            SET total_tests = total_tests + ?,
+                best_wpm = ?,
+                current_streak = ?,
+                longest_streak = MAX(longest_streak, ?),
+                last_test_date = ?
+            WHERE id = ?
+        ''', user_updates)
+        
+        for user_id, outcome in outcomes.items():
+            outcome['badges'] = _award(conn, user_id, outcome.pop('milestones'))
+        _touch(conn, *[f'user:{user_id}' for user_id in outcomes], 'leaderboard')
+    cache.invalidate(*[f'user:{user_id}' for user_id in outcomes], 'leaderboard')
+    
+    return outcomes
+
+@cached('user_stats', tags=lambda user_id: [f'user:{user_id}'])
 def get_user_stats(user_id):
     """Get comprehensive user statistics"""
     conn = get_db_connection()
@@ -123,16 +489,17 @@ def get_user_stats(user_id):
     # Get user info
     user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
     
-    # Get typing stats
+    # Get typing stats from the running aggregates (one primary-key read)
     stats = conn.execute('''
         SELECT 
-            COUNT(*) as total_tests,
-            AVG(wpm) as avg_wpm,
-            MAX(wpm) as best_wpm,
-            AVG(accuracy) as avg_accuracy,
-            MAX(accuracy) as best_accuracy
-        FROM typing_results 
-        WHERE user_id = ?
+            result_count as total_tests,
+            wpm_sum / result_count as avg_wpm,
+            wpm_max as best_wpm,
+            accuracy_sum / result_count as avg_accuracy,
+            accuracy_max as best_accuracy,
+            wpm_sq_sum / result_count - (wpm_sum / result_count) * (wpm_sum / result_count) as wpm_variance
+        FROM user_aggregates 
+        WHERE user_id = ? AND result_count > 0
     ''', (user_id,)).fetchone()
     
     # Get recent results for chart
@@ -151,8 +518,6 @@ def get_user_stats(user_id):
         ORDER BY earned_at DESC
     ''', (user_id,)).fetchall()
     
-    conn.close()
-    
     return {
         'user': dict(user) if user else None,
         'total_tests': stats['total_tests'] if stats else 0,
@@ -160,16 +525,247 @@ def get_user_stats(user_id):
         'best_wpm': round(stats['best_wpm'], 1) if stats and stats['best_wpm'] else 0,
         'avg_accuracy': round(stats['avg_accuracy'], 1) if stats and stats['avg_accuracy'] else 0,
         'best_accuracy': round(stats['best_accuracy'], 1) if stats and stats['best_accuracy'] else 0,
-        'current_streak': user['current_streak'] if user else 0,
+        'wpm_stddev': round(math.sqrt(max(stats['wpm_variance'], 0)), 1) if stats else 0,
+        'current_streak': live_streak(dict(user)) if user else 0,
         'longest_streak': user['longest_streak'] if user else 0,
         'recent_results': [dict(row) for row in recent_results] if recent_results else [],
         'badges': [dict(row) for row in badges] if badges else []
     }
 
-def get_leaderboard():
-    """Get leaderboard data"""
+@cached('progress', tags=lambda user_id, period, start, end: [f'user:{user_id}'])
+def get_progress(user_id, period, start, end):
+    """Get a user's (bucket, count, wpm sum, wpm max, accuracy sum) rows for one period and date range"""
     conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT bucket, result_count, wpm_sum, wpm_max, accuracy_sum
+        FROM progress_rollups
+        WHERE user_id = ? AND period = ? AND bucket BETWEEN ? AND ?
+        ORDER BY bucket
+    ''', (user_id, period, start, end)).fetchall()
+    return [tuple(row) for row in rows]
+
+def _first_test_day(user_id):
+    row = get_db_connection().execute('''
+        SELECT bucket FROM progress_rollups
+        WHERE user_id = ? AND period = 'month'
+        ORDER BY bucket
+        LIMIT 1
+    ''', (user_id,)).fetchone()
+    return date.fromisoformat(row['bucket']) if row else None
+
+def get_progress_series(user_id, resolution='auto', start=None, end=None, max_points=60):
+    """Progress chart data from the rollups, at most `max_points` points.
+
+    `resolution` is 'day', 'week', 'month' or 'auto' (the finest period that
+    fits the range in max_points). Ranges default to the user's whole
+    history. When there are still more buckets than points, consecutive
+    buckets are merged (weighted by test count).
+    """
+    end = end or date.today()
+    start = start or _first_test_day(user_id) or end
+    if resolution not in PROGRESS_PERIODS:
+        span_days = (end - start).days + 1
+        if span_days <= max_points:
+            resolution = 'day'
+        elif span_days <= max_points * 7:
+            resolution = 'week'
+        else:
+            resolution = 'month'
     
+    # Widen the start to the bucket containing it so partial buckets are included
+    first_bucket = dict(_rollup_buckets(start.isoformat()))[resolution]
+    rows = get_progress(user_id, resolution, first_bucket, end.isoformat())
+    
+    group = max(1, math.ceil(len(rows) / max_points))
+    points = []
+    for index in range(0, len(rows), group):
+        chunk = rows[index:index + group]
+        count = sum(row[1] for row in chunk)
+        points.append({
+            'bucket': chunk[0][0],
+            'tests': count,
+            'avg_wpm': round(sum(row[2] for row in chunk) / count, 1),
+            'max_wpm': round(max(row[3] for row in chunk), 1),
+            'avg_accuracy': round(sum(row[4] for row in chunk) / count, 1)
+        })
+    
+    return {
+        'resolution': resolution,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'points': points
+    }
+
+@cached('key_stats', tags=lambda user_id, limit=10, min_count=5: [f'user:{user_id}'])
+def get_key_stats(user_id, limit=10, min_count=5):
+    """Get a user's most-missed keys and slowest bigrams from the running counters"""
+    conn = get_db_connection()
+    missed_keys = conn.execute('''
+        SELECT key, attempts, errors,
+               100.0 * errors / attempts as error_rate,
+               CASE WHEN timed > 0 THEN 1.0 * total_ms / timed END as avg_ms
+        FROM user_key_stats
+        WHERE user_id = ? AND attempts >= ? AND errors > 0
+        ORDER BY error_rate DESC, attempts DESC
+        LIMIT ?
+    ''', (user_id, min_count, limit)).fetchall()
+    
+    slow_bigrams = conn.execute('''
+        SELECT bigram, count, 1.0 * total_ms / count as avg_ms
+        FROM user_bigram_stats
+        WHERE user_id = ? AND count >= ?
+        ORDER BY avg_ms DESC
+        LIMIT ?
+    ''', (user_id, min_count, limit)).fetchall()
+    
+    return {
+        'missed_keys': [dict(row, error_rate=round(row['error_rate'], 1),
+                             avg_ms=round(row['avg_ms']) if row['avg_ms'] is not None else None)
+                        for row in missed_keys],
+        'slow_bigrams': [dict(row, avg_ms=round(row['avg_ms'])) for row in slow_bigrams]
+    }
+
+# Per-user totals over the whole history: typing_results plus what archive.py moved out
+_RESULT_TOTALS = '''
+    SELECT user_id, SUM(result_count) as result_count, SUM(wpm_sum) as wpm_sum,
+           SUM(wpm_sq_sum) as wpm_sq_sum, MAX(wpm_max) as wpm_max,
+           SUM(accuracy_sum) as accuracy_sum, SUM(accuracy_sq_sum) as accuracy_sq_sum,
+           MAX(accuracy_max) as accuracy_max
+    FROM (
+        SELECT user_id, COUNT(*) as result_count, SUM(wpm) as wpm_sum,
+               SUM(wpm * wpm) as wpm_sq_sum, MAX(wpm) as wpm_max,
+               SUM(accuracy) as accuracy_sum, SUM(accuracy * accuracy) as accuracy_sq_sum,
+               MAX(accuracy) as accuracy_max
+        FROM typing_results
+        GROUP BY user_id
+        UNION ALL
+        SELECT user_id, result_count, wpm_sum, wpm_sq_sum, wpm_max,
+               accuracy_sum, accuracy_sq_sum, accuracy_max
+        FROM archived_totals
+    )
+    GROUP BY user_id
+'''
+
+def rebuild_user_aggregates():
+    """Recompute user_aggregates from typing_results and archived_totals (backfill / repair)"""
+    with transaction() as conn:
+        _rebuild_user_aggregates(conn)
+        _touch(conn, cache.ALL_TAGS)
+    cache.clear()
+
+def _rebuild_user_aggregates(conn):
+    """Recompute user_aggregates inside the caller's transaction"""
+    conn.execute('DELETE FROM user_aggregates')
+    conn.execute('''
+        INSERT INTO user_aggregates
+            (user_id, result_count, wpm_sum, wpm_sq_sum, wpm_max, accuracy_sum, accuracy_sq_sum, accuracy_max)
+        SELECT user_id, result_count, wpm_sum, wpm_sq_sum, wpm_max,
+               accuracy_sum, accuracy_sq_sum, accuracy_max
+        FROM (''' + _RESULT_TOTALS + ''')
+    ''')
+
+def rebuild_progress_rollups():
+    """Recompute progress_rollups from typing_results and the archive (backfill / repair)"""
+    query = 'SELECT user_id, wpm, accuracy, created_at FROM typing_results ORDER BY user_id'
+    with transaction() as conn:
+        conn.execute('DELETE FROM progress_rollups')
+        # Buckets are counted in each user's timezone, like _insert_result does
+        users = {row['id']: row['timezone'] for row in conn.execute('SELECT id, timezone FROM users')}
+        rollups = {}
+        # Each partition restarts the user order; the upsert adds to what is there
+        rows = chain(archive.cold_rows(query), conn.execute(query))
+        for user_id, results in groupby(rows, key=lambda row: row['user_id']):
+            zone = users.get(user_id)
+            for row in results:
+                wpm, accuracy = row['wpm'], row['accuracy']
+                for period, bucket in _rollup_buckets(_local_day(row['created_at'], zone)):
+                    rollup = rollups.get((period, bucket))
+                    if rollup is None:
+                        rollups[(period, bucket)] = [1, wpm, wpm, accuracy]
+                    else:
+                        rollup[0] += 1
+                        rollup[1] += wpm
+                        rollup[2] = max(rollup[2], wpm)
+                        rollup[3] += accuracy
+            conn.executemany(_ADD_TO_ROLLUP, [(user_id, *key, *values) for key, values in rollups.items()])
+            rollups.clear()
+        _touch(conn, cache.ALL_TAGS)
+    cache.clear()
+
+def rebuild_key_stats(text_for_id):
+    """Recompute key/bigram counters from the stored keystroke logs, archived ones included.
+
+    `text_for_id(text_id)` returns the passage a log was typed from, or None
+    if it is gone. Logs whose passage is gone, or no longer matches the text
+    hash stored with the log, are skipped. Returns the number skipped.
+    """
+    query = '''
+        SELECT r.user_id, k.text_id, k.data
+        FROM typing_keystrokes k
+        JOIN typing_results r ON r.id = k.result_id
+    '''
+    skipped = 0
+    with transaction() as conn:
+        conn.execute('DELETE FROM user_key_stats')
+        conn.execute('DELETE FROM user_bigram_stats')
+        for row in chain(archive.cold_rows(query), conn.execute(query)):
+            log = keystroke_logs.decode(row['data'])
+            text = log.text
+            if text is None and row['text_id'] is not None:
+                text = text_for_id(row['text_id'])
+            if text is None or (log.text_hash is not None and keystroke_logs.text_hash(text) != log.text_hash):
+                skipped += 1
+                continue
+            _add_key_stats(conn, row['user_id'], log.keys, log.intervals, text)
+        _touch(conn, cache.ALL_TAGS)
+    cache.clear()
+    return skipped
+
+def check_user_aggregates(tolerance=1e-6):
+    """Compare user_aggregates against typing_results and archived_totals.
+
+    Returns a list of (user_id, column, stored, expected) for every value
+    that drifted; an empty list means the aggregates are consistent.
+    """
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT
+            COALESCE(a.user_id, t.user_id) as user_id,
+            a.result_count, a.wpm_sum, a.wpm_sq_sum, a.wpm_max,
+            a.accuracy_sum, a.accuracy_sq_sum, a.accuracy_max,
+            t.result_count as t_result_count, t.wpm_sum as t_wpm_sum,
+            t.wpm_sq_sum as t_wpm_sq_sum, t.wpm_max as t_wpm_max,
+            t.accuracy_sum as t_accuracy_sum, t.accuracy_sq_sum as t_accuracy_sq_sum,
+            t.accuracy_max as t_accuracy_max
+        FROM (''' + _RESULT_TOTALS + ''') t
+        LEFT JOIN user_aggregates a ON a.user_id = t.user_id
+        UNION ALL
+        SELECT a.user_id, a.result_count, a.wpm_sum, a.wpm_sq_sum, a.wpm_max,
+               a.accuracy_sum, a.accuracy_sq_sum, a.accuracy_max,
+               0, 0, 0, 0, 0, 0, 0
+        FROM user_aggregates a
+        WHERE a.result_count > 0
+          AND NOT EXISTS (SELECT 1 FROM typing_results t WHERE t.user_id = a.user_id)
+          AND NOT EXISTS (SELECT 1 FROM archived_totals t WHERE t.user_id = a.user_id)
+    ''').fetchall()
+    
+    columns = ('result_count', 'wpm_sum', 'wpm_sq_sum', 'wpm_max', 'accuracy_sum', 'accuracy_sq_sum', 'accuracy_max')
+    mismatches = []
+    for row in rows:
+        for column in columns:
+            stored = row[column] or 0
+            expected = row['t_' + column] or 0
+            if not math.isclose(stored, expected, rel_tol=tolerance, abs_tol=tolerance):
+                mismatches.append((row['user_id'], column, stored, expected))
+    return mismatches
+
+@cached('leaderboard', tags=lambda limit=10, offset=0: ['leaderboard'])
+def get_leaderboard(limit=10, offset=0):
+    """Get a page of the leaderboard from the materialized ranking"""
+    conn = get_db_connection()
+    
+    # CROSS JOIN pins leaderboard_entries as the outer loop so the page is
+    # read in index order and users are looked up by primary key.
     leaders = conn.execute('''
         SELECT 
             u.id,
@@ -177,20 +773,47 @@ def get_leaderboard():
             u.current_streak,
             u.longest_streak,
             u.total_tests,
-            COALESCE(MAX(tr.wpm), 0) as best_wpm,
-            COALESCE(AVG(tr.accuracy), 0) as avg_accuracy,
-            COALESCE(AVG(tr.wpm), 0) as avg_wpm
-        FROM users u
-        LEFT JOIN typing_results tr ON u.id = tr.user_id
-        GROUP BY u.id
-        HAVING u.total_tests > 0
-        ORDER BY best_wpm DESC, avg_accuracy DESC
-        LIMIT 10
-    ''').fetchall()
+            l.best_wpm,
+            l.avg_accuracy,
+            l.avg_wpm
+        FROM leaderboard_entries l
+        CROSS JOIN users u ON u.id = l.user_id
+        WHERE u.total_tests > 0
+        ORDER BY l.best_wpm DESC, l.avg_accuracy DESC, l.user_id
+        LIMIT ? OFFSET ?
+    ''', (limit, offset)).fetchall()
     
-    conn.close()
     return [dict(row) for row in leaders]
 
+@cached('user_rank', tags=lambda user_id: ['leaderboard'])
+def get_user_rank(user_id):
+    """Get a user's 1-based leaderboard position, or None if unranked"""
+    conn = get_db_connection()
+    
+    entry = conn.execute('''
+        SELECT l.best_wpm, l.avg_accuracy
+        FROM leaderboard_entries l
+        JOIN users u ON u.id = l.user_id
+        WHERE l.user_id = ? AND u.total_tests > 0
+    ''', (user_id,)).fetchone()
+    if entry is None:
+        return None
+    
+    # Three index range counts instead of one OR, so each stays a seek; users
+    # are filtered like get_leaderboard does, so rank and list position agree
+    ahead = conn.execute('''
+        SELECT
+            (SELECT COUNT(*) FROM leaderboard_entries l CROSS JOIN users u ON u.id = l.user_id
+             WHERE l.best_wpm > ?1 AND u.total_tests > 0)
+          + (SELECT COUNT(*) FROM leaderboard_entries l CROSS JOIN users u ON u.id = l.user_id
+             WHERE l.best_wpm = ?1 AND l.avg_accuracy > ?2 AND u.total_tests > 0)
+          + (SELECT COUNT(*) FROM leaderboard_entries l CROSS JOIN users u ON u.id = l.user_id
+             WHERE l.best_wpm = ?1 AND l.avg_accuracy = ?2 AND l.user_id < ?3 AND u.total_tests > 0)
+    ''', (entry['best_wpm'], entry['avg_accuracy'], user_id)).fetchone()[0]
+    
+    return ahead + 1
+
+@cached('all_users', tags=lambda: ['leaderboard'])
 def get_all_users():
     """Get all users for dashboard display"""
     conn = get_db_connection()
@@ -201,26 +824,121 @@ def get_all_users():
             u.name,
             u.current_streak,
             u.total_tests,
-            COALESCE(MAX(tr.wpm), 0) as best_wpm
-        FROM users u
-        LEFT JOIN typing_results tr ON u.id = tr.user_id
-        GROUP BY u.id
-        ORDER BY best_wpm DESC
+            l.best_wpm
+        FROM leaderboard_entries l
+        CROSS JOIN users u ON u.id = l.user_id
+        ORDER BY l.best_wpm DESC, l.avg_accuracy DESC, l.user_id
         LIMIT 5
     ''').fetchall()
+    users = [dict(row) for row in users]
+    
+    # Pad with users who have not taken a test yet, as the old LEFT JOIN did
+    if len(users) < 5:
+        extra = conn.execute('''
+            SELECT id, name, current_streak, total_tests, 0 as best_wpm
+            FROM users
+            WHERE id NOT IN (SELECT user_id FROM leaderboard_entries)
+            ORDER BY id
+            LIMIT ?
+        ''', (5 - len(users),)).fetchall()
+        users.extend(dict(row) for row in extra)
+    
+    return users
+
+def check_query_plans(user_id):
+    """Run the dashboard/leaderboard reads and EXPLAIN every statement they issue.
+
+    Returns (sql, plan_detail) pairs for any step that scans a whole table
+    without an index; an empty list means every hot query is index-driven.
+    Run it against a populated database: get_all_users pads a short list
+    with a (tiny) users scan when fewer than five people have results.
+    """
+    conn = get_db_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        get_user_stats.uncached(user_id)
+        get_leaderboard.uncached()
+        get_all_users.uncached()
+        get_user_rank.uncached(user_id)
+        get_key_stats.uncached(user_id)
+        get_progress.uncached(user_id, 'day', '0000-01-01', '9999-12-31')
+    finally:
+        conn.set_trace_callback(None)
     
-    conn.close()
-    return [dict(row) for row in users]
+    full_scans = []
+    for sql in statements:
+        if not sql.lstrip().upper().startswith('SELECT'):
+            continue
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+            detail = row['detail']
+            if detail.startswith('SCAN ') and ' USING ' not in detail and detail != 'SCAN CONSTANT ROW':
+                full_scans.append((' '.join(sql.split()), detail))
+    return full_scans
+
+def rebuild_leaderboard():
+    """Recompute leaderboard_entries from user_aggregates"""
+    with transaction() as conn:
+        _rebuild_leaderboard(conn)
+        _touch(conn, cache.ALL_TAGS)
+    cache.clear()
+
+def _rebuild_leaderboard(conn):
+    """Recompute leaderboard_entries inside the caller's transaction"""
+    conn.execute('DELETE FROM leaderboard_entries')
+    conn.execute('''
+        INSERT INTO leaderboard_entries (user_id, best_wpm, avg_accuracy, avg_wpm)
+        SELECT user_id, wpm_max, accuracy_sum / result_count, wpm_sum / result_count
+        FROM user_aggregates
+        WHERE result_count > 0
+    ''')
+
+def check_leaderboard(limit=None, tolerance=1e-6):
+    """Compare the materialized leaderboard with totals recomputed from every result, archived ones included.
 
-def update_user_streak(user_id):
-    """Update user's typing streak"""
+    The original query ordered by best_wpm and avg_accuracy only, leaving
+    ties in arbitrary order; both sides here break ties by user id so rows
+    can be compared position by position. Returns a list of human-readable
+    differences; an empty list means they agree.
+    """
     conn = get_db_connection()
+    expected = conn.execute('''
+        SELECT 
+            u.id,
+            u.name,
+            u.current_streak,
+            u.longest_streak,
+            u.total_tests,
+            COALESCE(tr.wpm_max, 0) as best_wpm,
+            COALESCE(tr.accuracy_sum / tr.result_count, 0) as avg_accuracy,
+            COALESCE(tr.wpm_sum / tr.result_count, 0) as avg_wpm
+        FROM users u
+        LEFT JOIN (''' + _RESULT_TOTALS + ''') tr ON u.id = tr.user_id
+        WHERE u.total_tests > 0
+        ORDER BY best_wpm DESC, avg_accuracy DESC, u.id
+    ''').fetchall()
+    expected = [dict(row) for row in expected]
     
-    # Get user's last test date
-    user = conn.execute('SELECT last_test_date, current_streak FROM users WHERE id = ?', (user_id,)).fetchone()
+    count = len(expected) if limit is None else limit
+    actual = get_leaderboard.uncached(limit=max(count, 0), offset=0)
+    expected = expected[:count]
     
-    today = date.today()
-    last_test_date = datetime.strptime(user['last_test_date'], '%Y-%m-%d').date() if user['last_test_date'] else None
+    differences = []
+    if len(actual) != len(expected):
+        differences.append(f"expected {len(expected)} rows, got {len(actual)}")
+    for position, (want, got) in enumerate(zip(expected, actual), start=1):
+        for key, value in want.items():
+            if isinstance(value, float):
+                same = math.isclose(value, got[key], rel_tol=tolerance, abs_tol=tolerance)
+            else:
+                same = value == got[key]
+            if not same:
+                differences.append(f"#{position} {key}: expected {value!r}, got {got[key]!r}")
+    return differences
+
+def _next_streak(last_test_date, current_streak, today):
+    """Work out the streak after a test taken on `today`"""
+    last_test_date = datetime.strptime(last_test_date, '%Y-%m-%d').date() if last_test_date else None
     
     if last_test_date:
         # Calculate days difference
@@ -228,10 +946,10 @@ def update_user_streak(user_id):
         
         if days_diff == 1:
             # Consecutive day - increment streak
-            new_streak = user['current_streak'] + 1
+            new_streak = current_streak + 1
         elif days_diff == 0:
             # Same day - no change
-            new_streak = user['current_streak']
+            new_streak = current_streak
         else:
             # Streak broken - reset to 1
             new_streak = 1
@@ -239,48 +957,157 @@ def update_user_streak(user_id):
         # First test ever
         new_streak = 1
     
-    # Update user record
-    conn.execute('''
-        UPDATE users 
-        SET current_streak = ?, 
-            longest_streak = MAX(longest_streak, ?),
-            last_test_date = ?
-        WHERE id = ?
-    ''', (new_streak, new_streak, today.isoformat(), user_id))
+    return new_streak
+
+def live_streak(user):
+    """A user row's streak as of now: zero once a whole day has passed without a test.
+
+    Stored streaks are only zeroed by reset_broken_streaks(), so reads use
+    this instead of writing to the row.
+    """
+    if not user['current_streak'] or not user['last_test_date']:
+        return 0
+    yesterday = local_date(user.get('timezone')) - timedelta(days=1)
+    return user['current_streak'] if user['last_test_date'] >= yesterday.isoformat() else 0
+
+def reset_broken_streaks(batch_size=1000):
+    """Zero the stored streak of every user who missed a day in their timezone.
+
+    Meant to run from a nightly (or, with users spread over timezones,
+    hourly) job. Only live streaks whose last test is old enough to be
+    broken somewhere in the world are read, through a partial index, and
+    each reset only applies if last_test_date is still the value that was
+    read, so a test submitted in the meantime is never clobbered. Returns
+    the number of streaks reset.
+    """
+    now = datetime.now(timezone.utc)
+    # No timezone is more than 14 hours ahead of UTC, so nobody's yesterday is later than this
+    cutoff = ((now + timedelta(hours=14)).date() - timedelta(days=1)).isoformat()
+    conn = get_db_connection()
+    yesterdays = {}
+    broken = []
+    for row in conn.execute('''
+        SELECT id, timezone, last_test_date
+        FROM users
+        WHERE current_streak > 0 AND last_test_date < ?
+    ''', (cutoff,)):
+        yesterday = yesterdays.get(row['timezone'])
+        if yesterday is None:
+            yesterday = yesterdays[row['timezone']] = (local_date(row['timezone'], now) - timedelta(days=1)).isoformat()
+        if row['last_test_date'] < yesterday:
+            broken.append((row['id'], row['last_test_date']))
     
-    conn.commit()
-    conn.close()
+    reset = []
+    for start in range(0, len(broken), batch_size):
+        with transaction() as conn:
+            batch_reset = []
+            for user_id, last_test_date in broken[start:start + batch_size]:
+                cursor = conn.execute(
+                    'UPDATE users SET current_streak = 0 WHERE id = ? AND last_test_date = ? AND current_streak > 0',
+                    (user_id, last_test_date)
+                )
+                if cursor.rowcount:
+                    batch_reset.append(user_id)
+            if batch_reset:
+                _touch(conn, *[f'user:{user_id}' for user_id in batch_reset], 'leaderboard')
+        reset += batch_reset
+    if reset:
+        cache.invalidate(*[f'user:{user_id}' for user_id in reset], 'leaderboard')
+    return len(reset)
 
-def create_badge(user_id, title, description):
-    """Create a badge using anybadge and store in database"""
-    try:
-        # Create badge directory if it doesn't exist
-        badge_dir = '/tmp/badges' if os.name != 'nt' else 'badges'
-        os.makedirs(badge_dir, exist_ok=True)
-        
-        # Generate badge filename
-        filename = f"badge_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.svg"
-        filepath = os.path.join(badge_dir, filename)
-        
-        # Create badge with anybadge
-        badge = anybadge.Badge(
-            label=title,
-            value=description,
-            default_color='gold',
-            text_color='white'
-        )
-        badge.write_badge(filepath)
-        
-        # Save to database
-        conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO badges (user_id, badge_type, title, description, image_path)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, 'achievement', title, description, filepath))
-        conn.commit()
-        conn.close()
-        
-        return filepath
-    except Exception as e:
-        print(f"Error creating badge: {e}")
-        return None
\ No newline at end of file
+def _count_streak(state, results, zone):
+    """Extend (last day ordinal, current streak, longest streak) with results in created_at order"""
+    previous, streak, longest = state
+    for day in sorted({_local_day(row['created_at'], zone) for row in results}):
+        ordinal = date.fromisoformat(day).toordinal()
+        # Copies left in both tiers by an interrupted archive run are counted once
+        if previous is not None and ordinal <= previous:
+            continue
+        streak = streak + 1 if previous == ordinal - 1 else 1
+        longest = max(longest, streak)
+        previous = ordinal
+    return previous, streak, longest
+
+def recompute_streaks(batch_size=1000):
+    """Rebuild every user's streak from their results in one streaming pass.
+
+    Results are read in (user_id, created_at) index order from a single
+    read snapshot and grouped per user, so memory grows with the number of
+    users, not of results. The archived partitions are read the same way
+    first, keeping only each user's running streak, so a streak that runs
+    back past the archive horizon is counted in full. Days are counted in
+    each user's timezone; the longest streak never decreases, since
+    partitions may have been moved away. A user who tested after the
+    snapshot is left alone. Returns the number of users whose streak changed.
+    """
+    changes = []
+    with transaction(immediate=False) as conn:
+        users = {row['id']: row for row in conn.execute(
+            'SELECT id, timezone, current_streak, longest_streak, last_test_date FROM users'
+        )}
+        # Read after the snapshot started: a row archived since is in both, never in neither
+        archived = {}
+        cold = archive.cold_rows('SELECT user_id, created_at FROM typing_results ORDER BY user_id, created_at')
+        for user_id, results in groupby(cold, key=lambda row: row['user_id']):
+            user = users.get(user_id)
+            if user is not None:
+                archived[user_id] = _count_streak(archived.get(user_id, (None, 0, 0)), results, user['timezone'])
+        yesterdays = {}
+        rows = conn.execute('SELECT user_id, created_at FROM typing_results ORDER BY user_id, created_at')
+        for user_id, results in groupby(rows, key=lambda row: row['user_id']):
+            user = users.get(user_id)
+            if user is None:
+                continue
+            zone = user['timezone']
+            previous, streak, longest = _count_streak(archived.get(user_id, (None, 0, 0)), results, zone)
+            last_test_date = date.fromordinal(previous).isoformat()
+            
+            yesterday = yesterdays.get(zone)
+            if yesterday is None:
+                yesterday = yesterdays[zone] = (local_date(zone) - timedelta(days=1)).isoformat()
+            if last_test_date < yesterday:
+                streak = 0
+            longest = max(longest, user['longest_streak'] or 0)
+            if (streak, longest, last_test_date) != (user['current_streak'], user['longest_streak'], user['last_test_date']):
+                changes.append((streak, longest, last_test_date, user_id, user['last_test_date']))
+    
+    for start in range(0, len(changes), batch_size):
+        with transaction() as conn:
+            conn.executemany('''
+                UPDATE users
+                SET current_streak = ?, longest_streak = ?, last_test_date = ?
+                WHERE id = ? AND last_test_date IS ?
+            ''', changes[start:start + batch_size])
+            _touch(conn, *[f'user:{change[3]}' for change in changes[start:start + batch_size]], 'leaderboard')
+    if changes:
+        cache.invalidate(*[f'user:{change[3]}' for change in changes], 'leaderboard')
+    return len(changes)
+
+def _insert_badge(conn, user_id, title, description):
+    """Insert a badge row pointing at its shared image and return the image URL"""
+    key = badge_assets.badge_key(title, description)
+    image = badge_assets.badge_url(key)
+    conn.execute(
+        'INSERT OR IGNORE INTO badge_assets (asset_key, title, description) VALUES (?, ?, ?)',
+        (key, title, description)
+    )
+    conn.execute('''
+        INSERT INTO badges (user_id, badge_type, title, description, image_path)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, 'achievement', title, description, image))
+    return image
+
+def get_badge_asset(asset_key):
+    """Get (title, description) for a badge image key, or None"""
+    conn = get_db_connection()
+    row = conn.execute(
+        'SELECT title, description FROM badge_assets WHERE asset_key = ?',
+        (asset_key,)
+    ).fetchone()
+    return (row['title'], row['description']) if row else None
+
+# Time and count every public function here (per function, cache hits
+# included); pure date helpers called per row are left out
+metrics.instrument_module(globals(), exclude=(
+    'get_db_connection', 'to_utc_timestamp', 'local_date', 'is_valid_timezone', 'live_streak',
+))
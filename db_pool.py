@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+
+# Determine database path based on OS
+if os.name == 'nt':  # Windows
+    DEFAULT_DB_PATH = 'web.db'
+else:  # POSIX (Linux, macOS, Vercel)
+    DEFAULT_DB_PATH = '/tmp/web.db'
+
+# Connection settings, overridable through the environment
+DB_PATH = os.environ.get('DB_PATH', DEFAULT_DB_PATH)
+JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL')
+SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 256))
+# Released connections kept open for the next thread; the rest are closed
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+
+_local = threading.local()
+_lock = threading.Lock()
+# Idle connections as (connection, pid, generation), most recently released last
+_idle = []
+# Every open connection, held weakly: one owned by a thread that exits
+# without release() is closed when it is garbage collected
+_open = weakref.WeakSet()
+_generation = 0
+
+
+class _Connection(sqlite3.Connection):
+    """sqlite3.Connection that can be referenced weakly"""
+
+
+def configure(path=None, **settings):
+    """Point the pool at another database file and/or change pragmas.
+
+    Open connections are closed so the next call picks up the new settings.
+    """
+    global DB_PATH, JOURNAL_MODE, SYNCHRONOUS, CACHE_SIZE_KB, MMAP_SIZE, BUSY_TIMEOUT_MS, STATEMENT_CACHE_SIZE
+    close_all()
+    if path is not None:
+        DB_PATH = path
+    JOURNAL_MODE = settings.get('journal_mode', JOURNAL_MODE)
+    SYNCHRONOUS = settings.get('synchronous', SYNCHRONOUS)
+    CACHE_SIZE_KB = settings.get('cache_size_kb', CACHE_SIZE_KB)
+    MMAP_SIZE = settings.get('mmap_size', MMAP_SIZE)
+    BUSY_TIMEOUT_MS = settings.get('busy_timeout_ms', BUSY_TIMEOUT_MS)
+    STATEMENT_CACHE_SIZE = settings.get('statement_cache_size', STATEMENT_CACHE_SIZE)
+
+
+def _connect():
+    """Open and tune a new connection"""
+    # isolation_level=None puts the driver in autocommit mode; writes are
+    # grouped explicitly with transaction() instead of implicit BEGINs.
+    conn = sqlite3.connect(
+        DB_PATH,
+        factory=_Connection,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA journal_mode = {JOURNAL_MODE}')
+    conn.execute(f'PRAGMA synchronous = {SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def get_connection():
+    """Return this thread's connection, checking one out of the pool on first use.
+
+    A thread keeps its connection until release() hands it back. Connections
+    are keyed by process id so a forked worker never reuses a handle
+    inherited from its parent, and are replaced after close_all() or
+    configure().
+    """
+    pid = os.getpid()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == pid and _local.generation == _generation:
+        return conn
+    if conn is not None and _local.pid == pid:
+        # Left over from before close_all(); only this thread may close it
+        conn.close()
+    conn = None
+    with _lock:
+        while _idle:
+            candidate, candidate_pid, generation = _idle.pop()
+            if candidate_pid == pid and generation == _generation:
+                conn = candidate
+                break
+            if candidate_pid == pid:
+                candidate.close()
+        generation = _generation
+    if conn is None:
+        conn = _connect()
+        with _lock:
+            _open.add(conn)
+    _local.conn = conn
+    _local.pid = pid
+    _local.generation = generation
+    return conn
+
+
+@contextmanager
+def transaction(immediate=True):
+    """Run a block of statements atomically on the pooled connection.
+
+    BEGIN IMMEDIATE takes the write lock up front so concurrent writers wait
+    on busy_timeout instead of failing with "database is locked" half-way
+    through. Nested calls join the outer transaction.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def release():
+    """Hand this thread's connection back to the pool (e.g. at the end of a request)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    if _local.pid != os.getpid():
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    with _lock:
+        if _local.generation == _generation and len(_idle) < POOL_SIZE:
+            _idle.append((conn, _local.pid, _local.generation))
+            return
+        _open.discard(conn)
+    conn.close()
+
+
+def stats():
+    """Return the number of open and idle connections in this process"""
+    with _lock:
+        return {'open': len(_open), 'idle': len(_idle)}
+
+
+def close_all():
+    """Close the idle connections and this thread's, and retire every other one.
+
+    Connections checked out by other threads stay usable until those threads
+    next call get_connection() or release(), which replace or close them.
+    """
+    global _generation
+    with _lock:
+        idle = [conn for conn, pid, _ in _idle if pid == os.getpid()]
+        _idle.clear()
+        _generation += 1
+        for conn in idle:
+            _open.discard(conn)
+    for conn in idle:
+        conn.close()
+    conn = getattr(_local, 'conn', None)
+    _local.conn = None
+    if conn is not None and _local.pid == os.getpid():
+        with _lock:
+            _open.discard(conn)
+        try:
+            conn.close()
+        except sqlite3.ProgrammingError:
+            pass
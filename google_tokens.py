@@ -0,0 +1,237 @@
+"""Local verification of Google ID tokens.
+
+Instead of calling the tokeninfo endpoint on every login, the RS256
+signature is checked against Google's published JWKS keys, which are
+cached for as long as Google's Cache-Control allows and refetched early
+when a token names a key id we have not seen (key rotation). Tokens that
+already passed verification are remembered by hash for a short time.
+
+The key fetch uses a pooled requests session with timeouts. For offline
+tests, point GOOGLE_JWKS_URL at a stub server or install a fetcher with
+set_jwks_fetcher().
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+JWKS_URL = os.environ.get('GOOGLE_JWKS_URL', 'https://www.googleapis.com/oauth2/v3/certs')
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+HTTP_TIMEOUT = (3.05, 5)
+DEFAULT_KEYS_MAX_AGE = 3600
+# Don't refetch on unknown key ids more often than this
+MIN_REFRESH_INTERVAL = 60
+CLOCK_SKEW = 60
+VERIFIED_CACHE_TTL = float(os.environ.get('GOOGLE_TOKEN_CACHE_TTL', 300))
+VERIFIED_CACHE_SIZE = 4096
+
+# DER prefix of the DigestInfo for SHA-256 (RFC 8017, section 9.2)
+_SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+class TokenError(ValueError):
+    """Raised when an ID token is malformed, badly signed or not for us"""
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def _b64_to_int(value):
+    return int.from_bytes(_b64decode(value), 'big')
+
+
+def verify_rs256(signing_input, signature, n, e):
+    """Check an RSASSA-PKCS1-v1_5 SHA-256 signature"""
+    size = (n.bit_length() + 7) // 8
+    if len(signature) != size:
+        return False
+    decrypted = pow(int.from_bytes(signature, 'big'), e, n).to_bytes(size, 'big')
+    digest_info = _SHA256_DIGEST_INFO + hashlib.sha256(signing_input).digest()
+    padding = size - len(digest_info) - 3
+    if padding < 8:
+        return False
+    expected = b'\x00\x01' + b'\xff' * padding + b'\x00' + digest_info
+    return hmac.compare_digest(decrypted, expected)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=2))
+        return _session
+
+
+def fetch_jwks(url=JWKS_URL):
+    """Download a JWKS document; returns (jwks, max_age_seconds)"""
+    with metrics.external('google', 'jwks'):
+        response = _get_session().get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+    match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+    max_age = int(match.group(1)) if match else DEFAULT_KEYS_MAX_AGE
+    return response.json(), max_age
+
+
+class KeySet:
+    """Cached RSA public keys by key id"""
+
+    def __init__(self, fetcher=fetch_jwks):
+        self.fetcher = fetcher
+        self._keys = {}
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        # Held for the duration of a fetch, so only one thread downloads keys
+        self._refresh_lock = threading.Lock()
+
+    def _needs_refresh(self, kid):
+        """Check (with _lock held) whether the keys are expired or lack `kid`"""
+        now = time.time()
+        stale = now >= self._expires_at
+        unknown = kid not in self._keys and now - self._fetched_at >= MIN_REFRESH_INTERVAL
+        return stale or unknown
+
+    def _refresh(self, kid, wait=True):
+        """Fetch the keys without holding _lock, then swap them in.
+
+        With wait=False, returns straight away if another thread is already
+        fetching.
+        """
+        if not self._refresh_lock.acquire(blocking=wait):
+            return
+        try:
+            with self._lock:
+                if not self._needs_refresh(kid):
+                    return
+            jwks, max_age = self.fetcher()
+            keys = {}
+            for key in jwks.get('keys', []):
+                if key.get('kty') == 'RSA' and key.get('kid'):
+                    keys[key['kid']] = (_b64_to_int(key['n']), _b64_to_int(key['e']))
+            now = time.time()
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = now
+                self._expires_at = now + max_age
+        finally:
+            self._refresh_lock.release()
+
+    def get(self, kid):
+        """Return (n, e) for a key id, refreshing if expired or unknown"""
+        with self._lock:
+            needs_refresh = self._needs_refresh(kid)
+            have_keys = bool(self._keys)
+            known = kid in self._keys
+        if needs_refresh:
+            try:
+                # A key we already have is served while another thread refetches
+                self._refresh(kid, wait=not known)
+            except Exception as e:
+                # Keep serving the keys we have if Google is unreachable
+                if not have_keys:
+                    raise TokenError(f"Could not fetch signing keys: {e}")
+                print(f"Error refreshing Google signing keys: {e}")
+        with self._lock:
+            key = self._keys.get(kid)
+        if key is None:
+            raise TokenError(f"Unknown signing key {kid!r}")
+        return key
+
+
+_key_set = KeySet()
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+
+def set_jwks_fetcher(fetcher):
+    """Use a different key source (e.g. a local stub) and forget cached state"""
+    global _key_set
+    _key_set = KeySet(fetcher)
+    with _verified_lock:
+        _verified.clear()
+
+
+def _cached_claims(token_hash):
+    with _verified_lock:
+        item = _verified.get(token_hash)
+        if item is None:
+            return None
+        claims, expires_at = item
+        if expires_at <= time.time():
+            del _verified[token_hash]
+            return None
+        _verified.move_to_end(token_hash)
+        return claims
+
+
+def _remember(token_hash, claims):
+    expires_at = min(claims['exp'], time.time() + VERIFIED_CACHE_TTL)
+    with _verified_lock:
+        _verified[token_hash] = (claims, expires_at)
+        while len(_verified) > VERIFIED_CACHE_SIZE:
+            _verified.popitem(last=False)
+
+
+def verify_id_token(token, audience):
+    """Verify a Google ID token locally and return its claims.
+
+    Raises TokenError if the token is malformed, the signature does not
+    match a current Google key, or the issuer/audience/expiry are wrong.
+    """
+    if not token or not audience:
+        raise TokenError("Missing token or audience")
+    if not isinstance(token, str):
+        raise TokenError("Token must be a string")
+
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    claims = _cached_claims(token_hash)
+    if claims is not None and claims.get('aud') == audience:
+        return claims
+
+    try:
+        header_segment, payload_segment, signature_segment = token.split('.')
+        header = json.loads(_b64decode(header_segment))
+        claims = json.loads(_b64decode(payload_segment))
+        signature = _b64decode(signature_segment)
+    except (ValueError, TypeError) as e:
+        raise TokenError(f"Malformed token: {e}")
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise TokenError("Malformed token: header and payload must be JSON objects")
+    if not isinstance(header.get('kid'), str):
+        raise TokenError("Malformed token: missing key id")
+
+    if header.get('alg') != 'RS256':
+        raise TokenError(f"Unsupported algorithm {header.get('alg')!r}")
+
+    n, e = _key_set.get(header.get('kid'))
+    if not verify_rs256(f"{header_segment}.{payload_segment}".encode(), signature, n, e):
+        raise TokenError("Invalid signature")
+
+    now = time.time()
+    if claims.get('iss') not in ISSUERS:
+        raise TokenError("Wrong issuer")
+    if claims.get('aud') != audience:
+        raise TokenError("Wrong audience")
+    if not isinstance(claims.get('exp'), (int, float)) or claims['exp'] < now - CLOCK_SKEW:
+        raise TokenError("Token expired")
+    if not isinstance(claims.get('iat', 0), (int, float)) or claims.get('iat', 0) > now + CLOCK_SKEW:
+        raise TokenError("Token issued in the future")
+
+    _remember(token_hash, claims)
+    return claims
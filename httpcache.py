@@ -0,0 +1,305 @@
+"""HTTP caching and compression.
+
+Pages (dashboard, profiles, leaderboard) get weak ETags built from the
+versions of the tags they depend on ("user:<id>", "leaderboard"), plus the
+template build and the viewer. conditional() computes the ETag before the
+view runs, so a matching If-None-Match is answered with 304 from one
+indexed read, without rendering. Pages are private and revalidated on
+every visit (Cache-Control: private, no-cache).
+
+The versions come from the source installed with init_app(versions=...):
+the app reads the data_versions table, which every writer bumps in its own
+transaction, so a write from any process (another worker, the race
+server, manage.py) changes the ETag. A tag whose shared version moved is
+also invalidated in this process's read cache before the page renders, so
+the new ETag never goes out with stale content. Without a source, the
+in-process tag versions and cache epoch are used, which only see this
+process's writes.
+
+Assets are held in memory with their gzip copy, and a brotli copy when the
+optional brotli module is installed, compressed once at maximum level.
+Content-addressed URLs (badges, asset_url()) are served as immutable for a
+year. Other text responses over COMPRESS_MIN_BYTES are gzipped on the fly
+for clients that accept it.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request, session, url_for
+
+import cache
+import metrics
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(ROOT_DIR, 'templates')
+# Files from the project root that may be served under /assets/
+ASSET_FILES = ('favico.png',)
+ASSET_CACHE_ENTRIES = int(os.environ.get('ASSET_CACHE_ENTRIES', 1024))
+# Identifies the deployed templates in page ETags; hashed from templates/ when unset
+RELEASE = os.environ.get('RELEASE')
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+COMPRESSIBLE = ('text/html', 'text/plain', 'text/css', 'application/json',
+                'application/javascript', 'image/svg+xml')
+# Precompressed copies are only kept when they save at least this much
+MIN_SAVING = 0.1
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+PAGE_CACHE_CONTROL = 'private, no-cache'
+ETAG_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+NOT_MODIFIED = metrics.counter('http_not_modified_total', "Requests answered with 304 Not Modified", ('kind',))
+
+# Shared tag versions last seen by this process, most recent last
+SEEN_TAGS = int(os.environ.get('ETAG_SEEN_TAGS', 65536))
+
+_brotli = False
+_build = None
+_versions = None
+_seen = OrderedDict()
+_seen_lock = threading.Lock()
+_assets = OrderedDict()
+_assets_lock = threading.Lock()
+
+
+def _get_brotli():
+    """Import brotli on first use; None when it is not installed"""
+    global _brotli
+    if _brotli is False:
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        _brotli = brotli
+    return _brotli
+
+
+def _build_id():
+    global _build
+    if _build is None:
+        if RELEASE:
+            _build = RELEASE
+        else:
+            digest = hashlib.sha1()
+            for name in sorted(os.listdir(TEMPLATE_DIR)):
+                with open(os.path.join(TEMPLATE_DIR, name), 'rb') as f:
+                    digest.update(name.encode() + b'\0' + f.read())
+            _build = digest.hexdigest()[:12]
+    return _build
+
+
+def _shared_versions(tags):
+    """Shared versions of `tags`, invalidating any that moved in this process's read cache"""
+    tags = (*tags, cache.ALL_TAGS)
+    versions = _versions(tags)
+    moved = []
+    with _seen_lock:
+        for tag, version in zip(tags, versions):
+            # A tag not seen before may have cached entries from before a write
+            if _seen.get(tag) != version:
+                moved.append(tag)
+            _seen[tag] = version
+            _seen.move_to_end(tag)
+        while len(_seen) > SEEN_TAGS:
+            _seen.popitem(last=False)
+    if cache.ALL_TAGS in moved:
+        cache.clear()
+    elif moved:
+        cache.invalidate(*moved)
+    return versions
+
+
+def page_etag(tags, *parts):
+    """ETag for the current request given the cache tags its content depends on"""
+    if _versions is not None:
+        versions = _shared_versions(tags)
+    else:
+        versions = (cache.epoch(), cache.tag_versions(*tags))
+    key = repr((_build_id(), request.full_path, session.get('user_id'), versions, parts))
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def conditional(tags, vary=None):
+    """Answer GETs with 304 while the ETag from `tags(**view_args)` still matches.
+
+    `vary(**view_args)` may return extra values the page depends on, such
+    as the viewer's local date for streaks that lapse without a write.
+    The request path, query string and session user are always included.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            # Computed before the view runs: a write that lands while the
+            # page renders bumps a version, so the next visit re-renders
+            extra = vary(**kwargs) if vary else ()
+            etag = page_etag(tags(**kwargs), *extra)
+            if request.if_none_match.contains_weak(etag):
+                NOT_MODIFIED.inc('page')
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = PAGE_CACHE_CONTROL
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+
+def _accepts(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+class Asset:
+    """Bytes with a content hash and precompressed copies"""
+
+    def __init__(self, data, mimetype, tag=None):
+        self.data = data
+        self.mimetype = mimetype
+        self.tag = tag or hashlib.sha256(data).hexdigest()[:16]
+        self.encodings = {}
+        if mimetype in COMPRESSIBLE:
+            brotli = _get_brotli()
+            if brotli is not None:
+                self._keep('br', brotli.compress(data, quality=11))
+            self._keep('gzip', gzip.compress(data, 9, mtime=0))
+
+    def _keep(self, encoding, compressed):
+        if len(compressed) <= len(self.data) * (1 - MIN_SAVING):
+            self.encodings[encoding] = compressed
+
+    def response(self, cache_control):
+        encoding = next((name for name in self.encodings if _accepts(name)), None)
+        tag = self.tag + ETAG_SUFFIXES.get(encoding, '')
+        if _not_modified(self.tag):
+            NOT_MODIFIED.inc('asset')
+            response = Response(status=304)
+        else:
+            response = Response(self.encodings.get(encoding, self.data), mimetype=self.mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = cache_control
+        if self.encodings:
+            response.vary.add('Accept-Encoding')
+        return response
+
+
+def _not_modified(tag):
+    """Whether If-None-Match names any encoding of the asset `tag`"""
+    return any(request.if_none_match.contains(tag + suffix) for suffix in ('', *ETAG_SUFFIXES.values()))
+
+
+def get_asset(name, load):
+    """Return the Asset cached under `name`, building it from `load()` on first use.
+
+    `load()` returns (bytes, mimetype) or (bytes, mimetype, tag), or None
+    when there is no such asset (which is not cached).
+    """
+    with _assets_lock:
+        asset = _assets.get(name)
+        if asset is not None:
+            _assets.move_to_end(name)
+            return asset
+    loaded = load()
+    if loaded is None:
+        return None
+    asset = Asset(*loaded)
+    with _assets_lock:
+        _assets[name] = asset
+        while len(_assets) > ASSET_CACHE_ENTRIES:
+            _assets.popitem(last=False)
+    return asset
+
+
+def send_asset(name, load, cache_control=IMMUTABLE, tag=None):
+    """Serve an asset, or None if `load` does not know it.
+
+    With a known `tag` (a content-addressed URL) a revalidation is answered
+    before the asset is loaded.
+    """
+    if tag is not None and _not_modified(tag):
+        NOT_MODIFIED.inc('asset')
+        response = Response(status=304)
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+    asset = get_asset(name, load)
+    if asset is None:
+        return None
+    return asset.response(cache_control)
+
+
+def _load_file(filename):
+    def load():
+        import mimetypes
+
+        if filename not in ASSET_FILES:
+            return None
+        with open(os.path.join(ROOT_DIR, filename), 'rb') as f:
+            data = f.read()
+        return data, mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return load
+
+
+def send_file_asset(filename, cache_control):
+    """Serve one of ASSET_FILES from memory"""
+    return send_asset('file:' + filename, _load_file(filename), cache_control)
+
+
+def asset_url(filename):
+    """Fingerprinted URL of one of ASSET_FILES, safe to cache forever"""
+    asset = get_asset('file:' + filename, _load_file(filename))
+    stem, ext = os.path.splitext(filename)
+    return url_for('static_asset', name=f'{stem}.{asset.tag}{ext}')
+
+
+def send_fingerprinted(name):
+    """Serve /assets/<stem>.<hash><ext>; None unless the hash is the current one"""
+    stem, _, rest = name.partition('.')
+    tag, _, ext = rest.partition('.')
+    filename = f'{stem}.{ext}'
+    if filename not in ASSET_FILES:
+        return None
+    asset = get_asset('file:' + filename, _load_file(filename))
+    if asset is None or asset.tag != tag:
+        return None
+    return asset.response(IMMUTABLE)
+
+
+def init_app(app, versions=None):
+    """Gzip text responses on the fly and expose asset_url() to templates.
+
+    `versions(tags)` returns the shared version of each tag for page ETags.
+    """
+    global _versions
+    _versions = versions
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    @app.after_request
+    def compress(response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE
+                or not _accepts('gzip')):
+            return response
+        # A strong ETag names one exact representation
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            return response
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(gzip.compress(data, COMPRESS_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
@@ -0,0 +1,220 @@
+"""Background job queue persisted in SQLite.
+
+Slow side effects (emails, badge rendering) are enqueued instead of being
+run inside the request. Jobs live in the jobs table so they survive a
+restart; a small pool of worker threads claims and runs them. Failed jobs
+are retried with exponential backoff and moved to dead_jobs once they run
+out of attempts.
+
+Every job kind is listed in HANDLERS with the module and function that run
+it, imported on first use, so any process that runs the queue can handle
+every kind whatever it has imported. handler() registers extra kinds (or
+overrides one), e.g. in tests:
+
+    @jobs.handler('send_email', batch_size=20)
+    def send_email(payloads): ...
+
+A handler receives a list of payloads (up to batch_size jobs of the same
+kind claimed together) and either returns normally, meaning every job in
+the batch succeeded, raises PartialFailure when only the first jobs of the
+batch went through, or raises anything else to retry them all.
+"""
+import importlib
+import json
+import os
+import random
+import threading
+import time
+
+from db_pool import transaction, get_connection, release
+
+WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+BACKOFF_BASE = float(os.environ.get('JOB_BACKOFF_BASE', 2.0))
+BACKOFF_MAX = float(os.environ.get('JOB_BACKOFF_MAX', 600.0))
+# A running job whose worker died is handed out again after this long
+LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 300))
+
+# kind -> (module, function, batch_size)
+HANDLERS = {
+    'verification_email': ('auth', 'send_verification_emails', 20),
+    'render_badges': ('badges', 'render_badges', 1),
+}
+
+_handlers = {}
+_wakeup = threading.Event()
+_stop = threading.Event()
+_threads = []
+_start_lock = threading.Lock()
+
+
+class PartialFailure(Exception):
+    """Raised by a handler when the first `completed` jobs of its batch succeeded"""
+
+    def __init__(self, completed, error):
+        super().__init__(f"{error} (after {completed} job(s) completed)")
+        self.completed = completed
+        self.error = error
+
+
+def handler(kind, batch_size=1):
+    """Register the function that runs jobs of `kind`"""
+    def decorator(func):
+        _handlers[kind] = (func, batch_size)
+        return func
+    return decorator
+
+
+def _handler(kind):
+    """(function, batch_size) for a job kind, or (None, 1) if it has none"""
+    entry = _handlers.get(kind)
+    if entry is None and kind in HANDLERS:
+        module, name, batch_size = HANDLERS[kind]
+        entry = _handlers.setdefault(kind, (getattr(importlib.import_module(module), name), batch_size))
+    return entry or (None, 1)
+
+
+def enqueue(kind, payload, delay=0, max_attempts=MAX_ATTEMPTS):
+    """Persist a job and wake a worker; returns the job id"""
+    with transaction() as conn:
+        cursor = conn.execute(
+            'INSERT INTO jobs (kind, payload, run_at, max_attempts) VALUES (?, ?, ?, ?)',
+            (kind, json.dumps(payload), time.time() + delay, max_attempts)
+        )
+    start_workers()
+    _wakeup.set()
+    return cursor.lastrowid
+
+
+def _claim(now):
+    """Lease the next due job plus same-kind jobs for a batch"""
+    with transaction() as conn:
+        job = conn.execute('''
+            SELECT id, kind FROM jobs
+            WHERE (status = 'pending' AND run_at <= ?)
+               OR (status = 'running' AND locked_until <= ?)
+            ORDER BY run_at
+            LIMIT 1
+        ''', (now, now)).fetchone()
+        if job is None:
+            return None, []
+
+        _, batch_size = _handler(job['kind'])
+        rows = conn.execute('''
+            SELECT id, payload, attempts, max_attempts FROM jobs
+            WHERE kind = ?
+              AND ((status = 'pending' AND run_at <= ?)
+                   OR (status = 'running' AND locked_until <= ?))
+            ORDER BY run_at
+            LIMIT ?
+        ''', (job['kind'], now, now, batch_size)).fetchall()
+        conn.executemany(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ? WHERE id = ?",
+            [(now + LEASE_SECONDS, row['id']) for row in rows]
+        )
+    return job['kind'], [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+
+def _backoff(attempts):
+    delay = min(BACKOFF_BASE ** attempts, BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _finish(kind, batch, error=None):
+    """Delete succeeded jobs; reschedule or dead-letter failed ones"""
+    now = time.time()
+    with transaction() as conn:
+        if error is None:
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(job['id'],) for job in batch])
+            return
+        for job in batch:
+            if job['attempts'] >= job['max_attempts']:
+                conn.execute('''
+                    INSERT INTO dead_jobs (id, kind, payload, attempts, last_error)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (job['id'], kind, job['payload'], job['attempts'], error))
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+            else:
+                conn.execute('''
+                    UPDATE jobs SET status = 'pending', run_at = ?, last_error = ?, locked_until = NULL
+                    WHERE id = ?
+                ''', (now + _backoff(job['attempts']), error, job['id']))
+
+
+def run_next():
+    """Claim and run one batch; returns the number of jobs processed"""
+    kind, batch = _claim(time.time())
+    if not batch:
+        return 0
+
+    func = _handler(kind)[0]
+    if func is None:
+        _finish(kind, batch, f"No handler registered for {kind!r}")
+        return len(batch)
+
+    try:
+        func([json.loads(job['payload']) for job in batch])
+    except PartialFailure as e:
+        print(f"Error running {kind} job: {e}")
+        _finish(kind, batch[:e.completed])
+        _finish(kind, batch[e.completed:], repr(e.error))
+    except Exception as e:
+        print(f"Error running {kind} job: {e}")
+        _finish(kind, batch, repr(e))
+    else:
+        _finish(kind, batch)
+    return len(batch)
+
+
+def run_pending(limit=None):
+    """Run due jobs in the calling thread until none are left (or `limit`)"""
+    processed = 0
+    while limit is None or processed < limit:
+        count = run_next()
+        if not count:
+            break
+        processed += count
+    return processed
+
+
+def _worker():
+    while not _stop.is_set():
+        try:
+            if run_next():
+                continue
+        except Exception as e:
+            print(f"Job worker error: {e}")
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+    release()
+
+
+def start_workers(count=WORKERS):
+    """Start the worker threads once per process"""
+    with _start_lock:
+        alive = [thread for thread in _threads if thread.is_alive()]
+        if len(alive) >= count:
+            return
+        _stop.clear()
+        for index in range(count - len(alive)):
+            thread = threading.Thread(target=_worker, name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            _threads.append(thread)
+
+
+def stop_workers(timeout=5):
+    """Ask workers to exit and wait for them"""
+    _stop.set()
+    _wakeup.set()
+    for thread in list(_threads):
+        thread.join(timeout)
+    _threads.clear()
+
+
+def queue_stats():
+    """Return pending/running/dead job counts"""
+    conn = get_connection()
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    dead = conn.execute('SELECT COUNT(*) FROM dead_jobs').fetchone()[0]
+    return {'pending': counts.get('pending', 0), 'running': counts.get('running', 0), 'dead': dead}
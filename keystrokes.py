@@ -0,0 +1,179 @@
+"""Compact binary storage for keystroke logs.
+
+A log is stored as one blob next to its typing_results row instead of a
+row per keystroke:
+
+    header   <version:u8> <flags:u8> <count:u32> <text hash:8 bytes>
+    keys     count key codes, 1, 2 or 4 bytes each
+    timings  count u16 milliseconds since the previous keystroke
+    text     the UTF-8 text typed, only with FLAG_TEXT
+
+Timings are already deltas between keystroke timestamps, so they fit in
+two bytes and compress well. Key codes use the narrowest width that holds
+every character (one byte for Latin-1 text). The body is zlib-compressed
+when that makes it smaller.
+
+The text hash identifies what was typed, so a log can be checked against
+the passage it is replayed with. Texts that can't be looked up again
+(generated practice texts) are embedded with FLAG_TEXT. Version 1 blobs,
+without either, still decode; their text_hash is None.
+
+decode() does not copy an uncompressed blob: keys and timings are
+memoryviews cast straight over the stored bytes.
+
+analyze() turns a log into the per-key and per-bigram counters that the
+dashboard heatmaps are built from, so those can be maintained
+incrementally instead of being recomputed from raw logs.
+"""
+import hashlib
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+VERSION = 2
+HEADER = struct.Struct('<BBI')
+HASH_SIZE = 8
+FLAG_COMPRESSED = 0x01
+FLAG_TEXT = 0x08
+# Bits 1-2 hold an index into KEY_FORMATS: (bytes per key, array typecode, codec)
+WIDTH_SHIFT = 1
+WIDTH_MASK = 0x06
+KEY_FORMATS = ((1, 'B', 'latin-1'), (2, 'H', 'utf-16-le'), (4, 'I', 'utf-32-le'))
+MAX_TIMING_MS = 0xFFFF
+
+COMPRESS = os.environ.get('KEYSTROKE_COMPRESSION', '1') not in ('0', 'false', 'False')
+COMPRESS_MIN_BYTES = 128
+COMPRESS_LEVEL = 6
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+class KeystrokeLog:
+    """A decoded log; `key_codes` and `intervals` are read-only sequences"""
+
+    __slots__ = ('key_codes', 'intervals', 'text_hash', 'text', '_codec')
+
+    def __init__(self, key_codes, intervals, codec, text_hash=None, text=None):
+        self.key_codes = key_codes
+        self.intervals = intervals
+        # Hash of the text typed, and the text itself if it was embedded
+        self.text_hash = text_hash
+        self.text = text
+        self._codec = codec
+
+    def __len__(self):
+        return len(self.intervals)
+
+    @property
+    def keys(self):
+        """The typed characters as a string"""
+        return bytes(self.key_codes).decode(self._codec) if _LITTLE_ENDIAN else ''.join(map(chr, self.key_codes))
+
+
+def text_hash(text):
+    """Hash a log stores to identify the text it was typed from"""
+    return hashlib.sha256(text.encode()).digest()[:HASH_SIZE]
+
+
+def _key_format(keys):
+    highest = max(map(ord, keys), default=0)
+    if highest < 0x100:
+        return 0
+    # UTF-16 code units are only usable below the surrogate range
+    if highest < 0xD800:
+        return 1
+    return 2
+
+
+def encode(keys, intervals, text, embed_text=False):
+    """Pack typed characters and their millisecond gaps into a blob.
+
+    The blob records a hash of `text`; with embed_text, the text itself too.
+    """
+    if len(keys) != len(intervals):
+        raise ValueError("keys and intervals must have the same length")
+    key_format = _key_format(keys)
+    _, _, codec = KEY_FORMATS[key_format]
+    key_bytes = keys.encode(codec)
+    timings = array('H', (min(max(int(gap), 0), MAX_TIMING_MS) for gap in intervals))
+    if not _LITTLE_ENDIAN:
+        timings.byteswap()
+    body = key_bytes + timings.tobytes()
+
+    flags = key_format << WIDTH_SHIFT
+    if embed_text:
+        body += text.encode()
+        flags |= FLAG_TEXT
+    if COMPRESS and len(body) >= COMPRESS_MIN_BYTES:
+        packed = zlib.compress(body, COMPRESS_LEVEL)
+        if len(packed) < len(body):
+            body = packed
+            flags |= FLAG_COMPRESSED
+    return HEADER.pack(VERSION, flags, len(keys)) + text_hash(text) + body
+
+
+def decode(blob):
+    """Unpack a blob from encode() into a KeystrokeLog"""
+    version, flags, count = HEADER.unpack_from(blob)
+    if version not in (1, VERSION):
+        raise ValueError(f"Unsupported keystroke log version {version}")
+    width, typecode, codec = KEY_FORMATS[(flags & WIDTH_MASK) >> WIDTH_SHIFT]
+
+    body = memoryview(blob)[HEADER.size:]
+    digest = None
+    if version >= 2:
+        digest = bytes(body[:HASH_SIZE])
+        body = body[HASH_SIZE:]
+    if flags & FLAG_COMPRESSED:
+        body = memoryview(zlib.decompress(body))
+    keys_end = count * width
+    timings_end = keys_end + count * 2
+    if len(body) < timings_end or (len(body) != timings_end and not flags & FLAG_TEXT):
+        raise ValueError("Truncated keystroke log")
+    text = str(body[timings_end:], 'utf-8') if flags & FLAG_TEXT else None
+
+    if _LITTLE_ENDIAN:
+        return KeystrokeLog(body[:keys_end].cast(typecode), body[keys_end:timings_end].cast('H'),
+                            codec, digest, text)
+    # Big-endian hosts have to copy to swap bytes
+    key_codes = array(typecode, body[:keys_end])
+    intervals = array('H', body[keys_end:timings_end])
+    if width > 1:
+        key_codes.byteswap()
+    intervals.byteswap()
+    return KeystrokeLog(key_codes, intervals, codec, digest, text)
+
+
+def analyze(keys, intervals, text):
+    """Return per-key and per-bigram counters for one test.
+
+    Keys map each expected character to [attempts, errors, timed, total_ms]
+    and bigrams map two correctly typed characters to [count, total_ms].
+    A keystroke's time is the gap before it; the first keystroke's gap is
+    reaction time rather than typing, so it is not timed.
+    """
+    key_stats = {}
+    bigram_stats = {}
+    previous_ok = False
+    for index, (typed, expected, gap) in enumerate(zip(keys, text, intervals)):
+        stats = key_stats.get(expected)
+        if stats is None:
+            stats = key_stats[expected] = [0, 0, 0, 0]
+        stats[0] += 1
+        ok = typed == expected
+        if not ok:
+            stats[1] += 1
+        elif index:
+            stats[2] += 1
+            stats[3] += gap
+            if previous_ok:
+                bigram = text[index - 1:index + 1]
+                pair = bigram_stats.get(bigram)
+                if pair is None:
+                    pair = bigram_stats[bigram] = [0, 0]
+                pair[0] += 1
+                pair[1] += gap
+        previous_ok = ok
+    return key_stats, bigram_stats
@@ -0,0 +1,154 @@
+"""Reusable SMTP sender.
+
+Opening a connection, STARTTLS and logging in costs a few round trips per
+message, so the sender keeps one authenticated connection open and reuses
+it for every message (and for whole batches) until it has been idle for
+IDLE_TIMEOUT seconds. Transports are pluggable: SMTPTransport talks to a
+real server, FakeTransport records messages for tests.
+"""
+import os
+import smtplib
+import threading
+import time
+
+import metrics
+
+MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+MAIL_PORT = int(os.environ.get('MAIL_PORT', 587))
+MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', '1') not in ('0', 'false', 'False')
+MAIL_TIMEOUT = float(os.environ.get('MAIL_TIMEOUT', 10))
+IDLE_TIMEOUT = float(os.environ.get('MAIL_IDLE_TIMEOUT', 60))
+
+
+class SendError(Exception):
+    """A batch that failed part-way; the first `sent` messages were delivered"""
+
+    def __init__(self, sent, error):
+        super().__init__(f"{error} (after {sent} message(s) sent)")
+        self.sent = sent
+        self.error = error
+
+
+class SMTPTransport:
+    """Opens authenticated SMTP connections"""
+
+    def __init__(self, host=MAIL_SERVER, port=MAIL_PORT, use_tls=MAIL_USE_TLS,
+                 username=None, password=None, timeout=MAIL_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username if username is not None else os.environ.get('MAIL_USERNAME')
+        self.password = password if password is not None else os.environ.get('MAIL_PASSWORD')
+        self.timeout = timeout
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+
+class FakeTransport:
+    """Records sent messages instead of talking to a server"""
+
+    def __init__(self):
+        self.sent = []
+        self.connections = 0
+
+    def connect(self):
+        self.connections += 1
+        return self
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+    def noop(self):
+        return (250, b'OK')
+
+    def quit(self):
+        pass
+
+
+class Mailer:
+    """Sends messages over a pooled, reused connection"""
+
+    def __init__(self, transport=None):
+        self.transport = transport or SMTPTransport()
+        self._server = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._server is not None and time.monotonic() - self._last_used > IDLE_TIMEOUT:
+            self._close()
+        if self._server is None:
+            with metrics.external('smtp', 'connect'):
+                self._server = self.transport.connect()
+        return self._server
+
+    def _close(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                pass
+
+    def _send_one(self, msg):
+        try:
+            server = self._connection()
+            with metrics.external('smtp', 'send'):
+                server.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, OSError):
+            self._close()
+            server = self._connection()
+            with metrics.external('smtp', 'send'):
+                server.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def send_many(self, messages):
+        """Send messages in order over one connection, reconnecting once if it dropped.
+
+        Raises SendError on the first message that cannot be sent, so callers
+        know which ones were already delivered and must not be sent again.
+        """
+        with self._lock:
+            for sent, msg in enumerate(messages):
+                try:
+                    self._send_one(msg)
+                except Exception as e:
+                    raise SendError(sent, e) from e
+
+    def send(self, msg):
+        """Send a single message"""
+        self.send_many([msg])
+
+    def close(self):
+        """Close the pooled connection"""
+        with self._lock:
+            self._close()
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def get_mailer():
+    """Return the process-wide mailer"""
+    global _mailer
+    with _mailer_lock:
+        if _mailer is None:
+            _mailer = Mailer()
+        return _mailer
+
+
+def set_transport(transport):
+    """Replace the process-wide mailer's transport (e.g. FakeTransport in tests)"""
+    global _mailer
+    with _mailer_lock:
+        if _mailer is not None:
+            _mailer.close()
+        _mailer = Mailer(transport)
+        return _mailer
@@ -0,0 +1,648 @@
+"""Maintenance commands for the TypingMaster database.
+
+Usage:
+    python manage.py init-db
+    python manage.py rebuild-aggregates
+    python manage.py check-aggregates
+    python manage.py rebuild-key-stats
+    python manage.py rebuild-leaderboard
+    python manage.py check-leaderboard
+    python manage.py check-plans [--user-id N]
+    python manage.py reset-streaks
+    python manage.py recompute-streaks
+    python manage.py stress-streaks [--db PATH] [--threads N] [--submits N] [--timezone TZ]
+    python manage.py import-results FILE [--format ndjson|csv] [--batch-size N]
+    python manage.py archive-results [--days N] [--dry-run]
+    python manage.py export-results [--user-id N] [--format ndjson|csv] [--output FILE]
+    python manage.py run-jobs
+    python manage.py job-stats
+    python manage.py benchmark-passwords [--logins N]
+    python manage.py corpus-stats
+    python manage.py benchmark-scoring [--tests N]
+    python manage.py startup-report [--top N]
+    python manage.py benchmark-startup [--runs N] [--target-ms MS]
+    python manage.py seed-benchmark PATH [--users N] [--results N] [--days N] [--seed N]
+    python manage.py benchmark-routes PATH [--mode test-client|http|both] [--requests N]
+                                           [--workers N] [--output FILE] [--compare FILE]
+    python manage.py serve-races [--port N]
+    python manage.py benchmark-races PATH [--rooms N] [--players N] [--keys-per-second N]
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+import archive
+import benchmark
+import cache
+import corpus
+import database
+import db_pool
+import jobs
+import migrations
+import passwords
+import scoring
+
+
+def cmd_init_db(args):
+    applied = migrations.migrate()
+    if applied:
+        print(f"Applied migrations: {', '.join(str(version) for version in applied)}")
+    print(f"Database at schema version {migrations.current_version()}")
+    return 0
+
+
+def cmd_rebuild_aggregates(args):
+    database.init_db()
+    database.rebuild_user_aggregates()
+    print("User aggregates rebuilt")
+    return 0
+
+
+def cmd_rebuild_key_stats(args):
+    database.init_db()
+    texts = corpus.get_corpus()
+
+    def text_for_id(text_id):
+        passage = texts.get(text_id) if text_id is not None else None
+        return passage['text'] if passage else None
+
+    skipped = database.rebuild_key_stats(text_for_id)
+    print(f"Key stats rebuilt ({skipped} log(s) skipped: passage no longer in the corpus or changed)")
+    return 0
+
+
+def cmd_check_aggregates(args):
+    database.init_db()
+    mismatches = database.check_user_aggregates()
+    for user_id, column, stored, expected in mismatches:
+        print(f"user {user_id}: {column} is {stored}, expected {expected}")
+    if mismatches:
+        print(f"{len(mismatches)} inconsistent value(s); run rebuild-aggregates to repair")
+        return 1
+    print("User aggregates are consistent")
+    return 0
+
+
+def cmd_rebuild_leaderboard(args):
+    database.init_db()
+    database.rebuild_leaderboard()
+    print("Leaderboard rebuilt")
+    return 0
+
+
+def cmd_check_leaderboard(args):
+    database.init_db()
+    differences = database.check_leaderboard(limit=args.limit)
+    for difference in differences:
+        print(difference)
+    if differences:
+        print(f"{len(differences)} difference(s); run rebuild-leaderboard to repair")
+        return 1
+    print("Leaderboard matches typing_results")
+    return 0
+
+
+def cmd_check_plans(args):
+    database.init_db()
+    full_scans = database.check_query_plans(args.user_id)
+    for sql, detail in full_scans:
+        print(f"{detail}: {sql}")
+    if full_scans:
+        print(f"{len(full_scans)} full table scan(s) on hot queries")
+        return 1
+    print("No full table scans on hot queries")
+    return 0
+
+
+def _import_rows(path, file_format):
+    """Yield (line number, row dict) from an NDJSON or CSV file without loading it whole"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if file_format == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError:
+                    yield line_number, None
+
+
+def cmd_import_results(args):
+    database.init_db()
+    file_format = args.format or ('csv' if args.path.lower().endswith('.csv') else 'ndjson')
+    user_ids = {}
+
+    def resolve_user(row):
+        if row.get('user_id') not in (None, ''):
+            return int(row['user_id'])
+        email = row.get('email')
+        if email not in user_ids:
+            user = database.get_user_by_email(email) if email else None
+            user_ids[email] = user['id'] if user else None
+        return user_ids[email]
+
+    imported = unknown = 0
+    invalid = []
+    batch = []
+
+    def flush():
+        nonlocal imported, unknown
+        outcomes = database.bulk_record_results(batch)
+        saved = sum(outcome['saved'] for outcome in outcomes.values())
+        imported += saved
+        unknown += len(batch) - saved
+        batch.clear()
+
+    start = time.perf_counter()
+    for line_number, row in _import_rows(args.path, file_format):
+        try:
+            user_id = resolve_user(row)
+            result = {
+                'user_id': user_id,
+                'wpm': float(row['wpm']),
+                'accuracy': float(row['accuracy']),
+                'test_duration': int(float(row.get('test_duration') or row.get('duration') or 60)),
+                'taken_at': database.to_utc_timestamp(row['taken_at']) if row.get('taken_at') else None,
+            }
+        except (AttributeError, KeyError, TypeError, ValueError):
+            invalid.append(line_number)
+            continue
+        if user_id is None:
+            unknown += 1
+            continue
+        batch.append(result)
+        if len(batch) >= args.batch_size:
+            flush()
+    if batch:
+        flush()
+    elapsed = time.perf_counter() - start
+
+    print(f"Imported {imported} result(s) in {elapsed:.2f}s ({imported / max(elapsed, 1e-9):.0f}/s)")
+    if unknown:
+        print(f"Skipped {unknown} result(s) for unknown users")
+    if invalid:
+        print(f"Skipped {len(invalid)} invalid row(s), e.g. line(s) {', '.join(map(str, invalid[:10]))}")
+    return 0
+
+
+def cmd_archive_results(args):
+    database.init_db()
+    moved = archive.archive_results(days=args.days, dry_run=args.dry_run, progress=print)
+    total = sum(moved.values())
+    if args.dry_run:
+        print(f"{total} result(s) in {len(moved)} month(s) before {archive.horizon(args.days)} would be archived")
+    else:
+        print(f"Archived {total} result(s) from {len(moved)} month(s) to {archive.archive_dir()}")
+    return 0
+
+
+def cmd_export_results(args):
+    database.init_db()
+    encode, _ = archive.FORMATS[args.format]
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for line in encode(archive.export_results(args.user_id)):
+            out.write(line)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+def cmd_reset_streaks(args):
+    database.init_db()
+    start = time.perf_counter()
+    reset = database.reset_broken_streaks()
+    print(f"Reset {reset} broken streak(s) in {time.perf_counter() - start:.2f}s")
+    return 0
+
+
+def cmd_recompute_streaks(args):
+    database.init_db()
+    start = time.perf_counter()
+    changed = database.recompute_streaks()
+    print(f"Recomputed streaks from typing_results in {time.perf_counter() - start:.2f}s ({changed} user(s) changed)")
+    return 0
+
+
+def cmd_stress_streaks(args):
+    """Hammer two fresh users with concurrent submits and check nothing was lost.
+
+    Runs against a new scratch database (--db, or a temporary file that is
+    removed afterwards), never the one in DB_PATH.
+    """
+    if args.db:
+        if os.path.exists(args.db):
+            print(f"{args.db} already exists; stress-streaks needs a new scratch file")
+            return 1
+        db_pool.configure(args.db)
+        return _stress_streaks(args)
+    with tempfile.TemporaryDirectory(prefix='stress-streaks-') as directory:
+        db_pool.configure(os.path.join(directory, 'stress.db'))
+        try:
+            return _stress_streaks(args)
+        finally:
+            db_pool.close_all()
+
+
+def _stress_streaks(args):
+    database.init_db()
+    stamp = time.time_ns()
+    continuing = database.create_user('Stress Continuing', f'stress-{stamp}-a@example.invalid', '')
+    fresh = database.create_user('Stress Fresh', f'stress-{stamp}-b@example.invalid', '')
+    for user_id in (continuing, fresh):
+        database.set_user_timezone(user_id, args.timezone)
+    yesterday = database.local_date(args.timezone) - timedelta(days=1)
+    with db_pool.transaction() as conn:
+        conn.execute('UPDATE users SET current_streak = 4, longest_streak = 4, last_test_date = ? WHERE id = ?',
+                     (yesterday.isoformat(), continuing))
+    cache.invalidate(f'user:{continuing}')
+
+    errors = []
+    def submit(thread_index):
+        try:
+            for i in range(args.submits):
+                user_id = continuing if (thread_index + i) % 2 else fresh
+                database.record_typing_result(user_id, 30 + (thread_index * 7 + i) % 50, 95.0, 60)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db_pool.release()
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    total = args.threads * args.submits
+    print(f"{total} concurrent submits from {args.threads} thread(s) in {elapsed:.2f}s ({total / elapsed:.0f}/s)")
+
+    failures = [f"submit failed: {e}" for e in errors]
+    conn = database.get_db_connection()
+    for user_id, expected_streak in ((continuing, 5), (fresh, 1)):
+        user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        results = conn.execute('SELECT COUNT(*) FROM typing_results WHERE user_id = ?', (user_id,)).fetchone()[0]
+        streak_badges = conn.execute(
+            "SELECT COUNT(*) FROM badges WHERE user_id = ? AND title LIKE '% Day Streak'", (user_id,)
+        ).fetchone()[0]
+        if user['current_streak'] != expected_streak:
+            failures.append(f"user {user_id}: streak is {user['current_streak']}, expected {expected_streak}")
+        if user['total_tests'] != results:
+            failures.append(f"user {user_id}: total_tests is {user['total_tests']} for {results} result(s)")
+        if user['last_test_date'] != database.local_date(args.timezone).isoformat():
+            failures.append(f"user {user_id}: last_test_date is {user['last_test_date']}")
+        if streak_badges != (1 if expected_streak in database.STREAK_MILESTONES else 0):
+            failures.append(f"user {user_id}: {streak_badges} streak badge(s)")
+    failures += [f"user {user_id}: {column} is {stored}, expected {expected}"
+                 for user_id, column, stored, expected in database.check_user_aggregates()]
+    failures += database.check_leaderboard()
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        print(f"{len(failures)} problem(s) after concurrent submits")
+        return 1
+    print("Streaks, totals, aggregates and leaderboard are consistent")
+    return 0
+
+
+def cmd_run_jobs(args):
+    database.init_db()
+    processed = jobs.run_pending()
+    print(f"Processed {processed} job(s)")
+    return 0
+
+
+def cmd_job_stats(args):
+    database.init_db()
+    for status, count in jobs.queue_stats().items():
+        print(f"{status}: {count}")
+    return 0
+
+
+def cmd_benchmark_passwords(args):
+    for algorithm in ('scrypt', 'pbkdf2_sha256'):
+        print(f"{algorithm}: calibrated to {passwords.calibrate(algorithm)} for {passwords.TARGET_MS:.0f} ms")
+
+    stored = passwords.hash_password('benchmark-password')
+    print(f"Active: {passwords.ALGORITHM} {passwords.current_params()}, "
+          f"{passwords.WORKERS} worker(s), queue {passwords.QUEUE_SIZE}")
+
+    start = time.perf_counter()
+    passwords.verify_password('benchmark-password', stored)
+    print(f"Single verify: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # A burst of concurrent logins: admitted ones finish, the rest are rejected fast
+    results = {'ok': 0, 'busy': 0}
+    def login():
+        try:
+            passwords.verify_password('benchmark-password', stored)
+            results['ok'] += 1
+        except passwords.HashingBusy:
+            results['busy'] += 1
+    threads = [threading.Thread(target=login) for _ in range(args.logins)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(f"Burst of {args.logins}: {results['ok']} verified, {results['busy']} rejected as busy "
+          f"in {elapsed:.2f}s ({results['ok'] / elapsed:.1f} verifies/s)")
+    return 0
+
+
+def cmd_corpus_stats(args):
+    start = time.perf_counter()
+    texts = corpus.Corpus(corpus.read_passages())
+    print(f"Loaded from {corpus.CORPUS_DIR} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for name, value in texts.stats().items():
+        print(f"{name}: {value}")
+
+    picks = 10000
+    start = time.perf_counter()
+    for i in range(picks):
+        texts.choose(duration=60, difficulty='hard', focus='punctuation', user_key=i % 100)
+    print(f"Selection: {(time.perf_counter() - start) / picks * 1e6:.1f} us per passage")
+    return 0
+
+
+def cmd_benchmark_scoring(args):
+    texts = corpus.get_corpus()
+    rng = random.Random(0)
+    logs = []
+    passage_ids = texts.ids()
+    for _ in range(args.tests):
+        text = texts.text(rng.choice(passage_ids))
+        keys = ''.join(ch if rng.random() > 0.05 else '#' for ch in text)
+        logs.append((keys, [rng.randrange(60, 300) for _ in keys], text, 0))
+
+    start = time.perf_counter()
+    for log in logs:
+        scoring.score(*log)
+    elapsed = time.perf_counter() - start
+    print(f"score(): {args.tests / elapsed:.0f} tests/s")
+
+    backend = scoring.batch_backend()
+    start = time.perf_counter()
+    scoring.score_many(logs)
+    elapsed = time.perf_counter() - start
+    print(f"score_many() ({backend}): {args.tests / elapsed:.0f} tests/s")
+    return 0
+
+
+# Run in a fresh interpreter: imports app and prints its startup steps as JSON
+_STARTUP_SCRIPT = '''
+import json, time
+started = time.perf_counter()
+import app, metrics
+print(json.dumps({'import_ms': (time.perf_counter() - started) * 1000, 'steps': metrics.startup_report()}))
+'''
+
+
+def _cold_start(lazy=True, importtime=False):
+    """Import app in a new process; returns (report dict, importtime lines)"""
+    env = dict(os.environ, LAZY_STARTUP='1' if lazy else '0')
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', _STARTUP_SCRIPT]
+    completed = subprocess.run(command, capture_output=True, text=True, env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'import failed')
+    report = json.loads(completed.stdout.strip().splitlines()[-1])
+    lines = [line for line in completed.stderr.splitlines() if line.startswith('import time:')]
+    return report, lines
+
+
+def cmd_startup_report(args):
+    report, lines = _cold_start(lazy=not args.eager, importtime=True)
+    print(f"import app: {report['import_ms']:.1f} ms ({'eager' if args.eager else 'lazy'} startup)")
+    for step, seconds in report['steps']:
+        print(f"  {step:<16} {seconds * 1000:8.1f} ms")
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    local = {name[:-3] for name in os.listdir(here) if name.endswith('.py')}
+    modules = []
+    for line in lines[1:]:
+        self_us, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        modules.append((name, int(self_us) / 1000, int(cumulative_us) / 1000))
+    print("\nProject modules (self / cumulative ms):")
+    for name, self_ms, cumulative_ms in sorted((m for m in modules if m[0] in local), key=lambda m: -m[2]):
+        print(f"  {name:<16} {self_ms:8.1f} {cumulative_ms:8.1f}")
+    print("\nHeaviest third-party packages (cumulative ms):")
+    third_party = [m for m in modules if '.' not in m[0] and m[0] not in local and m[0] not in sys.stdlib_module_names]
+    for name, _, cumulative_ms in sorted(third_party, key=lambda m: -m[2])[:args.top]:
+        print(f"  {name:<16} {cumulative_ms:8.1f}")
+    return 0
+
+
+def cmd_benchmark_startup(args):
+    database.init_db()
+    timings = []
+    for _ in range(args.runs):
+        report, _ = _cold_start(lazy=not args.eager)
+        timings.append(report['import_ms'])
+    median = statistics.median(timings)
+    print(f"Cold import of app over {args.runs} run(s): min {min(timings):.1f} ms, "
+          f"median {median:.1f} ms, max {max(timings):.1f} ms (target {args.target_ms:.0f} ms)")
+    if median > args.target_ms:
+        print("Cold start is over target; run startup-report to see where the time goes")
+        return 1
+    return 0
+
+
+def cmd_seed_benchmark(args):
+    start = time.perf_counter()
+    try:
+        benchmark.seed(args.path, users=args.users, results=args.results, days=args.days, seed=args.seed,
+                       progress=print)
+    except FileExistsError as e:
+        print(f"Error: {e}")
+        return 1
+    print(f"Seeded {args.path} in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+def cmd_benchmark_routes(args):
+    modes = benchmark.MODES if args.mode == 'both' else (args.mode,)
+    routes = args.routes.split(',') if args.routes else tuple(benchmark.ROUTES)
+    unknown = [route for route in routes if route not in benchmark.ROUTES]
+    if unknown:
+        print(f"Unknown route(s): {', '.join(unknown)} (choose from {', '.join(benchmark.ROUTES)})")
+        return 2
+    report = benchmark.run(args.path, modes=modes, routes=routes, requests=args.requests, warmup=args.warmup,
+                           workers=args.workers, active_users=args.active_users, seed=args.seed, progress=print)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        regressions = benchmark.compare(previous, report, args.threshold)
+        for route, mode, description in regressions:
+            print(f"REGRESSION {mode} {route}: {description}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+
+def cmd_serve_races(args):
+    import races
+
+    print(f"Race server listening on port {args.port}")
+    races.serve(args.port, host=args.host)
+    return 0
+
+
+def cmd_benchmark_races(args):
+    report = benchmark.race_load(args.path, rooms=args.rooms, players=args.players,
+                                 keys_per_second=args.keys_per_second, duration=args.duration,
+                                 countdown_ms=args.countdown_ms, workers=args.workers,
+                                 timeout=args.timeout, seed=args.seed, progress=print)
+    server = report['server']
+    print(f"{report['racers']} racers in {args.rooms} rooms finished {report['finished']} races "
+          f"in {report['seconds']}s; {report['saved']} results saved, {report['rejected']} rejected, "
+          f"{report['errors']} errors")
+    print(f"Messages: {server['messages_in']} in, {server['messages_out']} out, "
+          f"{server['states_dropped']} state updates coalesced away, {server['slow_consumers']} slow consumers")
+    print(f"Keystroke to broadcast: p50 {report['echo_p50_ms']} ms, p99 {report['echo_p99_ms']} ms; "
+          f"tick p99 {server['tick_p99_ms']} ms, tick lag p99 {server['tick_lag_p99_ms']} ms; "
+          f"connect p99 {report['connect_p99_ms']} ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0 if report['errors'] == 0 and report['finished'] == report['racers'] else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TypingMaster maintenance commands")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('init-db', help="create or upgrade the schema").set_defaults(func=cmd_init_db)
+    subparsers.add_parser('rebuild-aggregates', help="recompute user_aggregates from typing_results").set_defaults(func=cmd_rebuild_aggregates)
+    subparsers.add_parser('check-aggregates', help="verify user_aggregates against typing_results").set_defaults(func=cmd_check_aggregates)
+    subparsers.add_parser('rebuild-key-stats', help="recompute key/bigram counters from keystroke logs").set_defaults(func=cmd_rebuild_key_stats)
+
+    subparsers.add_parser('rebuild-leaderboard', help="recompute the materialized leaderboard").set_defaults(func=cmd_rebuild_leaderboard)
+    check_leaderboard = subparsers.add_parser('check-leaderboard', help="compare the leaderboard with the full JOIN query")
+    check_leaderboard.add_argument('--limit', type=int, default=None, help="only compare the top N rows")
+    check_leaderboard.set_defaults(func=cmd_check_leaderboard)
+
+    check_plans = subparsers.add_parser('check-plans', help="EXPLAIN the dashboard and leaderboard queries")
+    check_plans.add_argument('--user-id', type=int, default=1, help="user whose dashboard queries are explained")
+    check_plans.set_defaults(func=cmd_check_plans)
+
+    subparsers.add_parser('reset-streaks', help="zero streaks that lapsed (run nightly)").set_defaults(func=cmd_reset_streaks)
+    subparsers.add_parser('recompute-streaks', help="rebuild every streak from typing_results").set_defaults(func=cmd_recompute_streaks)
+    stress_streaks = subparsers.add_parser('stress-streaks', help="check streaks under concurrent submits (scratch database)")
+    stress_streaks.add_argument('--db', help="new scratch database to keep (default: a temporary file)")
+    stress_streaks.add_argument('--threads', type=int, default=8, help="concurrent submitting threads")
+    stress_streaks.add_argument('--submits', type=int, default=50, help="submits per thread")
+    stress_streaks.add_argument('--timezone', default='Pacific/Kiritimati', help="timezone of the test users")
+    stress_streaks.set_defaults(func=cmd_stress_streaks)
+
+    import_results = subparsers.add_parser('import-results', help="bulk-load results from an NDJSON or CSV file")
+    import_results.add_argument('path', help="file with user_id or email, wpm, accuracy, duration and taken_at per row")
+    import_results.add_argument('--format', choices=('ndjson', 'csv'), help="default: from the file extension")
+    import_results.add_argument('--batch-size', type=int, default=5000, help="results written per transaction")
+    import_results.set_defaults(func=cmd_import_results)
+
+    archive_results = subparsers.add_parser('archive-results', help="move old results to per-month cold partitions")
+    archive_results.add_argument('--days', type=int, default=None,
+                                 help=f"archive whole months older than this (default {archive.ARCHIVE_AFTER_DAYS})")
+    archive_results.add_argument('--dry-run', action='store_true', help="only count what would be moved")
+    archive_results.set_defaults(func=cmd_archive_results)
+
+    export_results = subparsers.add_parser('export-results', help="stream result history from the hot and cold tiers")
+    export_results.add_argument('--user-id', type=int, default=None, help="one user's results (default: everyone's)")
+    export_results.add_argument('--format', choices=tuple(archive.FORMATS), default='ndjson')
+    export_results.add_argument('--output', help="file to write (default: standard output)")
+    export_results.set_defaults(func=cmd_export_results)
+
+    subparsers.add_parser('run-jobs', help="run due background jobs in the foreground").set_defaults(func=cmd_run_jobs)
+    subparsers.add_parser('job-stats', help="show pending/running/dead job counts").set_defaults(func=cmd_job_stats)
+
+    benchmark_passwords = subparsers.add_parser('benchmark-passwords', help="calibrate and time password hashing")
+    benchmark_passwords.add_argument('--logins', type=int, default=50, help="size of the concurrent login burst")
+    benchmark_passwords.set_defaults(func=cmd_benchmark_passwords)
+
+    subparsers.add_parser('corpus-stats', help="load the typing corpus and time passage selection").set_defaults(func=cmd_corpus_stats)
+
+    benchmark_scoring = subparsers.add_parser('benchmark-scoring', help="time server-side scoring of keystroke logs")
+    benchmark_scoring.add_argument('--tests', type=int, default=5000, help="number of synthetic tests to score")
+    benchmark_scoring.set_defaults(func=cmd_benchmark_scoring)
+
+    startup_report = subparsers.add_parser('startup-report', help="time app import and startup, per step and module")
+    startup_report.add_argument('--top', type=int, default=10, help="third-party packages to list")
+    startup_report.add_argument('--eager', action='store_true', help="report the non-lazy (long-lived server) startup")
+    startup_report.set_defaults(func=cmd_startup_report)
+
+    benchmark_startup = subparsers.add_parser('benchmark-startup', help="check the cold-start import time of app")
+    benchmark_startup.add_argument('--runs', type=int, default=5, help="fresh interpreters to time")
+    benchmark_startup.add_argument('--target-ms', type=float, default=300, help="fail when the median import is slower")
+    benchmark_startup.add_argument('--eager', action='store_true', help="time the non-lazy startup instead")
+    benchmark_startup.set_defaults(func=cmd_benchmark_startup)
+
+    seed_benchmark = subparsers.add_parser('seed-benchmark', help="create a synthetic database for benchmark-routes")
+    seed_benchmark.add_argument('path', help="new SQLite file to create")
+    seed_benchmark.add_argument('--users', type=int, default=1000, help="number of users")
+    seed_benchmark.add_argument('--results', type=int, default=100_000, help="number of typing results")
+    seed_benchmark.add_argument('--days', type=int, default=365, help="spread results over this many past days")
+    seed_benchmark.add_argument('--seed', type=int, default=0, help="random seed, for reproducible data")
+    seed_benchmark.set_defaults(func=cmd_seed_benchmark)
+
+    benchmark_routes = subparsers.add_parser('benchmark-routes', help="measure throughput and latency of the core routes")
+    benchmark_routes.add_argument('path', help="database created by seed-benchmark (it is written to)")
+    benchmark_routes.add_argument('--mode', choices=('test-client', 'http', 'both'), default='both')
+    benchmark_routes.add_argument('--routes', help=f"comma-separated subset of: {', '.join(benchmark.ROUTES)}")
+    benchmark_routes.add_argument('--requests', type=int, default=1000, help="timed requests per route and mode")
+    benchmark_routes.add_argument('--warmup', type=int, default=100, help="untimed requests before each run")
+    benchmark_routes.add_argument('--workers', type=int, default=4, help="client processes in http mode")
+    benchmark_routes.add_argument('--active-users', type=int, default=1000, help="seeded users requests are spread over")
+    benchmark_routes.add_argument('--seed', type=int, default=0)
+    benchmark_routes.add_argument('--output', help="write the results as JSON to this file")
+    benchmark_routes.add_argument('--compare', help="previous JSON results; exit 1 on regressions")
+    benchmark_routes.add_argument('--threshold', type=float, default=benchmark.REGRESSION_THRESHOLD,
+                                  help="relative slowdown that counts as a regression")
+    benchmark_routes.set_defaults(func=cmd_benchmark_routes)
+
+    serve_races = subparsers.add_parser('serve-races', help="run the WebSocket race server")
+    serve_races.add_argument('--port', type=int, default=int(os.environ.get('RACE_PORT', 8765)))
+    serve_races.add_argument('--host', default='0.0.0.0')
+    serve_races.set_defaults(func=cmd_serve_races)
+
+    benchmark_races = subparsers.add_parser('benchmark-races', help="drive simulated racers against a race server")
+    benchmark_races.add_argument('path', help="database created by seed-benchmark (results are written to it)")
+    benchmark_races.add_argument('--rooms', type=int, default=1000)
+    benchmark_races.add_argument('--players', type=int, default=4, help="racers per room")
+    benchmark_races.add_argument('--keys-per-second', type=float, default=6, help="typing rate of each racer")
+    benchmark_races.add_argument('--duration', type=int, default=15, help="passage length in seconds, as for /typing-text")
+    benchmark_races.add_argument('--countdown-ms', type=int, default=10000, help="time for every racer to connect")
+    benchmark_races.add_argument('--workers', type=int, default=4, help="client processes")
+    benchmark_races.add_argument('--timeout', type=int, default=300, help="seconds before the run is abandoned")
+    benchmark_races.add_argument('--seed', type=int, default=0)
+    benchmark_races.add_argument('--output', help="write the results as JSON to this file")
+    benchmark_races.set_defaults(func=cmd_benchmark_races)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
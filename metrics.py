@@ -0,0 +1,446 @@
+"""Request, database and external-call instrumentation.
+
+Everything is kept in process as counters and fixed-bucket histograms and
+exposed in the Prometheus text format by render() (served at /metrics):
+
+    http_request_duration_seconds{method, route, status}
+    db_call_duration_seconds{function}      every public database.py function
+    db_call_errors_total{function}
+    external_call_duration_seconds{service, operation}   edge_tts, smtp, google
+    external_call_errors_total{service, operation}
+    template_render_duration_seconds{template}
+
+plus the read cache's counters. Routes are labelled by their URL rule
+("/badges/<asset_key>.svg"), never by the raw path, so label sets stay
+bounded. Each response also carries a Server-Timing header splitting the
+request into db, render and external time, which shows up in the browser's
+network panel.
+
+With several worker processes every worker keeps its own numbers; scrape
+each one, or aggregate in Prometheus.
+
+Setting PROFILE_SLOW_REQUEST_MS turns on a sampling profiler: a background
+thread samples the stacks of threads that are serving a request every
+PROFILE_INTERVAL_MS, and requests slower than the threshold get their
+samples written to PROFILE_DIR in the folded format that flamegraph.pl and
+speedscope read ("frame;frame;frame count" per line).
+"""
+import bisect
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from functools import wraps
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1') not in ('0', 'false', 'False')
+# When set, /metrics requires "Authorization: Bearer <token>"; without it,
+# /metrics only answers requests from the local host
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles' if os.name == 'nt' else '/tmp/profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 200))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers a cached lookup up to a slow external call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """A monotonically increasing count per label set"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Gauge(Counter):
+    """A value that is set rather than counted, per label set"""
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    """Observations counted into fixed buckets, per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            return sum(state[0]) if state else 0
+
+    def quantile(self, fraction, *labels):
+        """Upper bound of the bucket holding the given quantile (0.0 without observations)"""
+        with self._lock:
+            state = self._values.get(labels)
+            counts = list(state[0]) if state else []
+        total = sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= fraction * total:
+                return bound
+        return 0.0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(state[0]), state[1])) for labels, state in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}'
+
+
+_metrics = []
+_collectors = []
+
+
+def counter(name, documentation, labelnames=()):
+    """Create and register a Counter"""
+    metric = Counter(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name, documentation, labelnames=()):
+    """Create and register a Gauge"""
+    metric = Gauge(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    """Create and register a Histogram"""
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def add_collector(collect):
+    """Register a callback returning [(name, kind, documentation, value)] at scrape time"""
+    _collectors.append(collect)
+
+
+def authorized(authorization, remote_addr):
+    """Whether a /metrics request may be served, from its Authorization header and peer address"""
+    if not METRICS_TOKEN:
+        return remote_addr in LOCAL_ADDRESSES
+    # Compared as bytes: compare_digest rejects non-ASCII str
+    supplied = (authorization or '').encode('utf-8', 'surrogatepass')
+    return hmac.compare_digest(supplied, f'Bearer {METRICS_TOKEN}'.encode())
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    for collect in _collectors:
+        try:
+            values = collect()
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+            continue
+        for name, kind, documentation, value in values:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_DURATION = histogram('http_request_duration_seconds', "Time spent handling requests",
+                             ('method', 'route', 'status'))
+DB_DURATION = histogram('db_call_duration_seconds', "Time spent in database.py functions, including cache hits",
+                        ('function',))
+DB_ERRORS = counter('db_call_errors_total', "database.py calls that raised", ('function',))
+EXTERNAL_DURATION = histogram('external_call_duration_seconds', "Time spent waiting on external services",
+                              ('service', 'operation'))
+EXTERNAL_ERRORS = counter('external_call_errors_total', "External calls that raised", ('service', 'operation'))
+RENDER_DURATION = histogram('template_render_duration_seconds', "Time spent rendering Jinja templates",
+                            ('template',))
+STARTUP_SECONDS = gauge('startup_step_seconds', "Time taken by each step of process startup", ('step',))
+PROFILES_WRITTEN = counter('slow_request_profiles_total', "Slow-request profiles written to PROFILE_DIR")
+
+_started_at = time.time()
+add_collector(lambda: [('process_start_time_seconds', 'gauge', "Start time of the process", _started_at)])
+
+
+_startup_steps = []
+
+
+@contextmanager
+def startup_step(name):
+    """Time one step of process startup (imports, schema check, ...)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup(name, time.perf_counter() - start)
+
+
+def record_startup(name, seconds):
+    """Record how long a startup step took"""
+    _startup_steps.append((name, seconds))
+    STARTUP_SECONDS.set(seconds, name)
+
+
+def startup_report():
+    """[(step, seconds)] in the order the steps ran"""
+    return list(_startup_steps)
+
+
+# Per-thread split of the current request's time, for Server-Timing
+_local = threading.local()
+
+
+def _add_time(part, seconds):
+    breakdown = getattr(_local, 'breakdown', None)
+    if breakdown is not None:
+        breakdown[part] += seconds
+
+
+def instrument(func, name=None):
+    """Wrap a database function so every call is timed and counted"""
+    if not ENABLED:
+        return func
+    name = name or func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # Nested database calls are timed individually but only the outermost
+        # one counts towards the request's db time
+        depth = getattr(_local, 'db_depth', 0)
+        _local.db_depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _local.db_depth = depth
+            DB_DURATION.observe(elapsed, name)
+            if not depth:
+                _add_time('db', elapsed)
+    return wrapper
+
+
+def instrument_module(namespace, exclude=()):
+    """Instrument every public function defined in a module's globals()"""
+    module = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if (not name.startswith('_') and name not in exclude and callable(value)
+                and not isinstance(value, type) and getattr(value, '__module__', None) == module):
+            namespace[name] = instrument(value, name)
+
+
+@contextmanager
+def external(service, operation):
+    """Time a call to an external service"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        EXTERNAL_ERRORS.inc(service, operation)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        EXTERNAL_DURATION.observe(elapsed, service, operation)
+        _add_time('external', elapsed)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    module = frame.f_globals.get('__name__') or os.path.basename(code.co_filename)
+    return f'{code.co_name} ({module}:{code.co_firstlineno})'
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of request threads and keeps those of slow requests"""
+
+    def __init__(self, threshold_ms=PROFILE_SLOW_REQUEST_MS, interval_ms=PROFILE_INTERVAL_MS,
+                 directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES):
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.directory = directory
+        self.max_files = max_files
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None or thread_id == me:
+                        continue
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_name(frame))
+                        frame = frame.f_back
+                    stacks[';'.join(reversed(names))] += 1
+                frames = frame = None
+
+    def begin(self):
+        """Start sampling the calling thread"""
+        self._start()
+        with self._lock:
+            self._active[threading.get_ident()] = StackCounter()
+
+    def end(self, elapsed_ms, label):
+        """Stop sampling the calling thread; write its stacks if the request was slow"""
+        with self._lock:
+            stacks = self._active.pop(threading.get_ident(), None)
+        if not stacks or elapsed_ms < self.threshold_ms:
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            slug = ''.join(ch if ch.isalnum() else '_' for ch in label).strip('_')
+            path = os.path.join(self.directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{slug}-{elapsed_ms:.0f}ms.folded')
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            self._prune()
+        except OSError as e:
+            print(f"Error writing request profile: {e}")
+            return None
+        PROFILES_WRITTEN.inc()
+        return path
+
+    def _prune(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.folded'))
+        for name in names[:max(len(names) - self.max_files, 0)]:
+            os.remove(os.path.join(self.directory, name))
+
+
+profiler = SlowRequestProfiler() if PROFILE_SLOW_REQUEST_MS > 0 else None
+
+
+def init_app(app):
+    """Time every request, template render and (optionally) profile slow requests"""
+    if not ENABLED:
+        return
+    from flask import before_render_template, g, request, template_rendered
+
+    @app.before_request
+    def start_timer():
+        _local.breakdown = {'db': 0.0, 'render': 0.0, 'external': 0.0}
+        g.metrics_start = time.perf_counter()
+        if profiler is not None:
+            profiler.begin()
+
+    @app.after_request
+    def record(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_DURATION.observe(elapsed, request.method, route, str(response.status_code))
+
+        breakdown = getattr(_local, 'breakdown', None) or {}
+        timings = [f'{part};dur={seconds * 1000:.1f}' for part, seconds in breakdown.items() if seconds]
+        timings.append(f'total;dur={elapsed * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+        if profiler is not None:
+            profiler.end(elapsed * 1000, f'{request.method} {route}')
+        return response
+
+    @app.teardown_request
+    def finish(exc):
+        _local.breakdown = None
+        # after_request does not run when a view raises
+        if profiler is not None and g.pop('metrics_start', None) is not None:
+            profiler.end(0, '')
+
+    def render_started(sender, template, context, **extra):
+        _local.render_start = time.perf_counter()
+
+    def render_finished(sender, template, context, **extra):
+        start = getattr(_local, 'render_start', None)
+        if start is not None:
+            elapsed = time.perf_counter() - start
+            RENDER_DURATION.observe(elapsed, template.name or 'string')
+            _add_time('render', elapsed)
+            _local.render_start = None
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
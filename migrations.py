@@ -0,0 +1,433 @@
+"""Versioned schema migrations.
+
+Each migration is a (version, name, function) entry in MIGRATIONS. Pending
+migrations run in order at startup, each in its own transaction, and the
+applied version is recorded in the schema_version table. Migrations are
+written to be safe on databases created before versioning existed, so the
+early ones check for tables/columns before creating them.
+
+To change the schema, append a new migration; never edit one that has
+already shipped.
+"""
+import os
+import re
+import sqlite3
+
+import archive
+import badges
+import corpus
+from db_pool import get_connection, transaction
+
+
+def _table_exists(conn, name):
+    """Check whether a table exists"""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    return row is not None
+
+
+def _column_exists(conn, table, column):
+    """Check whether a table has a column"""
+    return any(row['name'] == column for row in conn.execute(f'PRAGMA table_info({table})'))
+
+
+def _initial_schema(conn):
+    """Create the original users, typing_results and badges tables"""
+    # Users table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT,
+            google_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            current_streak INTEGER DEFAULT 0,
+            longest_streak INTEGER DEFAULT 0,
+            last_test_date DATE,
+            total_tests INTEGER DEFAULT 0,
+            verified BOOLEAN DEFAULT 0
+        )
+    ''')
+
+    # Typing results table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS typing_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            wpm REAL NOT NULL,
+            accuracy REAL NOT NULL,
+            test_duration INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Badges table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS badges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            badge_type TEXT NOT NULL,
+            title TEXT NOT NULL,
+            description TEXT,
+            image_path TEXT,
+            earned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+def _users_best_wpm(conn):
+    """Denormalize each user's best WPM onto the users row"""
+    if _column_exists(conn, 'users', 'best_wpm'):
+        return
+    conn.execute('ALTER TABLE users ADD COLUMN best_wpm REAL DEFAULT 0')
+    conn.execute('''
+        UPDATE users SET best_wpm = COALESCE(
+            (SELECT MAX(wpm) FROM typing_results WHERE user_id = users.id), 0)
+    ''')
+
+
+def _user_aggregates(conn):
+    """Add and backfill per-user running aggregates"""
+    if _table_exists(conn, 'user_aggregates'):
+        return
+    # Running per-user totals, kept in step with typing_results
+    conn.execute('''
+        CREATE TABLE user_aggregates (
+            user_id INTEGER PRIMARY KEY,
+            result_count INTEGER NOT NULL DEFAULT 0,
+            wpm_sum REAL NOT NULL DEFAULT 0,
+            wpm_sq_sum REAL NOT NULL DEFAULT 0,
+            wpm_max REAL NOT NULL DEFAULT 0,
+            accuracy_sum REAL NOT NULL DEFAULT 0,
+            accuracy_sq_sum REAL NOT NULL DEFAULT 0,
+            accuracy_max REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO user_aggregates
+            (user_id, result_count, wpm_sum, wpm_sq_sum, wpm_max, accuracy_sum, accuracy_sq_sum, accuracy_max)
+        SELECT user_id, COUNT(*), SUM(wpm), SUM(wpm * wpm), MAX(wpm),
+               SUM(accuracy), SUM(accuracy * accuracy), MAX(accuracy)
+        FROM typing_results
+        GROUP BY user_id
+    ''')
+
+
+def _leaderboard_entries(conn):
+    """Add and backfill the materialized leaderboard"""
+    if _table_exists(conn, 'leaderboard_entries'):
+        return
+    # Materialized ranking, one row per user with results
+    conn.execute('''
+        CREATE TABLE leaderboard_entries (
+            user_id INTEGER PRIMARY KEY,
+            best_wpm REAL NOT NULL,
+            avg_accuracy REAL NOT NULL,
+            avg_wpm REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_leaderboard_rank
+        ON leaderboard_entries (best_wpm DESC, avg_accuracy DESC, user_id)
+    ''')
+    conn.execute('''
+        INSERT INTO leaderboard_entries (user_id, best_wpm, avg_accuracy, avg_wpm)
+        SELECT user_id, wpm_max, accuracy_sum / result_count, wpm_sum / result_count
+        FROM user_aggregates
+        WHERE result_count > 0
+    ''')
+
+
+def _hot_query_indexes(conn):
+    """Index the per-user lookups behind the dashboard"""
+    # get_user_stats: recent results and badges per user, newest first
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_typing_results_user_created
+        ON typing_results (user_id, created_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_badges_user_earned
+        ON badges (user_id, earned_at)
+    ''')
+    # get_leaderboard / get_all_users / get_user_rank read leaderboard_entries
+    # through idx_leaderboard_rank, created with the table.
+
+
+def _badge_assets(conn):
+    """Add the shared, content-addressed badge image table"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS badge_assets (
+            asset_key TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _job_queue(conn):
+    """Add the background job queue and its dead-letter table"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_at REAL NOT NULL,
+            locked_until REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, run_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_kind_due ON jobs (kind, status, run_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dead_jobs (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _keystroke_logs(conn):
+    """Add per-result keystroke blobs and per-user key/bigram counters"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS typing_keystrokes (
+            result_id INTEGER PRIMARY KEY,
+            text_id INTEGER,
+            data BLOB NOT NULL,
+            FOREIGN KEY (result_id) REFERENCES typing_results (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_key_stats (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            timed INTEGER NOT NULL DEFAULT 0,
+            total_ms INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, key),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_bigram_stats (
+            user_id INTEGER NOT NULL,
+            bigram TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            total_ms INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, bigram),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _progress_rollups(conn):
+    """Add per-user daily/weekly/monthly result buckets and backfill them"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS progress_rollups (
+            user_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            result_count INTEGER NOT NULL DEFAULT 0,
+            wpm_sum REAL NOT NULL DEFAULT 0,
+            wpm_max REAL NOT NULL DEFAULT 0,
+            accuracy_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, period, bucket),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    # Buckets start on the (server-local) day, the Monday of the week and
+    # the first of the month, matching database._rollup_buckets
+    for period, modifiers in (('day', ""), ('week', ", 'weekday 0', '-6 days'"), ('month', ", 'start of month'")):
+        conn.execute(f'''
+            INSERT INTO progress_rollups (user_id, period, bucket, result_count, wpm_sum, wpm_max, accuracy_sum)
+            SELECT user_id, ?, date(created_at, 'localtime'{modifiers}),
+                   COUNT(*), SUM(wpm), MAX(wpm), SUM(accuracy)
+            FROM typing_results
+            GROUP BY user_id, 3
+        ''', (period,))
+
+
+def _user_timezones(conn):
+    """Add users.timezone and an index of live streaks by last test date"""
+    # NULL means the server's local time, which streaks were counted in before
+    if not _column_exists(conn, 'users', 'timezone'):
+        conn.execute('ALTER TABLE users ADD COLUMN timezone TEXT')
+    # Lets the nightly streak reset read only streaks that may have lapsed
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_live_streaks
+        ON users (last_test_date) WHERE current_streak > 0
+    ''')
+
+
+
+def _result_archive(conn):
+    """Add the cold partition catalog, archived per-user totals and a created_at index"""
+    # archive.py picks whole months older than the horizon through this index
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_typing_results_created ON typing_results (created_at)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive_partitions (
+            month TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            result_count INTEGER NOT NULL DEFAULT 0,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Totals of the results moved to cold partitions, so aggregates can be
+    # rebuilt and checked without opening them
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archived_totals (
+            user_id INTEGER PRIMARY KEY,
+            result_count INTEGER NOT NULL DEFAULT 0,
+            wpm_sum REAL NOT NULL DEFAULT 0,
+            wpm_sq_sum REAL NOT NULL DEFAULT 0,
+            wpm_max REAL NOT NULL DEFAULT 0,
+            accuracy_sum REAL NOT NULL DEFAULT 0,
+            accuracy_sq_sum REAL NOT NULL DEFAULT 0,
+            accuracy_max REAL NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+# WPM milestones as of migration 12; older badges named the exact WPM reached
+_WPM_BADGE_THRESHOLDS = {
+    'Lightning Fingers': 100,
+    'Speed Demon': 80,
+    'Fast Typer': 60,
+    'Speed Boost': 40,
+}
+
+
+def _shared_badge_images(conn):
+    """Point badges from before badge_assets at shared images"""
+    rows = conn.execute('''
+        SELECT id, title, description FROM badges
+        WHERE image_path IS NULL OR image_path NOT LIKE '/badges/%'
+    ''').fetchall()
+    updates = []
+    for row in rows:
+        description = row['description']
+        threshold = _WPM_BADGE_THRESHOLDS.get(row['title'])
+        if threshold and re.fullmatch(r'Achieved \d+ WPM!', description or ''):
+            description = f"Achieved {threshold} WPM!"
+        key = badges.badge_key(row['title'], description)
+        conn.execute(
+            'INSERT OR IGNORE INTO badge_assets (asset_key, title, description) VALUES (?, ?, ?)',
+            (key, row['title'], description)
+        )
+        updates.append((description, badges.badge_url(key), row['id']))
+    conn.executemany('UPDATE badges SET description = ?, image_path = ? WHERE id = ?', updates)
+
+
+def _stable_passage_ids(conn):
+    """Replace positional text_ids in keystroke logs with content-derived passage ids"""
+    # Until now a passage's id was its position in load order, counting
+    # every non-empty passage with a positive weight
+    mapping = []
+    for text, weight in corpus.read_passages():
+        if ' '.join(text.split()) and weight > 0:
+            mapping.append((corpus.passage_id(text), len(mapping)))
+    if not mapping:
+        return
+    remap = 'UPDATE typing_keystrokes SET text_id = ? WHERE text_id = ?'
+    conn.executemany(remap, mapping)
+
+    # Logs moved to cold partitions (archive.py) carry the same ids
+    if not _table_exists(conn, 'archive_partitions'):
+        return
+    for (filename,) in conn.execute('SELECT filename FROM archive_partitions').fetchall():
+        path = os.path.join(archive.archive_dir(), filename)
+        if not os.path.exists(path):
+            continue
+        cold = sqlite3.connect(path)
+        try:
+            with cold:
+                cold.executemany(remap, mapping)
+        finally:
+            cold.close()
+
+
+def _data_versions(conn):
+    """Add shared per-tag versions, which page ETags are built from"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            tag TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+
+
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'users.best_wpm', _users_best_wpm),
+    (3, 'user_aggregates', _user_aggregates),
+    (4, 'leaderboard_entries', _leaderboard_entries),
+    (5, 'hot query indexes', _hot_query_indexes),
+    (6, 'badge_assets', _badge_assets),
+    (7, 'job queue', _job_queue),
+    (8, 'keystroke logs', _keystroke_logs),
+    (9, 'progress rollups', _progress_rollups),
+    (10, 'user timezones', _user_timezones),
+    (11, 'result archive', _result_archive),
+    (12, 'shared badge images', _shared_badge_images),
+    (13, 'stable passage ids', _stable_passage_ids),
+    (14, 'data versions', _data_versions),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn=None):
+    """Return the highest applied migration version (0 for a new database)"""
+    conn = conn or get_connection()
+    if not _table_exists(conn, 'schema_version'):
+        return 0
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(target=None):
+    """Apply pending migrations up to `target` (default: latest).
+
+    Returns the list of versions that were applied.
+    """
+    target = LATEST_VERSION if target is None else target
+    # Usual case at startup: already current, so answer from one read and
+    # skip the write transactions below
+    if current_version() >= target:
+        return []
+    with transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    applied = []
+    for version, name, upgrade in MIGRATIONS:
+        if version > target:
+            break
+        # Re-check inside the write lock so concurrent workers starting up
+        # together apply each migration exactly once.
+        with transaction() as conn:
+            if current_version(conn) >= version:
+                continue
+            upgrade(conn)
+            conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+        applied.append(version)
+    return applied
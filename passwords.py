@@ -0,0 +1,180 @@
+"""Password hashing with self-calibrating KDF parameters.
+
+Hashes are stored with their algorithm and parameters:
+
+    scrypt$<n>$<r>$<p>$<salt>$<hash>
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+
+Legacy unsalted SHA-256 hex digests are still accepted and flagged for
+rehashing, so they are upgraded on the next successful login.
+
+KDF work is CPU-bound, so it runs on a small bounded executor: at most
+PASSWORD_HASH_WORKERS hashes run at once and at most PASSWORD_HASH_QUEUE
+more wait. Anything beyond that fails fast with HashingBusy instead of
+tying up request workers behind a burst of logins.
+
+The cost parameter is calibrated once per process (on first use) to take
+roughly PASSWORD_HASH_TARGET_MS, never going below the MIN_* floors. Set
+PASSWORD_SCRYPT_N or PASSWORD_PBKDF2_ITERATIONS to pin it instead.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITHM = os.environ.get('PASSWORD_HASH_ALGORITHM', 'scrypt')
+TARGET_MS = float(os.environ.get('PASSWORD_HASH_TARGET_MS', 50))
+WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+QUEUE_SIZE = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+SCRYPT_R = 8
+SCRYPT_P = 1
+MIN_SCRYPT_N = 2 ** 14
+MAX_SCRYPT_N = 2 ** 20
+MIN_PBKDF2_ITERATIONS = 100_000
+MAX_PBKDF2_ITERATIONS = 5_000_000
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+class HashingBusy(RuntimeError):
+    """Raised when the hashing executor is saturated"""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r, dklen=KEY_BYTES)
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations, dklen=KEY_BYTES)
+
+
+def _time_ms(func):
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+def calibrate(algorithm=ALGORITHM, target_ms=TARGET_MS):
+    """Pick the cost parameter that takes about `target_ms` on this machine"""
+    salt = b'\0' * SALT_BYTES
+    if algorithm == 'scrypt':
+        n = MIN_SCRYPT_N
+        while n < MAX_SCRYPT_N and _time_ms(lambda: _scrypt('calibrate', salt, n, SCRYPT_R, SCRYPT_P)) < target_ms / 2:
+            n *= 2
+        return {'n': n}
+    if algorithm == 'pbkdf2_sha256':
+        sample = 20_000
+        elapsed = max(_time_ms(lambda: _pbkdf2('calibrate', salt, sample)), 0.001)
+        iterations = int(sample * target_ms / elapsed)
+        return {'iterations': max(MIN_PBKDF2_ITERATIONS, min(iterations, MAX_PBKDF2_ITERATIONS))}
+    raise ValueError(f"Unknown password hash algorithm {algorithm!r}")
+
+
+_params = None
+_params_lock = threading.Lock()
+
+
+def current_params():
+    """Return (calibrating on first call) the parameters for new hashes"""
+    global _params
+    with _params_lock:
+        if _params is None:
+            if ALGORITHM == 'scrypt' and os.environ.get('PASSWORD_SCRYPT_N'):
+                _params = {'n': int(os.environ['PASSWORD_SCRYPT_N'])}
+            elif ALGORITHM == 'pbkdf2_sha256' and os.environ.get('PASSWORD_PBKDF2_ITERATIONS'):
+                _params = {'iterations': int(os.environ['PASSWORD_PBKDF2_ITERATIONS'])}
+            else:
+                _params = calibrate()
+        return _params
+
+
+def _hash_now(password):
+    params = current_params()
+    salt = secrets.token_bytes(SALT_BYTES)
+    if ALGORITHM == 'scrypt':
+        digest = _scrypt(password, salt, params['n'], SCRYPT_R, SCRYPT_P)
+        return f"scrypt${params['n']}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+    digest = _pbkdf2(password, salt, params['iterations'])
+    return f"pbkdf2_sha256${params['iterations']}${_b64(salt)}${_b64(digest)}"
+
+
+def _verify_now(password, stored):
+    """Return (matches, needs_rehash)"""
+    parts = stored.split('$')
+    if parts[0] == 'scrypt' and len(parts) == 6:
+        n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        digest = _scrypt(password, _unb64(parts[4]), n, r, p)
+        matches = hmac.compare_digest(digest, _unb64(parts[5]))
+        weaker = ALGORITHM != 'scrypt' or n < current_params()['n']
+        return matches, matches and weaker
+    if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+        iterations = int(parts[1])
+        digest = _pbkdf2(password, _unb64(parts[2]), iterations)
+        matches = hmac.compare_digest(digest, _unb64(parts[3]))
+        weaker = ALGORITHM != 'pbkdf2_sha256' or iterations < current_params()['iterations']
+        return matches, matches and weaker
+    if len(stored) == 64:
+        # Legacy unsalted SHA-256
+        matches = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        return matches, matches
+    return False, False
+
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='password-hash')
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE_SIZE)
+
+
+def _run(func, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy("Too many password checks in progress")
+    try:
+        future = _executor.submit(func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(TIMEOUT)
+    except TimeoutError:
+        raise HashingBusy("Password check timed out")
+
+
+def hash_password(password):
+    """Hash a password with the configured KDF (raises HashingBusy when saturated)"""
+    return _run(_hash_now, password)
+
+
+def verify_password(password, stored):
+    """Check a password against a stored hash.
+
+    Returns (matches, new_hash). new_hash is set when the stored hash uses a
+    legacy or weaker scheme and should be replaced. Raises HashingBusy when
+    the executor is saturated.
+    """
+    if not password or not stored:
+        return False, None
+    matches, needs_rehash = _run(_verify_now, password, stored)
+    if not matches:
+        return False, None
+    if not needs_rehash:
+        return True, None
+    try:
+        return True, _run(_hash_now, password)
+    except HashingBusy:
+        # Upgrade on a later login rather than failing this one
+        return True, None
@@ -0,0 +1,264 @@
+"""Adaptive practice texts aimed at each user's weak keys.
+
+A word-level Markov chain is built once from the typing corpus and stored
+in compressed sparse row form: for word id w, its successors are
+successors[row_start[w]:row_start[w + 1]], with the transition counts
+next to them in `counts` and their running totals in `cumulative`, so
+drawing the next word is a bisect over one row. Words that begin a
+passage or follow a sentence end are the starting states.
+
+Each word is indexed by the keys and bigrams it contains (including the
+spaces around it). For a user, the keys they miss most and the bigrams
+they type slowest (get_key_stats) give every word a score, and a
+successor's transition count is multiplied by 1 + PRACTICE_BOOST * score.
+That per-user table is one array of running totals over all transitions,
+built when the user's stats change (their "user:<id>" cache tag moves)
+and kept for the PRACTICE_MODEL_USERS most recent users. Generating a
+passage is then a few dozen bisects.
+
+Generated texts are not corpus passages, so they carry a signed token
+that /submit-result accepts in place of text_id. Their keystroke logs are
+stored with the text embedded, so manage.py rebuild-key-stats replays
+them like any other.
+"""
+import bisect
+import os
+import random
+import threading
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+
+import cache
+import corpus
+import metrics
+
+MODEL_USERS = int(os.environ.get('PRACTICE_MODEL_USERS', 512))
+# How strongly a fully weak word is favoured over a neutral one
+BOOST = float(os.environ.get('PRACTICE_BOOST', 4))
+# Weak keys and slow bigrams taken from a user's stats
+TARGETS = int(os.environ.get('PRACTICE_TARGETS', 10))
+TOKEN_MAX_AGE = int(os.environ.get('PRACTICE_TOKEN_MAX_AGE', 7 * 24 * 3600))
+# A word's score is capped so one long word cannot take over the text
+MAX_SCORE = 3.0
+MIN_CHARS = 50
+MAX_CHARS = 2000
+# Words allowed past the target length while looking for a sentence end
+MAX_OVERRUN = 12
+SENTENCE_ENDS = ('.', '!', '?')
+
+MODEL_BUILDS = metrics.counter('practice_model_builds_total', "Practice transition tables built", ('kind',))
+
+
+class MarkovModel:
+    """Word transition table over a set of passages"""
+
+    def __init__(self, passages):
+        word_ids = {}
+        self.words = []
+        transitions = {}
+        starts = {}
+
+        def word_id(word):
+            index = word_ids.get(word)
+            if index is None:
+                index = word_ids[word] = len(self.words)
+                self.words.append(word)
+            return index
+
+        for text in passages:
+            previous = None
+            for word in text.split():
+                current = word_id(word)
+                if previous is None or self.words[previous].endswith(SENTENCE_ENDS):
+                    starts[current] = starts.get(current, 0) + 1
+                if previous is not None:
+                    row = transitions.get(previous)
+                    if row is None:
+                        row = transitions[previous] = {}
+                    row[current] = row.get(current, 0) + 1
+                previous = current
+
+        self.row_start = array('L', [0])
+        self.successors = array('L')
+        self.counts = array('L')
+        for source in range(len(self.words)):
+            row = transitions.get(source, {})
+            self.successors.extend(row)
+            self.counts.extend(row.values())
+            self.row_start.append(len(self.successors))
+        self.cumulative = self._running_totals(self.counts)
+
+        self.starts = array('L', starts)
+        self.start_counts = array('L', starts.values())
+        self.start_cumulative = array('d', accumulate(self.start_counts))
+
+        # Word ids per key and per bigram, once per occurrence
+        self.key_words = {}
+        self.bigram_words = {}
+        for index, word in enumerate(self.words):
+            for key in word:
+                self.key_words.setdefault(key, array('L')).append(index)
+            spaced = f' {word} '
+            for position in range(len(spaced) - 1):
+                self.bigram_words.setdefault(spaced[position:position + 2], array('L')).append(index)
+
+    def __len__(self):
+        return len(self.words)
+
+    def _running_totals(self, weights):
+        """Per-row running totals of one weight per transition"""
+        totals = array('d')
+        row_start = self.row_start
+        for source in range(len(self.words)):
+            totals.extend(accumulate(weights[row_start[source]:row_start[source + 1]]))
+        return totals
+
+    def word_weights(self, key_scores, bigram_scores):
+        """Weight of every word given {key: score} and {bigram: score} in [0, 1]"""
+        scores = array('d', bytes(8 * len(self.words)))
+        for index_map, item_scores in ((self.key_words, key_scores), (self.bigram_words, bigram_scores)):
+            for item, score in item_scores.items():
+                for index in index_map.get(item, ()):
+                    scores[index] += score
+        return array('d', (1 + BOOST * min(score, MAX_SCORE) for score in scores))
+
+    def tables(self, weights):
+        """(transition totals, start totals) biased towards heavily weighted successors"""
+        successors = self.successors
+        edge_weights = array('d', (count * weights[successors[i]] for i, count in enumerate(self.counts)))
+        start_weights = (count * weights[word] for word, count in zip(self.starts, self.start_counts))
+        return self._running_totals(edge_weights), array('d', accumulate(start_weights))
+
+    def _start(self, start_cumulative, rng):
+        position = bisect.bisect_right(start_cumulative, rng.random() * start_cumulative[-1])
+        return self.starts[min(position, len(self.starts) - 1)]
+
+    def generate(self, length, tables=None, rng=random):
+        """Walk the chain until the text is at least `length` characters, ending a sentence if one is near"""
+        cumulative, start_cumulative = tables or (self.cumulative, self.start_cumulative)
+        if not start_cumulative:
+            return ''
+        row_start = self.row_start
+        words = self.words
+        parts = []
+        size = -1
+        overrun = 0
+        current = self._start(start_cumulative, rng)
+        while True:
+            word = words[current]
+            parts.append(word)
+            size += len(word) + 1
+            if size >= length:
+                if word.endswith(SENTENCE_ENDS) or overrun >= MAX_OVERRUN:
+                    break
+                overrun += 1
+            low, high = row_start[current], row_start[current + 1]
+            if low == high:
+                current = self._start(start_cumulative, rng)
+                continue
+            position = bisect.bisect_right(cumulative, rng.random() * cumulative[high - 1], low, high - 1)
+            current = self.successors[position]
+        return ' '.join(parts)
+
+
+def weak_spots(stats):
+    """Turn get_key_stats() output into ({key: score}, {bigram: score}), scores in (0, 1]"""
+    missed = [row for row in stats.get('missed_keys', ()) if row['error_rate']]
+    slow = [row for row in stats.get('slow_bigrams', ()) if row['avg_ms']]
+    key_scores = {}
+    if missed:
+        worst = max(row['error_rate'] for row in missed)
+        key_scores = {row['key']: row['error_rate'] / worst for row in missed}
+    bigram_scores = {}
+    if slow:
+        slowest = max(row['avg_ms'] for row in slow)
+        bigram_scores = {row['bigram']: row['avg_ms'] / slowest for row in slow}
+    return key_scores, bigram_scores
+
+
+_model = None
+_model_corpus = None
+_model_lock = threading.Lock()
+_users = OrderedDict()
+_users_lock = threading.Lock()
+
+
+def get_model():
+    """Return the Markov model of the current corpus, building it on first use"""
+    global _model, _model_corpus
+    texts = corpus.get_corpus()
+    with _model_lock:
+        if _model_corpus is not texts:
+            _model = MarkovModel(texts.text(passage_id) for passage_id in texts.ids())
+            _model_corpus = texts
+            MODEL_BUILDS.inc('corpus')
+            with _users_lock:
+                _users.clear()
+        return _model
+
+
+def user_tables(user_id, load_stats):
+    """Return (tables, key_scores, bigram_scores) for a user, cached until their stats change"""
+    model = get_model()
+    version = cache.tag_versions(f'user:{user_id}')
+    with _users_lock:
+        entry = _users.get(user_id)
+        if entry is not None and entry[0] == version and entry[1] is model:
+            _users.move_to_end(user_id)
+            return entry[2]
+
+    key_scores, bigram_scores = weak_spots(load_stats(user_id, limit=TARGETS))
+    tables = None
+    if key_scores or bigram_scores:
+        tables = model.tables(model.word_weights(key_scores, bigram_scores))
+        MODEL_BUILDS.inc('user')
+    result = (tables, key_scores, bigram_scores)
+    with _users_lock:
+        _users[user_id] = (version, model, result)
+        _users.move_to_end(user_id)
+        while len(_users) > MODEL_USERS:
+            _users.popitem(last=False)
+    return result
+
+
+def _serializer(secret):
+    from itsdangerous import URLSafeTimedSerializer
+    return URLSafeTimedSerializer(secret, salt='practice')
+
+
+def make_token(text, secret):
+    """Sign a generated text so it can be submitted back"""
+    return _serializer(secret).dumps(text)
+
+
+def read_token(token, secret, max_age=TOKEN_MAX_AGE):
+    """Return the text a token was issued for, or None"""
+    from itsdangerous import BadSignature
+    try:
+        text = _serializer(secret).loads(token, max_age=max_age)
+    except BadSignature:
+        return None
+    return text if isinstance(text, str) and text else None
+
+
+def generate(user_id=None, duration=None, load_stats=None, rng=random):
+    """Generate a practice passage, biased to a signed-in user's weak keys.
+
+    Returns {'text', 'length', 'targets': {'keys', 'bigrams'}}, or None when
+    the corpus is empty.
+    """
+    model = get_model()
+    length = min(max(int((duration or 60) * corpus.CHARS_PER_SECOND), MIN_CHARS), MAX_CHARS)
+    tables, key_scores, bigram_scores = None, {}, {}
+    if user_id is not None and load_stats is not None:
+        tables, key_scores, bigram_scores = user_tables(user_id, load_stats)
+    text = model.generate(length, tables, rng)
+    if not text:
+        return None
+    return {
+        'text': text,
+        'length': corpus.LENGTHS[bisect.bisect_right(corpus.LENGTH_LIMITS, len(text))],
+        'targets': {'keys': sorted(key_scores, key=key_scores.get, reverse=True),
+                    'bigrams': sorted(bigram_scores, key=bigram_scores.get, reverse=True)},
+    }
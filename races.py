@@ -0,0 +1,525 @@
+"""Real-time typing races over WebSockets.
+
+A race server is a separate aiohttp process (`python manage.py serve-races`)
+next to the Flask app. Clients fetch a signed token from /race/token and
+connect to /race/ws?token=...[&room=CODE|new]: without a room they are
+matched into the public room that is filling up, "new" opens a private room
+whose code can be shared, and a code joins that room. Everyone in a room
+types the same passage from the corpus, picked as /typing-text would.
+
+Rooms wait for RACE_MIN_PLAYERS, count down for RACE_COUNTDOWN_MS (joining is
+allowed until the start) and race until everyone has finished or left, or
+RACE_TIME_LIMIT_S runs out. Client messages:
+
+    {"type": "progress", "typed": 57}      characters typed so far
+    {"type": "finish", "result": {...}}    the /submit-result body
+
+Progress only overwrites the player's latest value. One hub task ticks every
+RACE_TICK_MS and sends each room that changed a single "state" snapshot, so
+a room costs one JSON encode per tick however fast people type. Each
+connection has its own writer: the control messages (joined, countdown,
+start, result, finished) are queued, while a state snapshot replaces the
+unsent one, so a slow client skips intermediate states instead of building
+a backlog. A client whose socket has not accepted a message for
+RACE_SEND_TIMEOUT_S is disconnected.
+
+Finished races are scored and saved through the same path as /submit-result
+(app.save_submission) on a small thread pool, so the event loop never waits
+on SQLite. Saving a result bumps its shared tag versions in the database,
+so the Flask workers' pages (which build their ETags from those and drop
+their own cached reads when they move) show it on the next visit. Their
+JSON endpoints may serve a cached read for up to CACHE_TTL until then.
+"""
+import asyncio
+import json
+import os
+import secrets
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-here')
+RACE_PORT = int(os.environ.get('RACE_PORT', 8765))
+# Public URL of the race server handed out by /race/token; by default the
+# app's host on RACE_PORT
+RACE_URL = os.environ.get('RACE_URL')
+TOKEN_MAX_AGE = int(os.environ.get('RACE_TOKEN_MAX_AGE', 300))
+
+TICK_MS = float(os.environ.get('RACE_TICK_MS', 200))
+MIN_PLAYERS = int(os.environ.get('RACE_MIN_PLAYERS', 2))
+MAX_PLAYERS = int(os.environ.get('RACE_MAX_PLAYERS', 5))
+COUNTDOWN_MS = float(os.environ.get('RACE_COUNTDOWN_MS', 5000))
+TIME_LIMIT_S = float(os.environ.get('RACE_TIME_LIMIT_S', 300))
+# Passage length, as for /typing-text?duration=
+DURATION_S = int(os.environ.get('RACE_DURATION_S', 60))
+
+SEND_TIMEOUT_S = float(os.environ.get('RACE_SEND_TIMEOUT_S', 5))
+CONTROL_QUEUE = int(os.environ.get('RACE_CONTROL_QUEUE', 32))
+HEARTBEAT_S = float(os.environ.get('RACE_HEARTBEAT_S', 30))
+# A finish message carries the whole keystroke log
+MAX_MESSAGE_BYTES = int(os.environ.get('RACE_MAX_MESSAGE_BYTES', 512 * 1024))
+SAVE_WORKERS = int(os.environ.get('RACE_SAVE_WORKERS', 4))
+
+CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+CODE_LENGTH = 6
+
+MESSAGES = metrics.counter('race_messages_total', "WebSocket messages handled by the race hub", ('direction',))
+DROPPED = metrics.counter('race_states_dropped_total', "State snapshots replaced before a slow client took them")
+SLOW_CONSUMERS = metrics.counter('race_slow_consumers_total', "Race connections closed for not keeping up")
+RESULTS = metrics.counter('race_results_total', "Race results by outcome", ('outcome',))
+TICK_DURATION = metrics.histogram('race_tick_duration_seconds', "Time spent in one hub tick")
+TICK_LAG = metrics.histogram('race_tick_lag_seconds', "How late hub ticks started")
+
+
+class RaceError(Exception):
+    """A join that cannot be served"""
+    pass
+
+
+def _serializer(secret=None):
+    from itsdangerous import URLSafeTimedSerializer
+    return URLSafeTimedSerializer(secret or SECRET_KEY, salt='race')
+
+
+def make_token(user_id, name, secret=None):
+    """Sign a short-lived token identifying a user to the race server"""
+    return _serializer(secret).dumps({'id': user_id, 'name': name})
+
+
+def read_token(token, secret=None, max_age=TOKEN_MAX_AGE):
+    """Return {'id', 'name'} for a valid token, or None"""
+    from itsdangerous import BadSignature
+    try:
+        user = _serializer(secret).loads(token, max_age=max_age)
+    except BadSignature:
+        return None
+    if not isinstance(user, dict) or not isinstance(user.get('id'), int):
+        return None
+    return user
+
+
+def choose_passage():
+    """Pick the passage for a new room"""
+    import corpus
+    return corpus.get_corpus().choose(duration=DURATION_S)
+
+
+class Player:
+    """One connection in a room, with its own writer task"""
+
+    def __init__(self, user, ws):
+        self.user_id = user['id']
+        self.name = user.get('name') or f"Player {user['id']}"
+        self.ws = ws
+        self.progress = 0
+        self.finished_at = None
+        self.result = None
+        self.left = False
+        self.control = deque()
+        self.latest = None
+        self.closing = False
+        self.dropped = False
+        self.sending_since = None
+        self.wakeup = asyncio.Event()
+        self.writer = None
+
+    def send(self, message):
+        """Queue a control message"""
+        if len(self.control) >= CONTROL_QUEUE:
+            self.drop()
+            return
+        self.control.append(json.dumps(message))
+        self.wakeup.set()
+
+    def send_state(self, encoded):
+        """Offer the latest room snapshot, replacing one that was not sent yet"""
+        if self.latest is not None:
+            DROPPED.inc()
+            # Checked here rather than with a timeout on every send: a stuck
+            # client is noticed on the next tick that has news for it
+            if self.sending_since is not None and time.monotonic() - self.sending_since > SEND_TIMEOUT_S:
+                self.drop()
+                return
+        self.latest = encoded
+        self.wakeup.set()
+
+    def close(self):
+        """Close once the queued messages are sent"""
+        self.closing = True
+        self.wakeup.set()
+
+    def drop(self):
+        """Disconnect a client that stopped reading"""
+        if self.writer is not None and not self.dropped:
+            self.dropped = True
+            SLOW_CONSUMERS.inc()
+            self.writer.cancel()
+
+    async def write(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.control or self.latest is not None:
+                    if self.control:
+                        message = self.control.popleft()
+                    else:
+                        message, self.latest = self.latest, None
+                    self.sending_since = time.monotonic()
+                    await self.ws.send_str(message)
+                    self.sending_since = None
+                    MESSAGES.inc('out')
+                if self.closing:
+                    break
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            if not self.dropped:
+                raise
+        await self.ws.close()
+
+
+class Room:
+    """Players racing on one passage"""
+
+    def __init__(self, hub, code, passage, public):
+        self.hub = hub
+        self.code = code
+        self.passage = passage
+        self.length = len(passage['text'])
+        self.public = public
+        self.players = {}
+        self.state = 'waiting'
+        self.starts_at = None
+        self.deadline = None
+        self.started_at = None
+
+    def joinable(self):
+        return self.state in ('waiting', 'countdown') and len(self.players) < MAX_PLAYERS
+
+    def add(self, player, now):
+        self.players[player.user_id] = player
+        player.send({'type': 'joined', 'room': self.code, 'passage': self.passage,
+                     'state': self.state, 'starts_in_ms': self._starts_in(now)})
+        if self.state == 'waiting' and len(self.players) >= MIN_PLAYERS:
+            self.state = 'countdown'
+            self.starts_at = now + COUNTDOWN_MS / 1000
+            self.hub.timed.add(self)
+            self._announce({'type': 'countdown', 'starts_in_ms': COUNTDOWN_MS})
+        self.hub.dirty.add(self)
+
+    def remove(self, player, now):
+        if self.players.get(player.user_id) is not player:
+            return
+        if self.state == 'finished':
+            player.left = True
+            return
+        if self.state in ('waiting', 'countdown'):
+            del self.players[player.user_id]
+            if self.state == 'countdown' and len(self.players) < MIN_PLAYERS:
+                self.state = 'waiting'
+                self.starts_at = None
+                self.hub.timed.discard(self)
+                self._announce({'type': 'waiting'})
+        else:
+            player.left = True
+        if not any(not p.left for p in self.players.values()):
+            self.hub.close_room(self)
+            return
+        self.hub.dirty.add(self)
+        self.update(now)
+
+    def set_progress(self, player, typed):
+        if self.state != 'racing' or player.finished_at is not None:
+            return
+        if not isinstance(typed, int):
+            return
+        typed = min(max(typed, 0), self.length)
+        if typed != player.progress:
+            player.progress = typed
+            self.hub.dirty.add(self)
+
+    def finish(self, player, now):
+        """Mark a player done; returns False if the finish does not count"""
+        if self.state != 'racing' or player.finished_at is not None:
+            return False
+        player.finished_at = now
+        player.progress = self.length
+        self.hub.dirty.add(self)
+        return True
+
+    def record(self, player, outcome, now):
+        player.result = outcome
+        player.send(dict(outcome, type='result'))
+        self.hub.dirty.add(self)
+        self.update(now)
+
+    def update(self, now):
+        """Start the race or end it when its time has come"""
+        if self.state == 'countdown' and now >= self.starts_at:
+            self.state = 'racing'
+            self.started_at = now
+            self.deadline = now + TIME_LIMIT_S
+            if self.public and self.hub.open_room is self:
+                self.hub.open_room = None
+            self._announce({'type': 'start'})
+            self.hub.dirty.add(self)
+        elif self.state == 'racing':
+            saving = any(p.finished_at is not None and p.result is None for p in self.players.values())
+            done = all(p.left or p.result is not None for p in self.players.values())
+            if done or (now >= self.deadline and not saving):
+                self.state = 'finished'
+                self._announce({'type': 'finished', 'standings': self.standings()})
+                for player in self.players.values():
+                    player.close()
+                self.hub.close_room(self)
+
+    def standings(self):
+        finished = sorted((p for p in self.players.values()
+                           if p.result is not None and p.result.get('success')),
+                          key=lambda p: p.finished_at)
+        places = {p.user_id: place for place, p in enumerate(finished, 1)}
+        return [{
+            'id': p.user_id,
+            'name': p.name,
+            'progress': p.progress,
+            'place': places.get(p.user_id),
+            'wpm': p.result.get('wpm') if p.result else None,
+            'left': p.left,
+        } for p in self.players.values()]
+
+    def broadcast_state(self):
+        encoded = json.dumps({'type': 'state', 'state': self.state, 'players': self.standings()})
+        for player in self.players.values():
+            if not player.left:
+                player.send_state(encoded)
+
+    def _announce(self, message):
+        for player in self.players.values():
+            if not player.left:
+                player.send(message)
+
+    def _starts_in(self, now):
+        if self.starts_at is None:
+            return None
+        return max(round((self.starts_at - now) * 1000), 0)
+
+
+class Hub:
+    """All rooms of one race server and the ticker that drives them"""
+
+    def __init__(self, save_result, secret=None, pick_passage=choose_passage):
+        self.save_result = save_result
+        self.secret = secret
+        self.pick_passage = pick_passage
+        self.rooms = {}
+        self.open_room = None
+        self.timed = set()
+        self.dirty = set()
+        self.connections = 0
+        self.executor = ThreadPoolExecutor(max_workers=SAVE_WORKERS, thread_name_prefix='race-save')
+        self._ticker = None
+        self._saves = set()
+
+    def now(self):
+        return asyncio.get_running_loop().time()
+
+    def join(self, user, code, ws):
+        """Place a user in a room; returns (room, player) or raises RaceError"""
+        now = self.now()
+        if code == 'new':
+            room = self._create(public=False)
+        elif code:
+            room = self.rooms.get(code.upper())
+            if room is None or not room.joinable():
+                raise RaceError('Race not found or already started')
+        else:
+            room = self.open_room
+            if room is None or not room.joinable():
+                room = self.open_room = self._create(public=True)
+        if user['id'] in room.players:
+            raise RaceError('Already in this race')
+        player = Player(user, ws)
+        room.add(player, now)
+        if room is self.open_room and not room.joinable():
+            self.open_room = None
+        return room, player
+
+    def _create(self, public):
+        passage = self.pick_passage()
+        if passage is None:
+            raise RaceError('No typing texts available')
+        code = ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+        while code in self.rooms:
+            code = ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+        room = self.rooms[code] = Room(self, code, passage, public)
+        return room
+
+    def close_room(self, room):
+        self.rooms.pop(room.code, None)
+        self.timed.discard(room)
+        self.dirty.discard(room)
+        if self.open_room is room:
+            self.open_room = None
+
+    def tick(self, now):
+        for room in list(self.timed):
+            room.update(now)
+        dirty, self.dirty = self.dirty, set()
+        for room in dirty:
+            room.broadcast_state()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        interval = TICK_MS / 1000
+        next_tick = loop.time() + interval
+        while True:
+            delay = next_tick - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = loop.time()
+            TICK_LAG.observe(max(started - next_tick, 0))
+            try:
+                self.tick(started)
+            except Exception as e:
+                print(f"Error in race tick: {e}")
+            finished = loop.time()
+            TICK_DURATION.observe(finished - started)
+            # Skip ticks that were missed instead of running them back to back
+            next_tick = max(next_tick + interval, finished)
+
+    def handle(self, room, player, text):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        kind = data.get('type')
+        if kind == 'progress':
+            room.set_progress(player, data.get('typed'))
+        elif kind == 'finish' and room.finish(player, self.now()):
+            task = asyncio.ensure_future(self._save(room, player, data.get('result')))
+            self._saves.add(task)
+            task.add_done_callback(self._saves.discard)
+
+    async def _save(self, room, player, data):
+        if not isinstance(data, dict) or data.get('text_id') != room.passage['id']:
+            outcome = {'success': False, 'message': 'Result is for a different text'}
+        else:
+            try:
+                outcome = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.save_result, player.user_id, data)
+            except Exception as e:
+                print(f"Error saving race result: {e}")
+                outcome = {'success': False, 'message': 'Could not save the result'}
+        RESULTS.inc('saved' if outcome.get('success') else 'rejected')
+        room.record(player, outcome, self.now())
+
+    async def websocket(self, request):
+        from aiohttp import web, WSMsgType
+
+        user = read_token(request.query.get('token', ''), self.secret)
+        if user is None:
+            return web.json_response({'success': False, 'message': 'Invalid or expired race token'}, status=401)
+        ws = web.WebSocketResponse(heartbeat=HEARTBEAT_S, max_msg_size=MAX_MESSAGE_BYTES)
+        await ws.prepare(request)
+        try:
+            room, player = self.join(user, request.query.get('room'), ws)
+        except RaceError as e:
+            await ws.send_str(json.dumps({'type': 'error', 'message': str(e)}))
+            await ws.close()
+            return ws
+
+        self.connections += 1
+        player.writer = asyncio.ensure_future(player.write())
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.TEXT:
+                    MESSAGES.inc('in')
+                    self.handle(room, player, message.data)
+                elif message.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.connections -= 1
+            room.remove(player, self.now())
+            player.close()
+            await player.writer
+        return ws
+
+    def stats(self):
+        states = {}
+        for room in self.rooms.values():
+            states[room.state] = states.get(room.state, 0) + 1
+        return {
+            'rooms': len(self.rooms),
+            'rooms_by_state': states,
+            'connections': self.connections,
+            'messages_in': MESSAGES.value('in'),
+            'messages_out': MESSAGES.value('out'),
+            'states_dropped': DROPPED.value(),
+            'slow_consumers': SLOW_CONSUMERS.value(),
+            'results_saved': RESULTS.value('saved'),
+            'results_rejected': RESULTS.value('rejected'),
+            'tick_p99_ms': round(TICK_DURATION.quantile(0.99) * 1000, 2),
+            'tick_lag_p99_ms': round(TICK_LAG.quantile(0.99) * 1000, 2),
+        }
+
+    async def start(self, application):
+        self._ticker = asyncio.ensure_future(self.run())
+
+    async def stop(self, application):
+        self._ticker.cancel()
+        self.executor.shutdown(wait=True)
+
+
+def create_app(hub):
+    """aiohttp application serving /race/ws, /race/stats and /metrics"""
+    from aiohttp import web
+
+    async def race_stats(request):
+        return web.json_response(hub.stats())
+
+    async def metrics_endpoint(request):
+        if not metrics.ENABLED:
+            return web.json_response({'success': False, 'message': 'Metrics are disabled'}, status=404)
+        if not metrics.authorized(request.headers.get('Authorization'), request.remote):
+            return web.json_response({'success': False, 'message': 'Unauthorized'}, status=401)
+        return web.Response(body=metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    metrics.add_collector(lambda: [
+        ('race_rooms', 'gauge', "Open race rooms", len(hub.rooms)),
+        ('race_connections', 'gauge', "Connected racers", hub.connections),
+    ])
+    application = web.Application()
+    application.router.add_get('/race/ws', hub.websocket)
+    application.router.add_get('/race/stats', race_stats)
+    application.router.add_get('/metrics', metrics_endpoint)
+    application.on_startup.append(hub.start)
+    application.on_cleanup.append(hub.stop)
+    return application
+
+
+def raise_file_limit():
+    """Let the process hold as many sockets as the hard limit allows"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(port=RACE_PORT, host='0.0.0.0', save_result=None, secret=None):
+    """Run a race server until interrupted"""
+    from aiohttp import web
+
+    if save_result is None:
+        import app
+        save_result = app.save_submission
+    raise_file_limit()
+    hub = Hub(save_result, secret=secret)
+    web.run_app(create_app(hub), host=host, port=port, print=None, access_log=None)
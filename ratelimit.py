@@ -0,0 +1,258 @@
+"""Admission control for the expensive routes.
+
+Two independent checks, applied per route with @admit(...):
+
+Rate limits are token buckets keyed by client: the signed-in user, or the
+IP address for anonymous requests (and, for /login, also the account being
+tried). A rule "N/S" allows bursts of N and refills N tokens every S
+seconds. A request that finds its bucket empty gets 429 with Retry-After
+set to when a token will be back. A route can charge more than one token
+per request (admit(cost=...)), e.g. one per result of a batch upload. Buckets live in a BucketStore; the
+default is in-process, so with several workers each enforces its own share
+unless a shared store is installed with set_store().
+
+Concurrency gates cap how many requests of a kind run at once (TTS
+synthesis, SQLite writes). Up to `queue` more wait for at most
+ADMISSION_QUEUE_TIMEOUT; anything beyond that is turned away at once with
+503 and Retry-After. Keeping the number of concurrent writers small means
+a burst queues here, where the wait is bounded, instead of piling up on
+SQLite's lock until busy_timeout expires with "database is locked".
+
+Rejections, queue waits and gate occupancy are exported on /metrics.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import jsonify, make_response, request, session
+
+import metrics
+
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+# Behind a proxy (Vercel sets VERCEL=1) the client address is in X-Forwarded-For
+TRUST_PROXY = os.environ.get('RATE_LIMIT_TRUST_PROXY', '1' if os.environ.get('VERCEL') else '0') == '1'
+MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', 100_000))
+QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2))
+
+RULES = {
+    'login': os.environ.get('RATE_LIMIT_LOGIN', '10/60'),
+    'login-account': os.environ.get('RATE_LIMIT_LOGIN_ACCOUNT', '5/60'),
+    'signup': os.environ.get('RATE_LIMIT_SIGNUP', '5/3600'),
+    'submit': os.environ.get('RATE_LIMIT_SUBMIT', '20/60'),
+    # Charged per result in a /submit-results batch
+    'submit-results': os.environ.get('RATE_LIMIT_SUBMIT_RESULTS', '500/3600'),
+    'speech': os.environ.get('RATE_LIMIT_SPEECH', '30/60'),
+    'export': os.environ.get('RATE_LIMIT_EXPORT', '10/3600'),
+}
+
+REJECTED = metrics.counter('ratelimit_rejected_total', "Requests refused by a rate limit", ('rule',))
+SHED = metrics.counter('admission_rejected_total', "Requests refused because a concurrency gate was full", ('gate',))
+QUEUE_WAIT = metrics.histogram('admission_queue_wait_seconds', "Time spent waiting for a concurrency gate", ('gate',))
+ACTIVE = metrics.gauge('admission_active', "Requests holding a concurrency gate", ('gate',))
+WAITING = metrics.gauge('admission_waiting', "Requests queued for a concurrency gate", ('gate',))
+
+
+def parse_rule(rule):
+    """"N/S" -> (capacity N, refill rate in tokens per second)"""
+    count, _, seconds = rule.partition('/')
+    capacity = float(count)
+    return capacity, capacity / float(seconds or 1)
+
+
+class BucketStore:
+    """Storage interface for token buckets.
+
+    take() must be atomic per key. A shared store (e.g. Redis) would run
+    the same arithmetic server-side, in a script or transaction.
+    """
+
+    def take(self, key, capacity, rate, cost=1):
+        """Take `cost` tokens; return 0 if allowed, else seconds until they would be available"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryBucketStore(BucketStore):
+    """Thread-safe in-process buckets, least recently used dropped beyond max_buckets"""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0
+            else:
+                wait = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # A dropped bucket comes back full, which errs on the side of letting requests in
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class Gate:
+    """At most `limit` holders at once, `queue` more waiting up to `timeout` seconds"""
+
+    def __init__(self, name, limit, queue, timeout=QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Return True once admitted, False if the queue is full or the wait timed out"""
+        with self._cond:
+            if self.active < self.limit:
+                self._enter()
+                return True
+            if self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+            WAITING.set(self.waiting, self.name)
+            started = time.monotonic()
+            deadline = started + self.timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self._enter()
+                return True
+            finally:
+                self.waiting -= 1
+                WAITING.set(self.waiting, self.name)
+                QUEUE_WAIT.observe(time.monotonic() - started, self.name)
+
+    def _enter(self):
+        self.active += 1
+        ACTIVE.set(self.active, self.name)
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            ACTIVE.set(self.active, self.name)
+            self._cond.notify()
+
+
+_store = MemoryBucketStore()
+
+GATES = {
+    'speech': Gate('speech', int(os.environ.get('ADMISSION_SPEECH_CONCURRENCY', 4)),
+                   int(os.environ.get('ADMISSION_SPEECH_QUEUE', 16))),
+    'db-write': Gate('db-write', int(os.environ.get('ADMISSION_WRITE_CONCURRENCY', 4)),
+                     int(os.environ.get('ADMISSION_WRITE_QUEUE', 64))),
+}
+
+
+def set_store(store):
+    """Install a different bucket store (e.g. one shared across workers)"""
+    global _store
+    _store = store
+
+
+def get_store():
+    """Return the active bucket store"""
+    return _store
+
+
+def set_enabled(enabled):
+    """Turn rate limits on or off (e.g. for benchmarks); concurrency gates stay"""
+    global ENABLED
+    ENABLED = enabled
+
+
+def client_ip():
+    if TRUST_PROXY and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or 'unknown'
+
+
+def client_key():
+    """The signed-in user, or the IP address for anonymous requests"""
+    user_id = session.get('user_id')
+    return f'user:{user_id}' if user_id is not None else f'ip:{client_ip()}'
+
+
+def check(rule, key, cost=1):
+    """Take `cost` tokens from `key`'s bucket for `rule`; returns seconds to wait, 0 if allowed"""
+    capacity, rate = parse_rule(RULES[rule])
+    # More than a full bucket could never be allowed; it takes the whole bucket instead
+    return _store.take(f'{rule}:{key}', capacity, rate, min(cost, capacity))
+
+
+def too_many_requests(wait):
+    response = jsonify({'success': False, 'message': 'Too many requests, please slow down'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(math.ceil(wait), 1))
+    return response
+
+
+def server_busy(retry_after=1):
+    response = jsonify({'success': False, 'message': 'Server busy, please try again'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def admit(rule=None, gate=None, keys=None, cost=None):
+    """Apply rate limit `rule` and/or concurrency `gate` to a view.
+
+    `keys()` returns the bucket keys to charge (default: client_key()); the
+    request is refused if any of them is empty; stack two admit()s to charge
+    keys under different rules. `cost()` returns how many tokens the request
+    takes from each bucket (default 1). A gate is held while the view runs, and for
+    streamed responses until the response is closed.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if rule is not None and ENABLED:
+                tokens = cost() if cost else 1
+                for key in (keys() if keys else [client_key()]):
+                    wait = check(rule, key, tokens)
+                    if wait:
+                        REJECTED.inc(rule)
+                        return too_many_requests(wait)
+            if gate is None:
+                return view(*args, **kwargs)
+
+            held = GATES[gate]
+            if not held.acquire():
+                SHED.inc(gate)
+                return server_busy()
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                held.release()
+                raise
+            if response.is_streamed:
+                response.call_on_close(held.release)
+            else:
+                held.release()
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,213 @@
+"""Server-side scoring of typing tests from keystroke logs.
+
+The browser uploads what was typed rather than its own WPM figure:
+
+    {"text_id": 12, "keys": "The quikc brown", "intervals": [310, 95, 120, ...]}
+
+`keys` holds one character per keystroke and `intervals` the milliseconds
+since the previous keystroke (the first one is measured from the start of
+the test). Backspace is disabled, so keystroke i is an attempt at
+character i of the passage.
+
+score() rates one log. score_many() rates a batch: with NumPy installed
+the whole batch is flattened into a few arrays and reduced per test in
+one pass, otherwise it falls back to score() per log, which already runs
+its inner loops in C via map/Counter. Both return the same numbers.
+NumPy is only imported by the first batch, as it is slow to import.
+
+validate() compares a score with the numbers the client claimed and
+rejects impossible timing, so /submit-result never stores figures the
+keystrokes do not support.
+"""
+import os
+from array import array
+from collections import Counter
+from itertools import chain, compress
+from operator import eq, mul, ne
+
+MAX_KEYSTROKES = 10_000
+# Fewer keystrokes than this is not a test (about one word)
+MIN_KEYSTROKES = 5
+MAX_INTERVAL_MS = 60_000
+# Longest test a client may report
+MAX_DURATION_S = 3600
+MAX_WPM = float(os.environ.get('SCORING_MAX_WPM', 250))
+# Keystrokes closer together than this are implausible for a human...
+MIN_HUMAN_INTERVAL_MS = 8
+# ...when more than this share of a (long enough) test is made of them
+MAX_FAST_SHARE = 0.2
+MIN_KEYS_FOR_TIMING_CHECK = 20
+# How far the client's figures may exceed the server's
+WPM_TOLERANCE = 3
+ACCURACY_TOLERANCE = 2
+
+
+_numpy = False  # not imported yet
+
+
+def _get_numpy():
+    """NumPy, imported on first use, or None if it is not installed"""
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def batch_backend():
+    """Which implementation score_many() uses: 'numpy' or 'stdlib'"""
+    return 'numpy' if _get_numpy() is not None else 'stdlib'
+
+
+class InvalidLog(ValueError):
+    """Raised when a keystroke log is malformed or cannot be genuine"""
+
+    def __init__(self, message, code='invalid_log'):
+        super().__init__(message)
+        # Machine-readable reason, returned to clients next to the message
+        self.code = code
+
+
+# Sent to clients from before keystroke logs, which post only wpm and accuracy
+OUTDATED_CLIENT = "Results must include the keystroke log (keys and intervals); reload the page to update"
+
+
+def parse_log(data, text):
+    """Check an uploaded log against its passage; returns (keys, intervals)"""
+    keys = data.get('keys')
+    intervals = data.get('intervals')
+    if not isinstance(keys, str) or not isinstance(intervals, list):
+        raise InvalidLog("Missing keystroke log")
+    if len(keys) != len(intervals):
+        raise InvalidLog("Keystroke log is inconsistent")
+    if len(keys) < MIN_KEYSTROKES:
+        raise InvalidLog("Too few keystrokes to score")
+    if len(keys) > min(len(text), MAX_KEYSTROKES):
+        raise InvalidLog("Keystroke log is longer than the text")
+    try:
+        # Lone surrogates cannot be stored or scored
+        keys.encode('utf-8')
+    except UnicodeEncodeError:
+        raise InvalidLog("Keystroke log is not valid text")
+    try:
+        intervals = array('l', intervals)
+    except (TypeError, OverflowError):
+        raise InvalidLog("Keystroke timings must be integers")
+    if intervals and (min(intervals) < 0 or max(intervals) > MAX_INTERVAL_MS):
+        raise InvalidLog("Keystroke timings are out of range")
+    return keys, intervals
+
+
+def _consistency(count, total, squares):
+    """100 for perfectly even keystroke intervals, falling with their spread"""
+    if count < 2 or total <= 0:
+        return 100.0
+    mean = total / count
+    variance = max(squares / count - mean * mean, 0.0)
+    return max(0.0, 100.0 * (1 - variance ** 0.5 / mean))
+
+
+def _result(typed, correct, elapsed_ms, consistency, key_errors):
+    minutes = elapsed_ms / 60000
+    return {
+        'wpm': correct / 5 / minutes if minutes else 0.0,
+        'raw_wpm': typed / 5 / minutes if minutes else 0.0,
+        'accuracy': correct * 100 / typed if typed else 100.0,
+        'typed': typed,
+        'correct': correct,
+        'errors': typed - correct,
+        'elapsed_ms': elapsed_ms,
+        'consistency': consistency,
+        'key_errors': key_errors,
+    }
+
+
+def score(keys, intervals, text, duration_ms=0):
+    """Score one keystroke log against the passage it was typed from.
+
+    The test lasted until the last keystroke or `duration_ms` (when the
+    timer ran out), whichever is longer. `key_errors` maps each expected
+    character to [attempts, errors].
+    """
+    expected = text[:len(keys)]
+    matches = list(map(eq, keys, expected))
+    correct = sum(matches)
+
+    attempts = Counter(expected)
+    misses = Counter(compress(expected, map(ne, keys, expected)))
+    key_errors = {char: [count, misses.get(char, 0)] for char, count in attempts.items()}
+
+    gaps = intervals[1:]
+    consistency = _consistency(len(gaps), sum(gaps), sum(map(mul, gaps, gaps)))
+    elapsed_ms = max(sum(intervals), duration_ms)
+    return _result(len(keys), correct, elapsed_ms, consistency, key_errors)
+
+
+def _codes(numpy, strings):
+    return numpy.frombuffer(''.join(strings).encode('utf-32-le'), dtype=numpy.uint32)
+
+
+def _score_batch(logs):
+    """Vectorized score() for a list of non-empty (keys, intervals, text, duration_ms)"""
+    numpy = _get_numpy()
+    lengths = numpy.fromiter((len(log[0]) for log in logs), dtype=numpy.int64, count=len(logs))
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    segment = numpy.repeat(numpy.arange(len(logs)), lengths)
+
+    typed = _codes(numpy, (log[0] for log in logs))
+    expected = _codes(numpy, (log[2][:len(log[0])] for log in logs))
+    match = typed == expected
+    correct = numpy.add.reduceat(match.astype(numpy.int64), starts)
+
+    intervals = numpy.fromiter(chain.from_iterable(log[1] for log in logs), dtype=numpy.float64, count=len(typed))
+    elapsed = numpy.add.reduceat(intervals, starts)
+    # Consistency ignores the wait before the first keystroke of each test
+    gaps = intervals.copy()
+    gaps[starts] = 0.0
+    gap_totals = numpy.add.reduceat(gaps, starts)
+    gap_squares = numpy.add.reduceat(gaps * gaps, starts)
+
+    # Attempts and misses per (test, expected character); pairs come out sorted by test
+    pair = segment.astype(numpy.uint64) << numpy.uint64(32) | expected.astype(numpy.uint64)
+    pairs, inverse, attempts = numpy.unique(pair, return_inverse=True, return_counts=True)
+    misses = numpy.bincount(inverse, weights=~match, minlength=len(pairs)).astype(numpy.int64)
+    bounds = numpy.searchsorted(pairs >> numpy.uint64(32), numpy.arange(len(logs) + 1, dtype=numpy.uint64)).tolist()
+    chars = list(map(chr, (pairs & numpy.uint64(0xFFFFFFFF)).tolist()))
+    counts = list(map(list, zip(attempts.tolist(), misses.tolist())))
+
+    results = []
+    columns = zip(lengths.tolist(), correct.tolist(), elapsed.tolist(), gap_totals.tolist(), gap_squares.tolist())
+    for index, (count, right, total_ms, gap_total, gap_square) in enumerate(columns):
+        key_errors = dict(zip(chars[bounds[index]:bounds[index + 1]], counts[bounds[index]:bounds[index + 1]]))
+        consistency = _consistency(count - 1, gap_total, gap_square)
+        results.append(_result(count, right, max(total_ms, logs[index][3]), consistency, key_errors))
+    return results
+
+def score_many(logs):
+    """Score a batch of (keys, intervals, text, duration_ms) logs"""
+    if _get_numpy() is None:
+        return [score(*log) for log in logs]
+    # reduceat cannot represent empty segments, so empty logs are scored one by one
+    results = [None if log[0] else score(*log) for log in logs]
+    batch = [index for index, log in enumerate(logs) if log[0]]
+    if batch:
+        for index, result in zip(batch, _score_batch([logs[index] for index in batch])):
+            results[index] = result
+    return results
+
+def validate(result, intervals, claimed_wpm=None, claimed_accuracy=None):
+    """Return why a scored test looks fabricated, or None if it is plausible"""
+    if result['wpm'] > MAX_WPM:
+        return "Typing speed is not humanly possible"
+    if len(intervals) >= MIN_KEYS_FOR_TIMING_CHECK:
+        fast = sum(1 for gap in intervals[1:] if gap < MIN_HUMAN_INTERVAL_MS)
+        if fast > MAX_FAST_SHARE * (len(intervals) - 1):
+            return "Keystroke timing looks automated"
+    if claimed_wpm is not None and claimed_wpm > result['wpm'] + WPM_TOLERANCE:
+        return "Claimed WPM does not match the keystrokes"
+    if claimed_accuracy is not None and claimed_accuracy > result['accuracy'] + ACCURACY_TOLERANCE:
+        return "Claimed accuracy does not match the keystrokes"
+    return None
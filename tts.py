@@ -0,0 +1,309 @@
+"""Text-to-speech with a long-lived event loop and a two-tier audio cache.
+
+Synthesis runs on one background asyncio loop instead of a new loop per
+request; asyncio and the loop are only set up by the first synthesis. Rendered clips are content-addressed by (voice, text) and kept in
+a bounded in-memory LRU backed by files on disk (also an LRU, capped at
+TTS_DISK_CACHE_BYTES), so repeated phrases such as the motivational quotes
+are only synthesized once per instance.
+
+The synthesizer is pluggable: EdgeSynthesizer talks to edge-tts, while
+FakeSynthesizer produces deterministic bytes locally for tests and
+benchmarks. Install one with set_synthesizer().
+"""
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import metrics
+
+DEFAULT_VOICE = os.environ.get('TTS_VOICE', 'en-US-AriaNeural')
+CACHE_DIR = os.environ.get('TTS_CACHE_DIR', 'tts_cache' if os.name == 'nt' else '/tmp/tts_cache')
+MEMORY_CACHE_BYTES = int(os.environ.get('TTS_MEMORY_CACHE_BYTES', 32 * 1024 * 1024))
+# /speech accepts arbitrary text, so the on-disk clips are capped too
+DISK_CACHE_BYTES = int(os.environ.get('TTS_DISK_CACHE_BYTES', 512 * 1024 * 1024))
+TIMEOUT = float(os.environ.get('TTS_TIMEOUT', 30))
+
+AUDIO_MIMETYPE = 'audio/mpeg'
+
+
+class Synthesizer:
+    """Interface for speech backends"""
+
+    async def stream(self, text, voice):
+        """Yield audio chunks (bytes) for `text` spoken by `voice`"""
+        raise NotImplementedError
+        yield b''
+
+
+class EdgeSynthesizer(Synthesizer):
+    """Microsoft Edge TTS voices via edge-tts"""
+
+    async def stream(self, text, voice):
+        import edge_tts
+
+        communicate = edge_tts.Communicate(text, voice)
+        with metrics.external('edge_tts', 'synthesize'):
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    yield chunk["data"]
+
+
+class FakeSynthesizer(Synthesizer):
+    """Offline stand-in that returns deterministic pseudo-audio"""
+
+    def __init__(self, chunk_size=4096, chunks=4, delay=0.0):
+        self.chunk_size = chunk_size
+        self.chunks = chunks
+        self.delay = delay
+        self.calls = 0
+
+    async def stream(self, text, voice):
+        self.calls += 1
+        seed = hashlib.sha256(f"{voice}\0{text}".encode()).digest()
+        block = (seed * (self.chunk_size // len(seed) + 1))[:self.chunk_size]
+        for _ in range(self.chunks):
+            if self.delay:
+                import asyncio
+
+                await asyncio.sleep(self.delay)
+            yield block
+
+
+def audio_key(text, voice=DEFAULT_VOICE):
+    """Content address of a clip"""
+    return hashlib.sha256(f"{voice}\0{text}".encode()).hexdigest()
+
+
+class AudioCache:
+    """Memory LRU in front of an on-disk LRU, each bounded by total bytes"""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MEMORY_CACHE_BYTES, max_disk_bytes=DISK_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._size = 0
+        # key -> size of the clips on disk, least recently used first;
+        # read from the directory (by mtime) on first use
+        self._disk = None
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get(self, key):
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return audio
+        try:
+            with open(self._path(key), 'rb') as f:
+                audio = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, audio)
+        with self._lock:
+            disk = self._disk_index()
+            if key in disk:
+                disk.move_to_end(key)
+        try:
+            # Keeps the order across restarts, which rebuild it from mtimes
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return audio
+
+    def put(self, key, audio):
+        self._remember(key, audio)
+        if not self.directory or len(audio) > self.max_disk_bytes:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"Error writing TTS cache: {e}")
+            return
+        evicted = []
+        with self._lock:
+            disk = self._disk_index()
+            self._disk_size += len(audio) - disk.pop(key, 0)
+            disk[key] = len(audio)
+            while self._disk_size > self.max_disk_bytes:
+                old_key, size = disk.popitem(last=False)
+                self._disk_size -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def _disk_index(self):
+        """The on-disk LRU index (call with the lock held)"""
+        if self._disk is None:
+            entries = []
+            try:
+                with os.scandir(self.directory) as listing:
+                    for entry in listing:
+                        if entry.name.endswith('.mp3'):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            except OSError:
+                pass
+            entries.sort()
+            self._disk = OrderedDict((key, size) for _, key, size in entries)
+            self._disk_size = sum(size for _, _, size in entries)
+        return self._disk
+
+    def _remember(self, key, audio):
+        if len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._memory[key] = audio
+            self._size += len(audio)
+            while self._size > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._size -= len(evicted)
+
+
+class TTSEngine:
+    """Runs synthesis on a shared background event loop"""
+
+    def __init__(self, synthesizer=None, audio_cache=None):
+        self.synthesizer = synthesizer or EdgeSynthesizer()
+        self.cache = audio_cache or AudioCache()
+        self._loop = None
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                import asyncio
+
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='tts-loop', daemon=True)
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+    async def _render(self, text, voice, sink):
+        chunks = []
+        async for chunk in self.synthesizer.stream(text, voice):
+            chunks.append(chunk)
+            if sink is not None:
+                sink(chunk)
+        return b"".join(chunks)
+
+    def _start(self, key, text, voice, sink=None):
+        """Start (or join) the synthesis of a clip.
+
+        Returns (future, started); `sink` only receives chunks when this
+        call started the synthesis.
+        """
+        import asyncio
+
+        loop = self._get_loop()
+        # Look up and register under one acquisition, so concurrent requests
+        # for the same clip share a single synthesis
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+            future = asyncio.run_coroutine_threadsafe(self._render(text, voice, sink), loop)
+            self._inflight[key] = future
+
+        def finished(done):
+            with self._lock:
+                self._inflight.pop(key, None)
+            if not done.cancelled() and done.exception() is None:
+                self.cache.put(key, done.result())
+
+        future.add_done_callback(finished)
+        return future, True
+
+    def synthesize(self, text, voice=DEFAULT_VOICE):
+        """Return the complete clip for `text`, from cache when possible"""
+        key = audio_key(text, voice)
+        audio = self.cache.get(key)
+        if audio is not None:
+            return audio
+        future, _ = self._start(key, text, voice)
+        return future.result(TIMEOUT)
+
+    def stream(self, text, voice=DEFAULT_VOICE):
+        """Yield the clip in chunks as they are produced.
+
+        Cached clips come back as a single chunk; otherwise chunks are
+        forwarded from the background loop while the full clip is cached.
+        """
+        key = audio_key(text, voice)
+        audio = self.cache.get(key)
+        if audio is not None:
+            yield audio
+            return
+
+        chunks = queue.Queue()
+        future, started = self._start(key, text, voice, sink=chunks.put_nowait)
+        if not started:
+            yield future.result(TIMEOUT)
+            return
+
+        future.add_done_callback(lambda _: chunks.put_nowait(None))
+        while True:
+            chunk = chunks.get(timeout=TIMEOUT)
+            if chunk is None:
+                break
+            yield chunk
+        # Surface synthesis errors raised after the last chunk
+        future.result(0)
+
+    def prerender(self, texts, voice=DEFAULT_VOICE):
+        """Synthesize uncached clips in the background (fire and forget)"""
+        for text in texts:
+            key = audio_key(text, voice)
+            if self.cache.get(key) is None:
+                future, _ = self._start(key, text, voice)
+                future.add_done_callback(_log_failure)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error pre-rendering speech: {future.exception()}")
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide TTS engine"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = TTSEngine()
+        return _engine
+
+
+def set_synthesizer(synthesizer, audio_cache=None):
+    """Replace the process-wide engine's backend (e.g. FakeSynthesizer in tests)"""
+    global _engine
+    with _engine_lock:
+        _engine = TTSEngine(synthesizer, audio_cache)
+        return _engine